@@ -1,11 +1,17 @@
 # Copyright 2019-2020 RnD Center "ELVEES", JSC
 
+import binascii
+import contextlib
+import contextvars
 import importlib.metadata
+import re
 import sys
 import time
 
 import serial
 
+from mcom02_flash_tools.trace import span
+
 try:
     __version__ = importlib.metadata.version(__package__)
 except importlib.metadata.PackageNotFoundError:
@@ -17,20 +23,358 @@ def eprint(*args, **kwargs):
     print('Error:', *args, file=sys.stderr, **kwargs)
 
 
-class CommandError(Exception):
-    pass
+# Handler of progress messages in the current context (see progress_handler())
+_progress_handler = contextvars.ContextVar('progress_handler', default=print)
+
+
+def progress(message):
+    """Report progress message of an operation: print it or pass it to the handler set by
+    progress_handler().
+    """
+    _progress_handler.get()(message)
+
+
+@contextlib.contextmanager
+def progress_handler(handler):
+    """Context manager which passes progress messages to `handler` (callable with message
+    argument, None drops the messages).
+    """
+    token = _progress_handler.set(handler if handler is not None else lambda message: None)
+    try:
+        yield
+    finally:
+        _progress_handler.reset(token)
+
+
+class FlashToolsError(Exception):
+    """Base class of errors of flashing operations."""
+
+
+class CommandError(FlashToolsError):
+    """Target does not respond or a command of the target fails."""
+
+
+class PortError(FlashToolsError):
+    """Serial port can not be opened."""
+
+
+class FlashMemoryError(FlashToolsError):
+    """Flash memory does not fit the data or does not complete an operation."""
+
+
+class VerificationError(FlashToolsError):
+    """Data read back from flash memory differs from the written one. `result` is result of
+    the operation (e.g. mcom02_flash_tools.api.FlashResult).
+    """
+
+    def __init__(self, message, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+class UMSError(FlashToolsError):
+    """USB Mass Storage device of the board is not found or can not be written."""
+
+
+class ReplayError(FlashToolsError):
+    """Host sends data which differs from the replayed transcript (see
+    mcom02_flash_tools.transcript.ReplaySerial).
+    """
+
+
+def open_serial(port, baudrate, timeout):
+    """Return serial port `port` configured with `baudrate` and read `timeout`. `port` is
+    a name, "replay:FILE[@SPEED]" for replay of a transcript (see
+    mcom02_flash_tools.transcript) or already open port (e.g. serial.Serial kept open by
+    mcom02-flash-daemon).
+    """
+    if not isinstance(port, str):
+        port.baudrate = baudrate
+        port.timeout = timeout
+        return port
+    from mcom02_flash_tools.transcript import ReplaySerial, is_replay_port
+
+    if is_replay_port(port):
+        return ReplaySerial.from_url(port, timeout)
+    return serial.Serial(port=port, baudrate=baudrate, timeout=timeout)
+
+
+class UARTProtocol(object):
+    """Command line protocol of UART console independent of I/O: search of patterns in
+    received data and parsing of responses and return codes. Used by UART and by
+    mcom02_flash_tools.aio.AsyncUART.
+
+    Methods with suffix "_steps" are generators of the console methods (e.g. _run_steps() for
+    run()). They yield I/O requests and return the result of the method:
+
+    * ('read', timeout) - the transport sends data received from UART (may be empty), the
+      transport waits for the first byte up to `timeout` seconds (None - infinite) or less;
+    * ('write', data) - the transport writes `data` to UART;
+    * ('sleep', seconds) - the transport waits.
+
+    The transports run the generators by _drive(), so the control flow is the same for
+    blocking and asyncio I/O.
+    """
+
+    # Marker printed before return code in the same line as command (see run_with_retcode())
+    RETCODE_MARKER = '@rc@'
+    # Conservative size of command line buffer of the shell (default CONFIG_SYS_CBSIZE of
+    # U-Boot), longer command lines are truncated. Return code of command which does not fit
+    # with the marker is received by separate "echo $?"
+    CMD_LINE_SIZE = 256
+
+    def __init__(self, prompt, newline='\n', verbose=False, window=1, retcode_mode='auto'):
+        self.prompt = prompt
+        self.window = window
+        self.retcode_mode = retcode_mode
+        self.newline = newline
+        self.verbose = verbose
+        self._rx_buf = bytearray()
+
+    @staticmethod
+    def _patterns(expected):
+        if not isinstance(expected, (list, tuple)):
+            expected = (expected,)
+        return [x.encode() for x in expected]
+
+    @staticmethod
+    def _find_patterns(resp, patterns, search_pos, match_end):
+        """Return end of the pattern which ends first in `resp`. Only the data after
+        `search_pos` is searched, `match_end` is the end of the match found before or None.
+        """
+        for pattern in patterns:
+            pos = resp.find(pattern, search_pos)
+            if pos >= 0 and (match_end is None or pos + len(pattern) < match_end):
+                match_end = pos + len(pattern)
+        return match_end
+
+    def _take_response(self, resp, match_end):
+        """Return result of wait_for_string() for data `resp` with match at `match_end`. Data
+        after the match is kept for the next call.
+        """
+        if match_end is not None:
+            self._rx_buf = resp[match_end:]
+            del resp[match_end:]
+
+        result = resp.decode(errors='replace').replace('\r', '')
+        if self.verbose:
+            print(result, end='')
+
+        return match_end is not None, result
+
+    def _strip_echo(self, cmd, resp):
+        # Return only output of command (without cmd + "\n" and command prompt)
+        return resp[len(cmd) + 1 : -len(self.prompt)]
+
+    def _retcode_probe_cmd(self):
+        return 'echo {}$?'.format(self.RETCODE_MARKER)
+
+    def _set_retcode_mode(self, probe_resp):
+        """Select retcode mode by response of _retcode_probe_cmd() in 'auto' mode."""
+        probe = r'{}\d+'.format(re.escape(self.RETCODE_MARKER))
+        supported = probe_resp is not None and re.fullmatch(probe, probe_resp.strip())
+        self.retcode_mode = 'inline' if supported else 'separate'
+
+    def _inline_cmd(self, cmd):
+        return '{}; echo {}$?'.format(cmd, self.RETCODE_MARKER)
+
+    def _inline_fits(self, cmd):
+        return len(self._inline_cmd(cmd).encode()) < self.CMD_LINE_SIZE
+
+    def _parse_inline_retcode(self, cmd, resp, strip_echo=True):
+        """Return return code and result of command `cmd` run by _inline_cmd(). If not
+        `strip_echo` then the result is the same as in 'separate' mode: the echo of command
+        line without the echo of the marker, the output and the prompt.
+        """
+        if resp is None:
+            raise CommandError('UART timeout at command "{}"'.format(cmd))
+
+        prompt = self.prompt.replace('\r', '')
+        text = resp
+        if not strip_echo and text.endswith(prompt):
+            text = text[: -len(prompt)]
+        # The marker with digits can only be printed by echo, the echo of command line has "$?"
+        match = None
+        for match in re.finditer(r'{}(\d+)'.format(re.escape(self.RETCODE_MARKER)), text):
+            pass
+        if match is None or text[match.end() :].strip():
+            raise CommandError('Can not parse return code of command "{}":\n{}'.format(cmd, resp))
+
+        result = text[: match.start()]
+        if result.endswith('\n'):
+            result = result[:-1]
+        if not strip_echo:
+            inline_cmd = self._inline_cmd(cmd)
+            if result.startswith(inline_cmd):
+                result = cmd + result[len(inline_cmd) :]
+            result += prompt
+        return int(match.group(1)), result
+
+    @staticmethod
+    def _parse_echo_retcode(cmd, resp):
+        if resp is None:
+            raise CommandError('UART timeout at command "echo $?" after "{}"'.format(cmd))
+        return int(resp)
+
+    @staticmethod
+    def _check_retcode(cmd, retcode, result, check, errmsg):
+        if check and retcode:
+            if errmsg is None:
+                errmsg = 'Command "{}" failed'.format(cmd)
+            raise CommandError('{}\nTarget answer:\n{}'.format(errmsg, result))
+
+        return retcode, result
+
+    def _wait_for_string_steps(self, expected, timeout):
+        patterns = self._patterns(expected)
+        max_len = max(len(x) for x in patterns)
+        time_end = time.monotonic() + timeout if timeout is not None else None
+
+        # Data received after the pattern by previous call is the beginning of the response
+        resp = self._rx_buf
+        self._rx_buf = bytearray()
+        search_pos = 0
+        match_end = None
+        with span('wait_for_string', 'wait'):
+            while True:
+                # Only the tail that may contain a new occurrence of a pattern is searched
+                match_end = self._find_patterns(resp, patterns, search_pos, match_end)
+                remaining = time_end - time.monotonic() if time_end is not None else None
+                if match_end is not None or (remaining is not None and remaining < 0):
+                    break
+                search_pos = max(0, len(resp) - max_len + 1)
+                resp += yield 'read', remaining
+
+        return self._take_response(resp, match_end)
+
+    def _run_steps(self, cmd, timeout=5, strip_echo=True):
+        data = '{}{}'.format(cmd, self.newline).encode()
+        with span('run', tx=len(data), baudrate=self.tty.baudrate) as s:
+            yield 'write', data
+            success, resp = yield from self._wait_for_string_steps(self.prompt, timeout)
+            s.set(rx=len(resp))
+        if not success:
+            return None
+
+        return self._strip_echo(cmd, resp) if strip_echo else resp
+
+    def _run_batch_steps(self, cmds, timeout=5, strip_echo=True, window=None):
+        if window is None:
+            window = self.window
+        window = max(1, window)
+        results = []
+        sent = 0
+        tx = rx = 0
+        with span('run_batch', count=len(cmds), baudrate=self.tty.baudrate) as s:
+            while len(results) < len(cmds):
+                if sent - len(results) < window and sent < len(cmds):
+                    count = min(len(cmds), len(results) + window) - sent
+                    data = ''.join(x + self.newline for x in cmds[sent : sent + count]).encode()
+                    yield 'write', data
+                    sent += count
+                    tx += len(data)
+
+                success, resp = yield from self._wait_for_string_steps(self.prompt, timeout)
+                rx += len(resp)
+                if not success:
+                    results += [None] * (len(cmds) - len(results))
+                    break
+                cmd = cmds[len(results)]
+                results.append(self._strip_echo(cmd, resp) if strip_echo else resp)
+            s.set(tx=tx, rx=rx)
+
+        return results
+
+    def _inline_retcode_steps(self):
+        """Return True if return code is received in the same round trip as command output.
+        In 'auto' mode probe the shell on the first call.
+        """
+        if self.retcode_mode == 'auto':
+            self._set_retcode_mode((yield from self._run_steps(self._retcode_probe_cmd())))
+        return self.retcode_mode == 'inline'
+
+    def _run_with_retcode_steps(self, cmd, timeout=5, strip_echo=True, check=True, errmsg=None):
+        if (yield from self._inline_retcode_steps()) and self._inline_fits(cmd):
+            resp = yield from self._run_steps(self._inline_cmd(cmd), timeout, strip_echo)
+            retcode, result = self._parse_inline_retcode(cmd, resp, strip_echo)
+        else:
+            result = yield from self._run_steps(cmd, timeout, strip_echo)
+            retcode = self._parse_echo_retcode(cmd, (yield from self._run_steps('echo $?')))
+        return self._check_retcode(cmd, retcode, result, check, errmsg)
+
+    def _run_batch_with_retcode_steps(
+        self, cmds, timeout=5, strip_echo=True, check=True, errmsg=None, window=None
+    ):
+        inline = yield from self._inline_retcode_steps()
+        inline = [inline and self._inline_fits(x) for x in cmds]
+        batch = []
+        for cmd, cmd_inline in zip(cmds, inline):
+            batch += [self._inline_cmd(cmd)] if cmd_inline else [cmd, 'echo $?']
+        resps = iter((yield from self._run_batch_steps(batch, timeout, strip_echo, window)))
+        results = []
+        for cmd, cmd_inline in zip(cmds, inline):
+            if cmd_inline:
+                results.append(self._parse_inline_retcode(cmd, next(resps), strip_echo))
+                continue
+            result, echo_resp = next(resps), next(resps)
+            if not strip_echo and echo_resp is not None:
+                echo_resp = self._strip_echo('echo $?', echo_resp)
+            results.append((self._parse_echo_retcode(cmd, echo_resp), result))
+        return [
+            self._check_retcode(cmd, retcode, result, check, errmsg)
+            for cmd, (retcode, result) in zip(cmds, results)
+        ]
+
+    def _wait_for_uboot_steps(self, timeout=None, show_status=True):
+        if show_status:
+            progress('Waiting for U-Boot prompt...')
+        yield 'write', b'\x03'  # send Ctrl-C for new prompt if U-Boot is already loaded
+
+        success, resp = yield from self._wait_for_string_steps(
+            ['Hit any key to stop autoboot:', self.prompt], timeout
+        )
+        if not success:
+            return False
+        elif resp.endswith(self.prompt):  # If U-Boot already loaded then do not need any actions
+            return True
+
+        yield 'sleep', 0.01  # wait for complete U-Boot message output
+        yield 'write', b'\x03'  # send Ctrl-C to interrupt autoboot
+        yield from self._wait_for_string_steps(self.prompt, 1)  # wait for prompt
+
+        return True
 
 
-class UART(object):
+class UART(UARTProtocol):
     """Class for work with UART console."""
 
-    def __init__(self, prompt, port, newline='\n', verbose=False, baudrate=115200, timeout=0.5):
+    # Baudrates tried by negotiate_baudrate()
+    BAUDRATES = (115200, 230400, 460800, 921600, 1000000, 1500000, 2000000, 3000000)
+    # Count of strings sent by probe_link(), the strings are deterministic, so the exchange
+    # can be replayed from a transcript (see mcom02_flash_tools.transcript)
+    _probe_count = 0
+
+    # YMODEM control characters (see send_ymodem())
+    SOH, STX, EOT, ACK, NAK, CAN = b'\x01', b'\x02', b'\x04', b'\x06', b'\x15', b'\x18'
+
+    def __init__(
+        self,
+        prompt,
+        port,
+        newline='\n',
+        verbose=False,
+        baudrate=115200,
+        timeout=0.5,
+        window=1,
+        retcode_mode='auto',
+        record=None,
+    ):
         """Parameters
         ----------
         prompt : str
             expected command line prompt
-        port : str
-            serial port for use (example: /dev/ttyUSB0)
+        port : str or serial.Serial
+            serial port for use (example: /dev/ttyUSB0), "replay:FILE[@SPEED]" or open port
         newline : str
             new line delimeter
         verbose : bool
@@ -39,11 +383,59 @@ class UART(object):
             UART speed in bit/sec
         timeout : float
             timeout for read() operations and affects the accuracy of the command execution time
+        window : int
+            default count of commands sent by run_batch() without waiting for the prompt
+        retcode_mode : str
+            how run_with_retcode() gets return code: 'inline' - command and "echo" of return
+            code are sent in one line (one round trip, 'separate' is used for command which
+            does not fit to CMD_LINE_SIZE with the echo), 'separate' - "echo $?" is sent as
+            a separate command, 'auto' - use 'inline' if it is supported by the shell
+        record : str
+            if specified then the exchange is recorded to the transcript file (see
+            mcom02_flash_tools.transcript)
         """
-        self.prompt = prompt
-        self.newline = newline
-        self.verbose = verbose
-        self.tty = serial.Serial(port=port, baudrate=baudrate, timeout=timeout)
+        super().__init__(prompt, newline, verbose, window, retcode_mode)
+        self.tty = open_serial(port, baudrate, timeout)
+        self._recording = record is not None
+        if self._recording:
+            from mcom02_flash_tools.transcript import RecordingSerial
+
+            self.tty = RecordingSerial(self.tty, record)
+        self._original_baudrate = None
+        self._switch_baudrate = None
+
+    def close(self, keep_port=False):
+        """Close the port. If `keep_port` then only resources of the console (e.g. transcript
+        file) are released and the port stays open (e.g. the port kept by mcom02-flash-daemon).
+        """
+        if not keep_port:
+            self.tty.close()
+        elif self._recording:
+            self.tty = self.tty.detach()
+            self._recording = False
+
+    def _drive(self, steps):
+        """Run generator `steps` of UARTProtocol with blocking I/O, return its result."""
+        result = error = None
+        while True:
+            try:
+                # I/O errors are raised in the generator, so its spans are finished
+                request = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as e:
+                return e.value
+            result = error = None
+            op, arg = request
+            try:
+                if op == 'read':
+                    # Read all waiting data at once or block until the first byte (or tty
+                    # timeout), the timeout of the request is checked by the generator
+                    result = self.tty.read(self.tty.in_waiting or 1)
+                elif op == 'write':
+                    self.tty.write(arg)
+                else:
+                    time.sleep(arg)
+            except BaseException as e:
+                error = e
 
     def wait_for_string(self, expected, timeout=1):
         """Method to wait for pattern `expected` to be received from UART.
@@ -63,31 +455,7 @@ class UART(object):
         str
             received data
         """
-
-        def endswith(resp, expected):
-            if not isinstance(expected, (list, tuple)):
-                expected = (expected,)
-
-            return any(map(resp.endswith, expected))
-
-        if timeout is not None:
-            time_end = time.monotonic() + timeout
-        else:
-            time_end = sys.float_info.max
-        resp = ''
-        while (time.monotonic() <= time_end) and not endswith(resp, expected):
-            ch = self.tty.read(1)
-            if not ch:
-                continue
-            resp += ch.decode()
-
-        result = resp.replace('\r', '')
-        if self.verbose:
-            print(result, end='')
-        if not endswith(resp, expected):
-            return False, result
-
-        return True, result
+        return self._drive(self._wait_for_string_steps(expected, timeout))
 
     def run(self, cmd, timeout=5, strip_echo=True):
         """Run command and wait for prompt.
@@ -106,13 +474,31 @@ class UART(object):
         str
             response string
         """
-        self.tty.write('{}{}'.format(cmd, self.newline).encode())
-        success, resp = self.wait_for_string(self.prompt, timeout)
-        if not success:
-            return None
+        return self._drive(self._run_steps(cmd, timeout, strip_echo))
 
-        # Return only output of command (without cmd + "\n" and command prompt)
-        return resp[len(cmd) + 1 : -len(self.prompt)] if strip_echo else resp
+    def run_batch(self, cmds, timeout=5, strip_echo=True, window=None):
+        """Run commands pipelined: up to `window` commands are sent without waiting for
+        the prompt. The response stream is split on prompts, so the target must process
+        the commands in order and must buffer the input while a command is executed.
+
+        Parameters
+        ----------
+        cmds : list of str
+            commands
+        timeout : float
+            argument for wait_for_string() for each command
+        strip_echo : bool
+            if true then will remove echo from response strings
+        window : int
+            count of commands in flight, if None then `self.window` is used
+
+        Returns
+        -------
+        list of str
+            response string for every command. If prompt was not received then the response
+            of the command and of all subsequent commands is None
+        """
+        return self._drive(self._run_batch_steps(cmds, timeout, strip_echo, window))
 
     def run_with_retcode(self, cmd, timeout=5, strip_echo=True, check=True, errmsg=None):
         """Run command and wait for prompt. Return retcode and result.
@@ -137,18 +523,19 @@ class UART(object):
         str
             response string
         """
-        result = self.run(cmd, timeout, strip_echo)
-        resp = self.run('echo $?')
-        if resp is None:
-            raise CommandError('UART timeout at command "echo $?" after "{}"'.format(cmd))
+        return self._drive(self._run_with_retcode_steps(cmd, timeout, strip_echo, check, errmsg))
 
-        retcode = int(resp)
-        if check and retcode:
-            if errmsg is None:
-                errmsg = 'Command "{}" failed'.format(cmd)
-            raise CommandError('{}\nTarget answer:\n{}'.format(errmsg, result))
+    def run_batch_with_retcode(
+        self, cmds, timeout=5, strip_echo=True, check=True, errmsg=None, window=None
+    ):
+        """Run commands pipelined (see run_batch()). Return list of retcodes and results.
 
-        return retcode, result
+        Parameters are the same as for run_with_retcode() and run_batch(). If check is True
+        then exception is raised for the first command returned non-zero retcode.
+        """
+        return self._drive(
+            self._run_batch_with_retcode_steps(cmds, timeout, strip_echo, check, errmsg, window)
+        )
 
     def get_uboot_board_model(self, timeout=5):
         self.run("fdt addr $fdtcontroladdr", timeout=timeout)
@@ -166,20 +553,207 @@ class UART(object):
             return None
 
     def wait_for_uboot(self, timeout=None, show_status=True):
-        if show_status:
-            print('Waiting for U-Boot prompt...')
-        self.tty.write(b'\x03')  # send Ctrl-C for new prompt if U-Boot is already loaded
+        return self._drive(self._wait_for_uboot_steps(timeout, show_status))
 
-        success, resp = self.wait_for_string(
-            ['Hit any key to stop autoboot:', self.prompt], timeout=timeout
-        )
-        if not success:
+    def set_host_baudrate(self, baudrate):
+        """Change baudrate of the host side and drop data received at the old baudrate."""
+        self.tty.baudrate = baudrate
+        self.tty.reset_input_buffer()
+        self._rx_buf = bytearray()
+
+    def set_uboot_baudrate(self, baudrate, timeout=1):
+        """Switch U-Boot and host to `baudrate` with "setenv baudrate" command.
+
+        Returns
+        -------
+        bool
+            True if U-Boot prompt is received at new baudrate
+        """
+        self.tty.write('setenv baudrate {}{}'.format(baudrate, self.newline).encode())
+        success, resp = self.wait_for_string(['press ENTER ...', 'not supported'], timeout)
+        if not success or not resp.endswith('press ENTER ...'):
+            # baudrate is not supported by U-Boot, prompt is at old baudrate
+            self.wait_for_string(self.prompt, timeout)
             return False
-        elif resp.endswith(self.prompt):  # If U-Boot already loaded then do not need any actions
-            return True
 
-        time.sleep(0.01)  # wait for complete U-Boot message output
-        self.tty.write(b'\x03')  # send Ctrl-C to interrupt autoboot
-        self.wait_for_string(self.prompt)  # wait for prompt
+        # U-Boot switches UART 50 ms after the message and then waits for ENTER
+        self.tty.flush()
+        time.sleep(0.1)
+        self.set_host_baudrate(baudrate)
+        self.tty.write(b'\r')
+        # New line before the prompt was sent at the old baudrate
+        success, _ = self.wait_for_string(self.prompt.lstrip('\r\n'), timeout)
+        return success
+
+    def probe_link(self, count=4, timeout=1):
+        """Check link by echo of strings with varying bits. Return True if all strings are
+        received.
+        """
+        tokens = []
+        for _ in range(count):
+            self._probe_count += 1
+            # Fibonacci hashing of the counter: every string differs from the previous ones
+            tokens.append('probe{:08x}'.format(self._probe_count * 0x9E3779B1 & 0xFFFFFFFF))
+        resps = self.run_batch(['echo {}'.format(x) for x in tokens], timeout)
+        return all(resp is not None and resp.strip() == x for x, resp in zip(tokens, resps))
 
-        return True
+    def negotiate_baudrate(self, switch, max_baudrate, probes=4):
+        """Switch to the fastest reliable baudrate not greater than `max_baudrate`.
+
+        Baudrates from BAUDRATES are tried from the fastest one. After switching the link is
+        checked with probe_link(); on errors the target and host are switched back and the next
+        lower baudrate is tried. Original baudrate is restored by restore_baudrate().
+
+        Parameters
+        ----------
+        switch : callable
+            switch(baudrate) switches target and host to baudrate, returns True on success
+            (e.g. set_uboot_baudrate)
+        max_baudrate : int
+            maximum baudrate to try
+        probes : int
+            count of probes in probe_link()
+
+        Returns
+        -------
+        int
+            baudrate of the link
+        """
+        original = self.tty.baudrate
+        if self._original_baudrate is None:
+            self._original_baudrate = original
+        self._switch_baudrate = switch
+        for baudrate in sorted(self.BAUDRATES, reverse=True):
+            if baudrate <= original:
+                break
+            if baudrate > max_baudrate:
+                continue
+            if switch(baudrate) and self.probe_link(probes):
+                return baudrate
+            if self.tty.baudrate != original:
+                self._recover_baudrate(original, probes)
+        return self.tty.baudrate
+
+    def _recover_baudrate(self, baudrate, probes):
+        # Target can be at the new or at the old baudrate, try to switch back from the new one
+        if self._switch_baudrate(baudrate) and self.probe_link(probes):
+            return
+        self.set_host_baudrate(baudrate)
+        # ENTER for the case when target waits for it after switching, the answer is dropped
+        self.tty.write(b'\r')
+        time.sleep(0.1)
+        self.set_host_baudrate(baudrate)
+        if not self.probe_link(probes):
+            raise CommandError('Lost connection while switching baudrate')
+
+    def restore_baudrate(self):
+        """Switch target and host to baudrate used before negotiate_baudrate()."""
+        if self._original_baudrate is None or self.tty.baudrate == self._original_baudrate:
+            return
+        if not self._switch_baudrate(self._original_baudrate):
+            raise CommandError('Failed to restore baudrate {}'.format(self._original_baudrate))
+
+    def send_ymodem(self, data, file_name='image.bin', timeout=10, retries=10):
+        """Send `data` with YMODEM protocol (1 KiB packets with CRC-16).
+
+        Receiver must be started before (e.g. with U-Boot "loady" command). Every packet is
+        acknowledged by receiver and is sent again if it is corrupted.
+
+        Parameters
+        ----------
+        data : bytes
+            data for sending
+        file_name : str
+            file name sent in the header packet
+        timeout : float
+            time in seconds to wait for receiver answer on every packet
+        retries : int
+            count of attempts to send a packet
+        """
+
+        def packet(seq, payload, pad):
+            size = 128 if len(payload) <= 128 else 1024
+            payload = bytes(payload).ljust(size, pad)
+            header = (self.SOH if size == 128 else self.STX) + bytes([seq & 0xFF, ~seq & 0xFF])
+            return header + payload + binascii.crc_hqx(payload, 0).to_bytes(2, 'big')
+
+        def send(buf):
+            for _ in range(retries):
+                self.tty.write(buf)
+                success, resp = self.wait_for_string(
+                    [x.decode() for x in (self.ACK, self.NAK, self.CAN)], timeout
+                )
+                if success and resp.endswith(self.ACK.decode()):
+                    return
+                if success and resp.endswith(self.CAN.decode()):
+                    raise CommandError('YMODEM transfer is cancelled by receiver')
+            raise CommandError('YMODEM packet is not acknowledged by receiver')
+
+        def wait_for_receiver():
+            # Receiver requests packets with CRC-16 by 'C' character
+            if not self.wait_for_string('C', timeout)[0]:
+                raise CommandError('YMODEM receiver does not respond')
+
+        packets = (len(data) + 1023) // 1024
+        # Packets are sent with 5 bytes of header and CRC
+        size = len(data) + packets * 5
+        with span('send_ymodem', tx=size, rx=packets, baudrate=self.tty.baudrate):
+            wait_for_receiver()
+            send(packet(0, '{}\0{}\0'.format(file_name, len(data)).encode(), b'\0'))
+            wait_for_receiver()
+            view = memoryview(data)
+            for seq, offset in enumerate(range(0, len(data), 1024), 1):
+                send(packet(seq, view[offset : offset + 1024], b'\x1a'))
+            # The end of file is confirmed by receiver (may be after NAK) and then receiver
+            # requests the next header, empty header finishes the batch
+            send(self.EOT)
+            wait_for_receiver()
+            send(packet(0, b'', b'\0'))
+
+    def read_until(self, expected, timeout=1):
+        """Generator of data chunks received from UART until `expected` string. Unlike
+        wait_for_string() the data is not accumulated, so the caller can process it while
+        the rest is received. Raise CommandError if `expected` is not received in `timeout`
+        seconds.
+
+        Yields
+        ------
+        bytearray
+            received data up to and including `expected`
+        """
+        pattern = expected.encode()
+        time_end = time.monotonic() + timeout
+        # Tail of the previous chunk which may contain the beginning of the pattern
+        tail = bytearray()
+        data = self._rx_buf
+        self._rx_buf = bytearray()
+        while True:
+            pos = (tail + data[: len(pattern) - 1]).find(pattern)
+            if pos >= 0:
+                end = pos + len(pattern) - len(tail)
+            else:
+                pos = data.find(pattern)
+                end = pos + len(pattern) if pos >= 0 else None
+            if end is not None:
+                self._rx_buf = data[end:]
+                del data[end:]
+            if data and self.verbose:
+                print(data.decode(errors='replace').replace('\r', ''), end='')
+            if end is not None:
+                yield data
+                return
+            if data:
+                yield data
+                tail = (tail + data)[-(len(pattern) - 1) :] if len(pattern) > 1 else bytearray()
+            if time.monotonic() > time_end:
+                raise CommandError('{!r} is not received in {} s'.format(expected, timeout))
+            data = bytearray(self.tty.read(self.tty.in_waiting or 1))
+
+    def read_bytes(self, count, timeout=1):
+        """Read `count` bytes of binary data. Return less bytes if timeout is expired."""
+        time_end = time.monotonic() + timeout
+        data = self._rx_buf
+        while len(data) < count and time.monotonic() < time_end:
+            data += self.tty.read(max(1, min(self.tty.in_waiting, count - len(data))))
+        self._rx_buf = data[count:]
+        return bytes(data[:count])
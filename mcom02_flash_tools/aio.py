@@ -0,0 +1,211 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+
+"""asyncio transport for UART consoles.
+
+AsyncUART reads the serial port file descriptor when the event loop reports it is readable
+instead of blocking in read() with timeout, so one event loop drives many consoles and a
+waiting console does not use CPU or a thread:
+
+    async def flash(port):
+        uart = AsyncUART(prompt='\\nmcom# ', port=port)
+        await uart.wait_for_uboot(timeout=10)
+        return await uart.run_with_retcode('sf probe')
+
+    async def flash_all(ports):
+        return await asyncio.gather(*(flash(x) for x in ports))
+
+    results = asyncio.run(flash_all(ports))
+
+SyncUART is a blocking wrapper with interface of UART for the synchronous tools.
+"""
+
+import asyncio
+import os
+
+import serial
+
+from mcom02_flash_tools import UART, UARTProtocol, open_serial
+
+
+class AsyncUART(UARTProtocol):
+    """UART console with coroutine methods. Parameters are the same as for UART."""
+
+    # Maximum size of data read by one system call
+    READ_SIZE = 65536
+
+    def __init__(
+        self,
+        prompt,
+        port,
+        newline='\n',
+        verbose=False,
+        baudrate=115200,
+        timeout=0.5,
+        window=1,
+        retcode_mode='auto',
+        record=None,
+    ):
+        # Data is read from the descriptor of the port, so it can not be recorded or replayed
+        if record is not None:
+            raise ValueError('recording of transcript is not supported by AsyncUART')
+        super().__init__(prompt, newline, verbose, window, retcode_mode)
+        # Blocking methods of the port (e.g. read() used by UART methods inherited by SyncUART)
+        # are still available and use `timeout`
+        self.tty = open_serial(port, baudrate, timeout)
+        self._fd = self.tty.fileno()
+        os.set_blocking(self._fd, False)
+
+    def close(self, keep_port=False):
+        """Close the port, see UART.close()."""
+        if not keep_port:
+            self.tty.close()
+
+    def _read_nowait(self):
+        # pyserial sets VMIN = 0, so empty data is returned if nothing is received
+        try:
+            return os.read(self._fd, self.READ_SIZE)
+        except BlockingIOError:
+            return b''
+        except OSError as e:
+            raise serial.SerialException('read failed: {}'.format(e))
+
+    async def _wait_fd(self, add, remove, timeout):
+        """Wait until the port is ready for add(), e.g. loop.add_reader(). Return False if
+        `timeout` is expired.
+        """
+        ready = asyncio.get_running_loop().create_future()
+        add(self._fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            remove(self._fd)
+        return True
+
+    async def read(self, timeout=None):
+        """Return data received from UART. Wait up to `timeout` seconds (None - infinite) for
+        the first byte, return empty data if nothing is received.
+        """
+        data = self._read_nowait()
+        if data or (timeout is not None and timeout <= 0):
+            return data
+        loop = asyncio.get_running_loop()
+        if not await self._wait_fd(loop.add_reader, loop.remove_reader, timeout):
+            return b''
+        data = self._read_nowait()
+        if not data:
+            # the same error as raised by pyserial
+            raise serial.SerialException(
+                'device reports readiness to read but returned no data '
+                '(device disconnected or multiple access on port?)'
+            )
+        return data
+
+    async def write(self, data):
+        """Write `data` to UART, wait while the output buffer of the port is full."""
+        loop = asyncio.get_running_loop()
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(self._fd, view) :]
+            except BlockingIOError:
+                pass
+            except OSError as e:
+                raise serial.SerialException('write failed: {}'.format(e))
+            if view:
+                await self._wait_fd(loop.add_writer, loop.remove_writer, None)
+
+    async def _drive(self, steps):
+        """Run generator `steps` of UARTProtocol with asyncio I/O, return its result."""
+        result = error = None
+        while True:
+            try:
+                # I/O errors are raised in the generator, so its spans are finished
+                request = steps.send(result) if error is None else steps.throw(error)
+            except StopIteration as e:
+                return e.value
+            result = error = None
+            op, arg = request
+            try:
+                if op == 'read':
+                    result = await self.read(arg)
+                elif op == 'write':
+                    await self.write(arg)
+                else:
+                    await asyncio.sleep(arg)
+            except BaseException as e:
+                error = e
+
+    async def wait_for_string(self, expected, timeout=1):
+        """Wait for pattern `expected` to be received from UART, see UART.wait_for_string()."""
+        return await self._drive(self._wait_for_string_steps(expected, timeout))
+
+    async def run(self, cmd, timeout=5, strip_echo=True):
+        """Run command and wait for prompt, see UART.run()."""
+        return await self._drive(self._run_steps(cmd, timeout, strip_echo))
+
+    async def run_batch(self, cmds, timeout=5, strip_echo=True, window=None):
+        """Run commands pipelined, see UART.run_batch()."""
+        return await self._drive(self._run_batch_steps(cmds, timeout, strip_echo, window))
+
+    async def run_with_retcode(self, cmd, timeout=5, strip_echo=True, check=True, errmsg=None):
+        """Run command and wait for prompt. Return retcode and result, see
+        UART.run_with_retcode().
+        """
+        return await self._drive(
+            self._run_with_retcode_steps(cmd, timeout, strip_echo, check, errmsg)
+        )
+
+    async def run_batch_with_retcode(
+        self, cmds, timeout=5, strip_echo=True, check=True, errmsg=None, window=None
+    ):
+        """Run commands pipelined. Return list of retcodes and results, see
+        UART.run_batch_with_retcode().
+        """
+        return await self._drive(
+            self._run_batch_with_retcode_steps(cmds, timeout, strip_echo, check, errmsg, window)
+        )
+
+    async def wait_for_uboot(self, timeout=None, show_status=True):
+        """Wait for U-Boot prompt and interrupt autoboot, see UART.wait_for_uboot()."""
+        return await self._drive(self._wait_for_uboot_steps(timeout, show_status))
+
+
+def _delegated(name):
+    # Attribute of SyncUART stored in the wrapped AsyncUART
+    return property(
+        lambda self: getattr(self.uart, name), lambda self, value: setattr(self.uart, name, value)
+    )
+
+
+class SyncUART(UART):
+    """Blocking wrapper of AsyncUART with interface of UART. Console methods (e.g. run()) are
+    inherited from UART and their I/O is done by AsyncUART in a private event loop, the other
+    methods (e.g. negotiate_baudrate(), read_until(), send_ymodem()) use the same port and
+    receive buffer directly. Parameters are the same as for UART.
+    """
+
+    prompt = _delegated('prompt')
+    newline = _delegated('newline')
+    verbose = _delegated('verbose')
+    window = _delegated('window')
+    retcode_mode = _delegated('retcode_mode')
+    tty = _delegated('tty')
+    _rx_buf = _delegated('_rx_buf')
+
+    def __init__(self, *args, **kwargs):
+        self.uart = AsyncUART(*args, **kwargs)
+        self._loop = asyncio.new_event_loop()
+        self._original_baudrate = None
+        self._switch_baudrate = None
+
+    def close(self, keep_port=False):
+        self.uart.close(keep_port)
+        self._loop.close()
+
+    def _drive(self, steps):
+        # Console methods of UART run the generators with I/O of the wrapped AsyncUART
+        return self._loop.run_until_complete(self.uart._drive(steps))
@@ -0,0 +1,841 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+
+"""Programmatic interface of the flashing tools.
+
+FlashSession runs operations of mcom02-flash-spi, mcom02-flash-factory and
+mcom02-flash-ums-mmc on one UART connection. Errors are raised as subclasses of
+FlashToolsError, operations return result objects with durations of phases, byte counts
+and state of written blocks:
+
+    with FlashSession.open('/dev/ttyUSB0') as session:
+        result = session.flash_spi('image.bin')
+        session.verify_spi('image.bin')
+    print(result.bytes_written, result.timings)
+
+Progress messages (the output of the tools) are dropped unless `progress` handler (e.g.
+print) is passed to the session.
+"""
+
+import os
+import subprocess
+import sys
+import time
+import zlib
+from contextlib import contextmanager
+
+from serial import SerialException
+
+from mcom02_flash_tools import (
+    UART,
+    CommandError,
+    FlashMemoryError,
+    FlashToolsError,
+    PortError,
+    UMSError,
+    VerificationError,
+    progress,
+    progress_handler,
+)
+from mcom02_flash_tools.flash_chips import UNLOCK_GLOBAL
+from mcom02_flash_tools.ihex import map_file
+from mcom02_flash_tools.journal import Journal, default_journal_dir, journal_path
+from mcom02_flash_tools.mcom02_flash_factory import spi_lock, spi_probe, spi_unlock
+from mcom02_flash_tools.mcom02_flash_spi import (
+    BAUDRATE,
+    CHECK_BLOCK_SIZE,
+    CHECK_BLOCK_SIZES,
+    NEWLINE,
+    SECTOR_SIZE,
+    UPLOAD_BLOCK_SIZE,
+    UPLOAD_BLOCK_SIZES,
+    check_file,
+    clip_ranges,
+    erase_sectors,
+    image_layout,
+    load_image,
+    prepare_cache,
+    probe_flash,
+    profile_block_sizes,
+    read_jedec_id,
+    resume_point,
+    save_profile,
+    send_cmd,
+    send_cmds,
+    split_ranges,
+    unlock_write_protect,
+    write_bin_to_flash,
+)
+from mcom02_flash_tools.profile import Autotuner
+from mcom02_flash_tools.stub import FlasherStub
+from mcom02_flash_tools.trace import span
+
+# Terminal the board is running
+BOOTROM = 'bootrom'
+UBOOT = 'uboot'
+# Time in seconds to wait for U-Boot messages during enabling of USB Mass Storage
+UMS_TIMEOUT = 10
+# Time in seconds to wait for the block device of the board
+UMS_DEVICE_DELAY = 5
+
+
+def uart_options(mode):
+    """Return keyword arguments of UART for terminal `mode` (BOOTROM or UBOOT)."""
+    if mode == BOOTROM:
+        return {'prompt': '\r#', 'newline': NEWLINE, 'baudrate': BAUDRATE}
+    if mode == UBOOT:
+        return {'prompt': '\nmcom# '}
+    raise ValueError('Unknown terminal mode {!r}'.format(mode))
+
+
+class Result(object):
+    """Result of an operation.
+
+    Attributes
+    ----------
+    operation : str
+        name of the operation (e.g. 'flash_spi')
+    timings : dict
+        duration of phases of the operation (e.g. 'write', 'check') in seconds
+    duration : float
+        duration of the operation in seconds
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+        self.timings = {}
+        self.duration = 0.0
+        self._start = time.monotonic()
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager which adds its duration to timings of phase `name`."""
+        start = time.monotonic()
+        try:
+            with span(name, 'phase'):
+                yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.monotonic() - start
+
+    def finish(self):
+        self.duration = time.monotonic() - self._start
+        return self
+
+    def as_dict(self):
+        """Return attributes of the result as dict (e.g. for JSON report)."""
+        return {key: value for key, value in vars(self).items() if not key.startswith('_')}
+
+
+class FlashResult(Result):
+    """Result of writing or checking of SPI flash memory.
+
+    Attributes
+    ----------
+    chip : str
+        flash memory found by BootROM, None in U-Boot mode
+    size : int
+        size of the image in bytes
+    bytes_written : int
+        count of bytes written to flash memory (blocks written again are counted once)
+    bytes_erased : int
+        count of bytes of sectors erased instead of writing
+    bytes_checked : int
+        count of bytes read back and compared with the image
+    blocks : list
+        state of written blocks, see write_bin_to_flash() (empty with flasher stub and in
+        U-Boot mode)
+    verified : bool
+        True if flash data is equal to the image
+    """
+
+    def __init__(self, operation, size=0):
+        super().__init__(operation)
+        self.chip = None
+        self.size = size
+        self.bytes_written = 0
+        self.bytes_erased = 0
+        self.bytes_checked = 0
+        self.blocks = []
+        self.verified = False
+
+
+class FactoryResult(Result):
+    """Result of an operation with factory settings. `settings` is dict of written or read
+    settings, None if the factory settings sector is empty or corrupted.
+    """
+
+    def __init__(self, operation, settings=None):
+        super().__init__(operation)
+        self.settings = settings
+
+
+class UMSResult(Result):
+    """Result of writing an image via USB Mass Storage: block `device` of the board and
+    `bytes_written`.
+    """
+
+    def __init__(self, operation):
+        super().__init__(operation)
+        self.device = None
+        self.bytes_written = 0
+
+
+def _block_devices():
+    out = subprocess.check_output(
+        ['lsblk', '-o', 'name', '--list', '--nodeps'], universal_newlines=True
+    )
+    return out.split()[1:]
+
+
+class FlashSession(object):
+    """Flashing operations on one connection to BootROM or U-Boot terminal of the board.
+
+    Parameters
+    ----------
+    uart : UART
+        open console (e.g. UART or SyncUART) with options of uart_options(`mode`), the
+        console is not closed by the session
+    mode : str
+        BOOTROM or UBOOT: terminal the board is running
+    progress : callable
+        handler of progress messages (e.g. print), the messages are dropped if None
+    """
+
+    def __init__(self, uart, mode=BOOTROM, progress=None):
+        uart_options(mode)
+        self.uart = uart
+        self.mode = mode
+        self.progress = progress
+        self.connected = False
+        # BootROM terminal is replaced by flasher stub until the board is reset
+        self._stub_loaded = False
+        self._owned = False
+
+    @classmethod
+    def open(cls, port, mode=BOOTROM, window=1, async_uart=False, progress=None, **kwargs):
+        """Open serial `port` (name or serial.Serial) and return session which closes the
+        port. `kwargs` are passed to UART (e.g. verbose, retcode_mode). `window` greater
+        than 1 enables pipelining of commands (see UART.run_batch()). Raise PortError if
+        the port can not be opened.
+        """
+        uart_class = UART
+        if async_uart:
+            from mcom02_flash_tools.aio import SyncUART
+
+            uart_class = SyncUART
+        options = dict(uart_options(mode), window=window)
+        options.update(kwargs)
+        try:
+            uart = uart_class(port=port, **options)
+        except SerialException as e:
+            raise PortError("Failed to open device '{}': {}".format(port, e))
+        session = cls(uart, mode, progress)
+        session._owned = True
+        return session
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Restore the original UART baudrate, close the port opened by open(). Failure of
+        restoring the baudrate (e.g. the link is lost) is reported as a warning, so close()
+        does not replace the error of the operation.
+        """
+        try:
+            self.uart.restore_baudrate()
+        except (FlashToolsError, SerialException, OSError) as e:
+            with self._operation():
+                progress('Warning: {}'.format(e))
+        finally:
+            if self._owned:
+                self.uart.close()
+
+    @contextmanager
+    def _operation(self):
+        # Progress messages of the operation are passed to the handler of the session
+        with progress_handler(self.progress):
+            yield
+
+    def connect(self, timeout=None):
+        """Wait for the terminal, U-Boot autoboot is interrupted. Operations connect to the
+        terminal if it is not connected. Raise CommandError if the terminal does not respond
+        in `timeout` seconds (None - default timeout of BootROM command, infinite for U-Boot).
+        """
+        if self.connected:
+            return
+        with self._operation():
+            if self.mode == BOOTROM:
+                options = {} if timeout is None else {'timeout': timeout}
+                if self.uart.run('', **options) is None:
+                    raise CommandError(
+                        "Terminal does not respond. Set the boot mode to UART "
+                        "and reset the board power (do not use warm reset)"
+                    )
+                # Disable DDR retention to avoid large current on DDRx_VDDQ (see rf#1160).
+                send_cmds(self.uart, ["set 38095024 0", "autorun 0"])
+            elif not self.uart.wait_for_uboot(timeout=timeout):
+                raise CommandError(
+                    'U-Boot terminal does not respond. Set the boot mode to SPI '
+                    'and reset the board power (do not use warm reset).'
+                )
+        self.connected = True
+
+    def set_baudrate(self, max_baudrate):
+        """Negotiate the fastest reliable UART baudrate up to `max_baudrate` with U-Boot,
+        the original one is restored by close(). Return the baudrate.
+        """
+        self._require(UBOOT, 'baudrate negotiation')
+        self.connect()
+        if max_baudrate <= self.uart.tty.baudrate:
+            return self.uart.tty.baudrate
+        with self._operation():
+            baudrate = self.uart.negotiate_baudrate(self.uart.set_uboot_baudrate, max_baudrate)
+            progress('UART baudrate: {}'.format(baudrate))
+        return baudrate
+
+    def _require(self, mode, operation):
+        if self.mode != mode:
+            raise ValueError('{} is supported only in {} mode'.format(operation, mode))
+        if self._stub_loaded:
+            raise CommandError(
+                'BootROM terminal is replaced by flasher stub, reset the board power'
+            )
+
+    def flash_spi(
+        self,
+        file_name=None,
+        manifest=None,
+        count=None,
+        sparse=False,
+        stub=None,
+        cache=None,
+        verify_each=False,
+        retries=3,
+        resume=False,
+        autotune=False,
+        board='default',
+        profile=None,
+        spi=(0, 0),
+    ):
+        """Write a binary file to SPI flash memory and check it. Return FlashResult, raise
+        VerificationError if the data read back differs from the file.
+
+        Parameters
+        ----------
+        file_name : str
+            binary file written from zero offset
+        manifest : Manifest
+            regions written instead of `file_name`
+        count : int
+            count of bytes to check, all the data by default (ignored with `verify_each`)
+        sparse : bool
+            erase sectors filled with erased value instead of writing
+        stub : str or IntelHex
+            flasher stub (see FlasherStub), the board must be reset after flashing
+        cache : BlockCache
+            cache of Intel-HEX blocks of the file
+        verify_each : bool
+            read back every block after writing, write corrupted blocks again up to
+            `retries` times
+        resume : bool
+            continue interrupted writing of the file (see Journal)
+        autotune : bool
+            measure throughput of block sizes and save the fastest ones to `profile`
+        board : str
+            board model of block sizes in `profile`
+        profile : Profile
+            block sizes of BootROM mode, default sizes are used if None
+        spi : tuple
+            SPI bus and chip select of flash memory in U-Boot mode
+        """
+        if self.mode == UBOOT:
+            options = {
+                'manifest': manifest,
+                'sparse': sparse,
+                'stub': stub,
+                'cache': cache,
+                'verify_each': verify_each,
+                'resume': resume,
+                'autotune': autotune,
+            }
+            for name, value in options.items():
+                if value:
+                    raise ValueError('{} is not supported in U-Boot mode'.format(name))
+            return self._uboot_operation(self._flash_uboot, 'flash_spi', file_name, count, spi)
+
+        self._require(BOOTROM, 'flash_spi')
+        if autotune and profile is None:
+            raise ValueError('autotune requires profile')
+        if stub is not None and isinstance(stub, str):
+            stub = FlasherStub.read_ihex(stub)
+        self.connect()
+        with self._operation(), load_image(file_name, manifest) as source:
+            result = FlashResult('flash_spi', len(source[0]))
+            if stub is not None:
+                self._flash_stub(result, stub, source[0], count, sparse)
+            else:
+                self._flash_bootrom(
+                    result,
+                    source,
+                    manifest,
+                    count,
+                    sparse,
+                    cache,
+                    verify_each,
+                    retries,
+                    resume,
+                    autotune,
+                    board,
+                    profile,
+                )
+        return self._checked(result)
+
+    def verify_spi(
+        self,
+        file_name=None,
+        manifest=None,
+        count=None,
+        sparse=False,
+        board='default',
+        profile=None,
+        spi=(0, 0),
+    ):
+        """Check that SPI flash memory contains a binary file without writing. Parameters
+        are the same as for flash_spi(). Return FlashResult, raise VerificationError if the
+        data differs from the file.
+        """
+        if self.mode == UBOOT:
+            if manifest is not None or sparse:
+                raise ValueError('manifest and sparse are not supported in U-Boot mode')
+            return self._uboot_operation(self._verify_uboot, 'verify_spi', file_name, count, spi)
+
+        self._require(BOOTROM, 'verify_spi')
+        self.connect()
+        with self._operation(), load_image(file_name, manifest) as (image, regions, fills):
+            result = FlashResult('verify_spi', len(image))
+            send_cmd(self.uart, "cache 1")
+            chip, ranges, _ = self._layout(result, image, regions, fills, manifest, sparse)
+            _, check_size = self._block_sizes(profile, board)
+            self._check(result, image, count, ranges, check_size)
+            send_cmd(self.uart, "cache 0")
+        return self._checked(result)
+
+    def _checked(self, result):
+        result.finish()
+        if not result.verified:
+            raise VerificationError('Checking failed', result)
+        return result
+
+    @staticmethod
+    def _block_sizes(profile, board):
+        if profile is None:
+            return UPLOAD_BLOCK_SIZE, CHECK_BLOCK_SIZE
+        return profile_block_sizes(profile, board)
+
+    def _layout(self, result, image, regions, fills, manifest, sparse):
+        # Return flash memory, ranges to write and offsets of sectors to erase
+        chip = probe_flash(read_jedec_id(self.uart), len(image))
+        result.chip = str(chip)
+        if manifest is not None and chip.sector_size != SECTOR_SIZE:
+            try:
+                manifest.validate(chip.sector_size)
+            except ValueError as e:
+                raise FlashMemoryError(e)
+        ranges, skipped = image_layout(image, regions, fills, sparse, chip)
+        return chip, ranges, skipped
+
+    def _check(self, result, image, count, ranges, check_size, tuner=None):
+        progress("Checking...")
+        with result.phase('check'):
+            result.verified = check_file(self.uart, image, count, ranges, check_size, tuner)
+        checked = len(image[:count])
+        result.bytes_checked = sum(size for _, size in clip_ranges(ranges, checked))
+
+    def _flash_stub(self, result, stub_ihex, data, count, sparse):
+        progress("Starting flasher stub...")
+        flasher = FlasherStub(self.uart)
+        self._stub_loaded = True
+        try:
+            with result.phase('stub'):
+                flasher.load(stub_ihex)
+            chip = probe_flash(flasher.jedec_id, len(data))
+            result.chip = str(chip)
+            if chip.unlock == UNLOCK_GLOBAL:
+                flasher.unlock()
+                progress("Software write protect is disabled")
+
+            progress("Writing to flash...")
+            with result.phase('write'):
+                skipped = flasher.write_file(data, sparse)
+            result.bytes_written = len(data) - skipped
+            result.bytes_erased = skipped
+
+            progress("Checking...")
+            checked = data[:count]
+            with result.phase('check'):
+                result.verified = flasher.check_file(checked)
+            result.bytes_checked = len(checked)
+        except CommandError as e:
+            raise CommandError(
+                "{}\nReset the board power and run without --stub option to flash "
+                "by BootROM".format(e)
+            )
+        if sparse:
+            progress(
+                "Skipped {} bytes: blocks filled with 0xFF are erased and not written".format(
+                    skipped
+                )
+            )
+
+    def _flash_bootrom(
+        self,
+        result,
+        source,
+        manifest,
+        count,
+        sparse,
+        cache,
+        verify_each,
+        retries,
+        resume,
+        autotune,
+        board,
+        profile,
+    ):
+        image, regions, fills = source
+        send_cmd(self.uart, "cache 1")
+        chip, ranges, skipped = self._layout(result, image, regions, fills, manifest, sparse)
+        upload_size, check_size = self._block_sizes(profile, board)
+
+        # Blocks do not cross sector boundaries
+        boundary = chip.sector_size
+        cached = None
+        if cache is not None:
+            with result.phase('prepare'):
+                cached = prepare_cache(
+                    cache, image, NEWLINE.encode(), ranges, upload_size, boundary
+                )
+
+        unlock_write_protect(self.uart, chip)
+
+        tuners = {}
+        journal = None
+        start = 0
+        if autotune:
+            tuners = {
+                'upload': Autotuner(UPLOAD_BLOCK_SIZES, boundary),
+                'check': Autotuner(CHECK_BLOCK_SIZES),
+            }
+        else:
+            # Block sizes of autotuning are not stored, so the run is not journaled
+            blocks = list(split_ranges(ranges, upload_size, boundary))
+            params = {
+                'block_size': upload_size,
+                'boundary': boundary,
+                'ranges': [list(x) for x in ranges],
+                'verify': verify_each,
+            }
+            port = self.uart.tty.port
+            path = journal_path(default_journal_dir(), image, port, board, chip.jedec_id)
+            journal = Journal(path, params, len(blocks))
+            if resume:
+                with result.phase('resume'):
+                    start = resume_point(
+                        self.uart, image, journal, blocks, check_size, verify_all=verify_each
+                    )
+            else:
+                journal.reset()
+
+        if skipped and not (journal is not None and journal.erased):
+            progress("Erasing {} sectors filled with 0x{:02X}...".format(len(skipped), chip.erased))
+            with result.phase('erase'):
+                erase_sectors(self.uart, skipped)
+            if journal is not None:
+                journal.set_erased()
+        result.bytes_erased = len(skipped) * chip.sector_size
+
+        if verify_each:
+            progress("Writing to flash with checking of every block...")
+            with result.phase('write'):
+                result.blocks = write_bin_to_flash(
+                    self.uart,
+                    image,
+                    ranges,
+                    upload_size,
+                    cached,
+                    tuners.get('upload'),
+                    verify_size=check_size,
+                    retries=retries,
+                    journal=journal,
+                    start=start,
+                    boundary=boundary,
+                )
+            result.verified = all(x['verified'] for x in result.blocks)
+            result.bytes_checked = sum(x['size'] for x in result.blocks if x['verified'])
+            if journal is not None and result.verified:
+                journal.remove()
+        else:
+            progress("Writing to flash...")
+            with result.phase('write'):
+                result.blocks = write_bin_to_flash(
+                    self.uart,
+                    image,
+                    ranges,
+                    upload_size,
+                    cached,
+                    tuners.get('upload'),
+                    journal=journal,
+                    start=start,
+                    boundary=boundary,
+                )
+            if journal is not None:
+                # all blocks are written, the check below reads the whole file
+                journal.remove()
+            self._check(result, image, count, ranges, check_size, tuners.get('check'))
+        result.bytes_written = sum(x['size'] for x in result.blocks if x['attempts'])
+
+        send_cmd(self.uart, "cache 0")
+        if sparse or skipped:
+            progress(
+                "Skipped {} bytes: sectors filled with 0x{:02X} are erased, not written "
+                "and not checked".format(len(skipped) * chip.sector_size, chip.erased)
+            )
+        if tuners and result.verified:
+            save_profile(profile, board, tuners)
+
+    def _uboot_operation(self, func, operation, file_name, count, spi):
+        self._require(UBOOT, operation)
+        self.connect()
+        with self._operation(), map_file(file_name) as data:
+            result = FlashResult(operation, len(data))
+            func(result, data, os.path.basename(file_name), count, spi)
+        return self._checked(result)
+
+    def _loadaddr(self):
+        _, resp = self.uart.run_with_retcode('env print loadaddr')
+        return int(resp.split('=', 1)[1], 16)
+
+    def _flash_uboot(self, result, data, file_name, count, spi):
+        # The file is sent to RAM with YMODEM, written with "sf update" (sectors with the
+        # same data are not erased and written) and checked by CRC32 of the data read back
+        console = self.uart
+        loadaddr = self._loadaddr()
+
+        progress("Sending file...")
+        with result.phase('send'):
+            console.tty.write('loady {:#x}{}'.format(loadaddr, console.newline).encode())
+            if not console.wait_for_string('bps...', timeout=5)[0]:
+                raise CommandError('U-Boot does not support YMODEM download (loady command)')
+            console.send_ymodem(data, file_name)
+            success, resp = console.wait_for_string(console.prompt, timeout=10)
+            if not success or 'Total Size' not in resp:
+                raise CommandError('File sending error\nTarget answer:\n{}'.format(resp))
+
+        spi_probe(console, spi)
+        spi_unlock(console, 0, '{:#x}'.format(len(data)))
+        progress("Writing to flash...")
+        # SPI flash is erased with 200 KB/s at least
+        timeout = 10 + len(data) / 100e3
+        with result.phase('write'):
+            _, resp = console.run_with_retcode(
+                'sf update {:#x} 0 {:#x}'.format(loadaddr, len(data)),
+                timeout=timeout,
+                errmsg='Flashing error. Please check write protection jumper.',
+            )
+        progress(resp.strip())
+        result.bytes_written = len(data)
+
+        # Data is read back after the file in RAM so the file is not compared with itself
+        self._check_uboot(result, data, count, loadaddr + (len(data) + 0xFFFF & ~0xFFFF))
+
+    def _verify_uboot(self, result, data, file_name, count, spi):
+        loadaddr = self._loadaddr()
+        spi_probe(self.uart, spi)
+        self._check_uboot(result, data, count, loadaddr)
+
+    def _check_uboot(self, result, data, count, addr):
+        size = len(data) if count is None else min(count, len(data))
+        result.verified = True
+        if size == 0:
+            return
+        progress("Checking...")
+        with result.phase('check'):
+            self.uart.run_with_retcode(
+                'sf read {:#x} 0 {:#x}'.format(addr, size),
+                timeout=10 + size / 100e3,
+                errmsg='Read from SPI Flash error',
+            )
+            _, resp = self.uart.run_with_retcode('crc32 {:#x} {:#x}'.format(addr, size))
+        result.verified = int(resp.split('==>')[1], 16) == zlib.crc32(data[:size])
+        result.bytes_checked = size
+
+    def factory_flash(self, settings, spi=(0, 0), lock=True):
+        """Write factory settings (dict of U-Boot variables) to SPI flash memory and enable
+        write protection of the settings if `lock` is True. Return FactoryResult.
+        """
+        self._require(UBOOT, 'factory_flash')
+        self.connect()
+        console = self.uart
+        result = FactoryResult('factory_flash', dict(settings))
+        with self._operation():
+            console.run_batch_with_retcode(
+                ['setenv {} {}'.format(key, value) for key, value in settings.items()]
+            )
+            console.run_with_retcode(
+                'env export -c -s ${{factorysize}} ${{loadaddr}} {}'.format(' '.join(settings))
+            )
+            spi_probe(console, spi)
+            spi_unlock(console)
+            with result.phase('write'):
+                console.run_with_retcode(
+                    'sf update ${loadaddr} ${factoryoffset} ${factorysize}',
+                    errmsg='Flashing error. Please check write protection jumper.',
+                )
+            if lock:
+                spi_lock(console)
+        return result.finish()
+
+    def factory_clear(self, spi=(0, 0), lock=True):
+        """Erase factory settings, enable write protection of the settings if `lock` is
+        True. Return FactoryResult.
+        """
+        self._require(UBOOT, 'factory_clear')
+        self.connect()
+        console = self.uart
+        result = FactoryResult('factory_clear')
+        with self._operation():
+            spi_probe(console, spi)
+            spi_unlock(console)
+            with result.phase('erase'):
+                console.run_with_retcode(
+                    'sf erase ${factoryoffset} ${factorysize}',
+                    errmsg='Factory settings clear error. Please check write protection ' 'jumper.',
+                )
+            if lock:
+                spi_lock(console)
+        return result.finish()
+
+    def factory_read(self, spi=(0, 0)):
+        """Read factory settings. Return FactoryResult with `settings` None if the settings
+        sector is empty or corrupted.
+        """
+        self._require(UBOOT, 'factory_read')
+        self.connect()
+        console = self.uart
+        result = FactoryResult('factory_read')
+
+        def get_var_int(name):
+            _, resp = console.run_with_retcode('env print {}'.format(name))
+            _, value = resp.split('=', 1)
+            return int(value, 16)
+
+        with self._operation():
+            # backup original environment
+            loadaddr = get_var_int('loadaddr')
+            factorysize = get_var_int('factorysize')
+
+            # env_backup_size must be equal to CONFIG_ENV_SIZE but this value is unavailable
+            # from U-Boot command line. Using factorysize because factorysize equal to sector
+            # size.
+            env_backup_size = factorysize
+            env_backup_addr = loadaddr + factorysize
+
+            # BUG: env export command will create incorrect buffer if used
+            # CONFIG_SYS_REDUNDAND_ENVIRONMENT
+            console.run_with_retcode(
+                'env export -c -s {:#x} {:#x}'.format(env_backup_size, env_backup_addr)
+            )
+            spi_probe(console, spi)
+            with result.phase('read'):
+                console.run_with_retcode(
+                    'sf read ${loadaddr} ${factoryoffset} ${factorysize}',
+                    errmsg='Read from SPI Flash error',
+                )
+            retcode, _ = console.run_with_retcode(
+                'env import -d -c ${loadaddr} ${factorysize}', check=False
+            )
+            if retcode:
+                return result.finish()
+
+            _, resp = console.run_with_retcode('env print')
+
+            # restore original environment
+            console.run_with_retcode(
+                'env import -d -c {:#x} {:#x}'.format(env_backup_addr, env_backup_size)
+            )
+        result.settings = dict(x.split('=', 1) for x in resp.split('\n\n')[0].split('\n'))
+        return result.finish()
+
+    def ums_write(self, file_name, mmcdev=0, status=False):
+        """Write a binary image to MMC device `mmcdev` of the board exported by U-Boot as
+        USB Mass Storage. The image is written with dd, `status` shows progress of dd.
+        Return UMSResult, raise UMSError if the device of the board is not found or is not
+        written.
+        """
+        self._require(UBOOT, 'ums_write')
+        self.connect()
+        tty = self.uart
+        result = UMSResult('ums_write')
+        with self._operation():
+            tty.run('')  # hitting key to stop autoboot
+            uboot_version = tty.get_uboot_version()
+            if uboot_version is None:
+                raise CommandError('No U-Boot terminal found.')
+            progress('Found U-Boot: {}'.format(uboot_version))
+
+            progress('Board model: {}'.format(tty.get_uboot_board_model(timeout=UMS_TIMEOUT)))
+            progress('Enabling USB Mass storage on target...')
+            with result.phase('enable'):
+                block_devices = _block_devices()
+                tty.tty.write('ums 0 mmc {}\n'.format(mmcdev).encode())
+                time.sleep(UMS_DEVICE_DELAY)
+
+                ok, resp = tty.wait_for_string(
+                    [
+                        'UMS: LUN 0, dev {}'.format(mmcdev),  # for U-Boot < 2021.04
+                        'UMS: LUN 0, dev mmc {}'.format(mmcdev),  # for U-Boot >= 2021.04
+                    ],
+                    timeout=UMS_TIMEOUT,
+                )
+                if not ok:
+                    raise UMSError(
+                        'Failed to enable UMS for MMC {}. U-Boot response {}.'.format(mmcdev, resp)
+                    )
+
+                usb_devices = set(_block_devices()) - set(block_devices)
+                if len(usb_devices) == 0:
+                    raise UMSError('No USB device connections from board.')
+                if len(usb_devices) > 1:
+                    raise UMSError('Too many USB device connections.')
+
+            result.device = '/dev/{}'.format(usb_devices.pop())
+            progress('Writing image {} to {}...'.format(file_name, result.device))
+            cmd = [
+                'dd',
+                'if={}'.format(file_name),
+                'of={}'.format(result.device),
+                'bs=4M',
+                'oflag=direct',
+            ]
+            if status:
+                cmd.append('status=progress')
+            size = os.path.getsize(file_name)
+            with result.phase('write'), span('dd', 'usb', tx=size):
+                process = subprocess.Popen(cmd, stdout=sys.stdout, stderr=sys.stderr)
+                try:
+                    errcode = process.wait()
+                finally:  # terminate child process in case KeyboardInterrupt (Ctrl+C), etc
+                    if process.poll() is None:
+                        progress('Terminating child process...')
+                        process.terminate()
+                        process.kill()
+            if errcode:
+                raise UMSError('Failed to write image to USB device')
+            result.bytes_written = size
+
+            tty.run('\x03', timeout=UMS_TIMEOUT)  # send Ctrl-C to stop UMS
+        return result.finish()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+#
+
+"""End-to-end benchmark of flashing tools against the emulated BootROM and U-Boot."""
+
+import argparse
+import json
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+from intelhex import IntelHex
+
+from mcom02_flash_tools import __version__, eprint, microbench, stub
+from mcom02_flash_tools.emulator import BootROMEmulator, SPIFlashModel, UBootEmulator
+
+
+def run_tool(module, args, quiet=True):
+    """Run flashing tool from `module` with arguments `args`. Return exit code and wall time."""
+    cmd = [sys.executable, '-m', 'mcom02_flash_tools.{}'.format(module)] + list(args)
+    stdout = subprocess.DEVNULL if quiet else None
+    start = time.monotonic()
+    retcode = subprocess.call(cmd, stdout=stdout)
+    return retcode, time.monotonic() - start
+
+
+def make_stub_placeholder(file_name, size=2048):
+    """Write Intel-HEX file which is accepted by mcom02-flash-spi --stub. The emulated BootROM
+    does not execute it but emulates the flasher stub protocol.
+    """
+    ihex = IntelHex()
+    ihex.frombytes(bytes(size), stub.STUB_ADDR)
+    ihex.start_addr = {'EIP': stub.STUB_ADDR}
+    ihex.write_hex_file(file_name)
+
+
+def make_result(emulator, retcode, wall_time, **kwargs):
+    result = {
+        'baudrate': emulator.baudrate,
+        'retcode': retcode,
+        'wall_time': wall_time,
+        'phases': {x: emulator.phase_stats(x).as_dict() for x in emulator.phases()},
+    }
+    result.update(kwargs)
+    return result
+
+
+def benchmark(
+    file_name,
+    baudrate=115200,
+    jedec_id=0x20BA18,
+    extra_args=(),
+    quiet=True,
+    link_latency=0.0,
+    uboot=False,
+    flash=None,
+    stub_file=None,
+):
+    """Flash `file_name` with mcom02-flash-spi to emulated board (BootROM or U-Boot if `uboot`
+    is True). If `stub_file` is specified then it is used as flasher stub (see
+    make_stub_placeholder()). Return dict with results.
+    """
+    with open(file_name, 'rb') as f:
+        image = f.read()
+
+    if flash is None:
+        flash = SPIFlashModel(jedec_id=jedec_id, protected=False if uboot else None)
+    if uboot:
+        emulator = UBootEmulator(
+            baudrate=baudrate, prompt='mcom# ', flash=flash, link_latency=link_latency
+        )
+        extra_args = ['--uboot', '-t', '10'] + list(extra_args)
+    else:
+        emulator = BootROMEmulator(baudrate=baudrate, flash=flash, link_latency=link_latency)
+        if stub_file is not None:
+            extra_args = ['--stub', stub_file] + list(extra_args)
+    with emulator:
+        args = ['-p', emulator.port] + list(extra_args) + [file_name]
+        retcode, wall_time = run_tool('mcom02_flash_spi', args, quiet)
+
+    flashed = bytes(emulator.flash.data[: len(image)]) == image
+    return make_result(emulator, retcode, wall_time, image_size=len(image), flashed=flashed)
+
+
+def benchmark_factory(
+    command_args, baudrate=115200, latency=None, quiet=True, emulator=None, link_latency=0.0
+):
+    """Run mcom02-flash-factory with `command_args` (e.g. ['print']) on emulated U-Boot.
+    Return dict with results.
+    """
+    if emulator is None:
+        emulator = UBootEmulator(
+            baudrate=baudrate, prompt='mcom# ', latency=latency, link_latency=link_latency
+        )
+    with emulator:
+        args = ['-p', emulator.port, '-t', '10'] + list(command_args)
+        retcode, wall_time = run_tool('mcom02_flash_factory', args, quiet)
+
+    return make_result(emulator, retcode, wall_time, command=' '.join(command_args))
+
+
+def benchmark_ums(
+    file_name, baudrate=115200, latency=None, quiet=True, link_latency=0.0, extra_args=()
+):
+    """Write `file_name` with mcom02-flash-ums-mmc to emulated board. Requires losetup.
+    Return dict with results.
+    """
+    with open(file_name, 'rb') as f:
+        image = f.read()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mmc_image = os.path.join(tmpdir, 'mmc0.img')
+        with open(mmc_image, 'wb') as f:
+            # MMC size is multiple of 1 MiB and is larger than image
+            f.truncate((len(image) // 0x100000 + 1) * 0x100000)
+        emulator = UBootEmulator(
+            baudrate=baudrate,
+            prompt='mcom# ',
+            latency=latency,
+            mmc_images={0: mmc_image},
+            link_latency=link_latency,
+        )
+        with emulator:
+            args = list(extra_args) + [emulator.port, file_name]
+            retcode, wall_time = run_tool('mcom02_flash_ums_mmc', args, quiet)
+        with open(mmc_image, 'rb') as f:
+            flashed = f.read(len(image)) == image
+
+    return make_result(emulator, retcode, wall_time, image_size=len(image), flashed=flashed)
+
+
+def print_report(result):
+    print(
+        'Baudrate: {}, exit code: {}, wall time: {:.3f} s'.format(
+            result['baudrate'], result['retcode'], result['wall_time']
+        )
+    )
+    if 'flashed' in result:
+        print(
+            'Image: {} bytes, flash content: {}'.format(
+                result['image_size'], 'OK' if result['flashed'] else 'MISMATCH'
+            )
+        )
+    row = '{:<10} {:>10} {:>10} {:>14} {:>14} {:>10}'
+    print(row.format('Phase', 'Time, s', 'Busy, s', 'Host->target', 'Target->host', 'Commands'))
+    phases = list(result['phases'].items())
+    for name, stats in phases + [('total', None)]:
+        if stats is None:
+            stats = {
+                key: sum(x[key] for _, x in phases)
+                for key in ('busy', 'rx_bytes', 'tx_bytes', 'commands')
+            }
+            stats['duration'] = result['wall_time']
+        print(
+            row.format(
+                name,
+                '{:.3f}'.format(stats['duration']),
+                '{:.3f}'.format(stats['busy']),
+                stats['rx_bytes'],
+                stats['tx_bytes'],
+                stats['commands'],
+            )
+        )
+
+
+def run_host(args):
+    """Run microbenchmarks of mcom02-flash-bench host with parsed arguments `args`."""
+    baseline = None
+    if args.baseline:
+        try:
+            baseline = microbench.load_baseline(args.baseline)
+        except (OSError, ValueError) as e:
+            eprint('Failed to read baseline {}: {}'.format(args.baseline, e))
+            sys.exit(1)
+
+    print(microbench.format_header())
+    results = microbench.run_suite(
+        args.sizes,
+        args.cases,
+        args.repeat,
+        report=lambda key, result: print(microbench.format_result(key, result), flush=True),
+    )
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.save_baseline:
+        microbench.save_baseline(args.save_baseline, results)
+
+    if baseline is not None:
+        regressions = microbench.compare(
+            results, baseline, args.max_slowdown, args.max_memory_growth
+        )
+        for regression in regressions:
+            eprint('Regression: {}'.format(regression))
+        if regressions:
+            sys.exit(1)
+        print('No regressions relative to {}'.format(args.baseline))
+
+
+def main():
+    description = (
+        'Benchmark flashing tools without a board: the tools work with the emulated MCom-02 '
+        'BootROM or U-Boot and the script reports wall time, bytes transferred and count of '
+        'commands (round trips) per phase.'
+    )
+    parser = argparse.ArgumentParser(
+        description=description, formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '-b', '--baudrate', type=int, default=115200, help='emulated UART speed, 0 - unlimited'
+    )
+    parser.add_argument(
+        '-l',
+        '--link-latency',
+        type=float,
+        default=0.002,
+        help='round trip latency of the link (USB-UART adapter), s',
+    )
+    parser.add_argument('--json', dest='json_file', help='save results to JSON file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show output of the tool')
+    parser.add_argument(
+        '--tool-args', default='', help='additional arguments for the tool (quoted)'
+    )
+    parser.add_argument('--version', action='version', version=__version__)
+    subparsers = parser.add_subparsers(dest='tool', required=True, help='benchmarked tool')
+
+    parser_spi = subparsers.add_parser(
+        'spi', help='mcom02-flash-spi', formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser_spi.add_argument(
+        'file_name', nargs='?', help='binary file for programming, random data if not specified'
+    )
+    parser_spi.add_argument('-s', '--size', type=int, default=300 * 1024, help='random image size')
+    parser_spi.add_argument(
+        '--padding', type=int, default=0, help='count of 0xFF bytes appended to random image'
+    )
+    parser_spi.add_argument(
+        '--jedec-id', type=lambda x: int(x, 16), default='20ba18', help='SPI flash JEDEC ID'
+    )
+    parser_spi.add_argument(
+        '--uboot', action='store_true', help='flash via emulated U-Boot instead of BootROM'
+    )
+    parser_spi.add_argument(
+        '--stub', action='store_true', help='flash with emulated flasher stub loaded by BootROM'
+    )
+
+    parser_factory = subparsers.add_parser(
+        'factory',
+        help='mcom02-flash-factory',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser_factory.add_argument(
+        'command_args', nargs='+', help='command and its arguments, e.g. "print"'
+    )
+    parser_factory.add_argument(
+        '--latency', type=float, default=0.0005, help='U-Boot command execution time, s'
+    )
+
+    parser_ums = subparsers.add_parser(
+        'ums',
+        help='mcom02-flash-ums-mmc (requires losetup)',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser_ums.add_argument(
+        'file_name', nargs='?', help='image for writing, random data if not specified'
+    )
+    parser_ums.add_argument('-s', '--size', type=int, default=1024 * 1024, help='random image size')
+    parser_ums.add_argument(
+        '--latency', type=float, default=0.0005, help='U-Boot command execution time, s'
+    )
+
+    parser_host = subparsers.add_parser(
+        'host',
+        help='microbenchmarks of host-side parsing and encoding (emulator is not used)',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser_host.add_argument(
+        '--sizes',
+        type=lambda x: [microbench.parse_size(y) for y in x.split(',')],
+        default='64K,1M,32M',
+        help='comma-separated image sizes (suffixes K and M)',
+    )
+    parser_host.add_argument(
+        '--cases', nargs='+', choices=list(microbench.CASES), help='cases to run, all by default'
+    )
+    parser_host.add_argument(
+        '--repeat',
+        type=int,
+        default=1,
+        help='minimum runs of every case (short cases are repeated for {} s), the best one is '
+        'reported'.format(microbench.MIN_TIME),
+    )
+    parser_host.add_argument(
+        '--baseline', help='JSON file with baseline results, regressions fail the benchmark'
+    )
+    parser_host.add_argument('--save-baseline', help='save results as baseline JSON file')
+    parser_host.add_argument(
+        '--max-slowdown',
+        type=float,
+        default=microbench.MAX_SLOWDOWN,
+        help='allowed relative decrease of throughput',
+    )
+    parser_host.add_argument(
+        '--max-memory-growth',
+        type=float,
+        default=microbench.MAX_MEMORY_GROWTH,
+        help='allowed relative increase of peak memory',
+    )
+    args = parser.parse_args()
+
+    if args.tool == 'host':
+        run_host(args)
+        return
+
+    tool_args = shlex.split(args.tool_args)
+    quiet = not args.verbose
+    with tempfile.TemporaryDirectory() as tmpdir:
+        file_name = getattr(args, 'file_name', None)
+        if file_name is None and args.tool in ('spi', 'ums'):
+            file_name = os.path.join(tmpdir, 'image.bin')
+            with open(file_name, 'wb') as f:
+                f.write(os.urandom(args.size))
+                f.write(b'\xff' * getattr(args, 'padding', 0))
+
+        if args.tool == 'spi':
+            stub_file = None
+            if args.stub:
+                stub_file = os.path.join(tmpdir, 'stub.hex')
+                make_stub_placeholder(stub_file)
+            result = benchmark(
+                file_name,
+                args.baudrate,
+                args.jedec_id,
+                tool_args,
+                quiet,
+                link_latency=args.link_latency,
+                uboot=args.uboot,
+                stub_file=stub_file,
+            )
+        elif args.tool == 'factory':
+            result = benchmark_factory(
+                tool_args + args.command_args,
+                args.baudrate,
+                {'default': args.latency},
+                quiet,
+                link_latency=args.link_latency,
+            )
+        else:
+            result = benchmark_ums(
+                file_name,
+                args.baudrate,
+                {'default': args.latency},
+                quiet,
+                link_latency=args.link_latency,
+                extra_args=tool_args,
+            )
+
+    print_report(result)
+    if args.json_file:
+        with open(args.json_file, 'w') as f:
+            json.dump(result, f, indent=4)
+
+    if result['retcode'] or not result.get('flashed', True):
+        eprint('Benchmarked tool failed')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
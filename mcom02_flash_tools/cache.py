@@ -0,0 +1,150 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+
+"""On-disk cache of data prepared from image file before flashing.
+
+Cache entry is a directory named by the key (see BlockCache.key()). The entry contains
+streams: every stream is a file with concatenated chunks (e.g. encoded Intel-HEX blocks) and
+lengths of the chunks are stored in the index file. Entries are written to temporary
+directory and renamed, so concurrent runs never see partially written entries.
+
+Modification time of the index file is updated on every use. If total size of the cache
+exceeds the limit then least recently used entries are removed.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from mcom02_flash_tools.ihex import map_file
+
+CACHE_VERSION = 1
+INDEX_FILE = 'index.json'
+
+
+def default_cache_dir():
+    """Cache directory according to XDG Base Directory Specification."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'mcom02-flash-tools')
+
+
+class CacheEntry(object):
+    """Streams of cache entry."""
+
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+
+    def chunk_lengths(self, name):
+        return self.index['streams'][name]
+
+    def chunks(self, name):
+        """Yield chunks of stream `name` as memoryview slices of memory-mapped stream file."""
+        with map_file(os.path.join(self.path, name)) as data:
+            offset = 0
+            for length in self.chunk_lengths(name):
+                yield data[offset : offset + length]
+                offset += length
+
+
+class BlockCache(object):
+    """Size-bounded LRU cache of prepared data."""
+
+    def __init__(self, directory, max_size=1024 * 1024 * 1024):
+        """Parameters
+        ----------
+        directory : str
+            cache directory, created if does not exist
+        max_size : int
+            maximum total size of entries in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def key(data, *params):
+        """Key of entry for `data` (bytes-like object) prepared with `params`."""
+        digest = hashlib.sha256(data).hexdigest()
+        return '-'.join([digest] + [str(x) for x in params])
+
+    def get(self, key):
+        """Return CacheEntry or None if the cache does not contain valid entry for `key`."""
+        path = os.path.join(self.directory, key)
+        index_path = os.path.join(path, INDEX_FILE)
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+            if index.get('version') != CACHE_VERSION:
+                return None
+            for name, lengths in index['streams'].items():
+                if os.path.getsize(os.path.join(path, name)) != sum(lengths):
+                    return None
+            os.utime(index_path)
+        except (OSError, ValueError, KeyError, AttributeError):
+            return None
+        return CacheEntry(path, index)
+
+    def put(self, key, streams):
+        """Write entry for `key` and return CacheEntry.
+
+        Parameters
+        ----------
+        key : str
+            entry key
+        streams : dict
+            stream name to iterable of chunks (bytes-like objects), a chunk must not be used
+            by the iterable after the next chunk is requested
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            index = {'version': CACHE_VERSION, 'streams': {}}
+            for name, chunks in streams.items():
+                lengths = index['streams'][name] = []
+                with open(os.path.join(tmp, name), 'wb') as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                        lengths.append(len(chunk))
+            with open(os.path.join(tmp, INDEX_FILE), 'w') as f:
+                json.dump(index, f)
+            path = os.path.join(self.directory, key)
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # entry is written by concurrent run
+                shutil.rmtree(tmp)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict(keep=key)
+        return self.get(key)
+
+    def entries(self):
+        """Return list of (last use time, size, key) of entries."""
+        result = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if key.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                mtime = os.path.getmtime(os.path.join(path, INDEX_FILE))
+                size = sum(e.stat().st_size for e in os.scandir(path))
+            except OSError:
+                continue
+            result.append((mtime, size, key))
+        return result
+
+    def evict(self, keep=None):
+        """Remove least recently used entries (except `keep`) until size fits the limit."""
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total -= size
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+#
+
+"""Flashing daemon: runs jobs of mcom02-flash-spi and mcom02-flash-factory in one long-running
+process which keeps serial ports open between jobs.
+
+The tools forward jobs to the daemon if it is running (see forward_job()). A client sends one
+JSON line {"tool": module, "args": parsed arguments} to the Unix socket, the daemon sends JSON
+lines {"stdout": text} and {"stderr": text} with output of the job and {"retcode": code} at
+the end. Jobs on the same port are run one after another, jobs on different ports are run
+concurrently.
+"""
+
+import argparse
+import importlib
+import json
+import os
+import select
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+
+import serial
+
+from mcom02_flash_tools import __version__, eprint
+from mcom02_flash_tools.cache import default_cache_dir
+from mcom02_flash_tools.transcript import is_replay_port
+
+SOCKET_NAME = 'mcom02-flash-daemon.sock'
+# Socket path used instead of the default one
+SOCKET_ENV = 'MCOM02_FLASH_DAEMON_SOCKET'
+# Modules of mcom02_flash_tools which run jobs with run(args) function
+TOOLS = ('mcom02_flash_spi', 'mcom02_flash_factory')
+
+# Context of the job run by the current thread of the daemon
+_job = threading.local()
+# Unix sockets are not available on Windows, the tools run jobs without the daemon there
+HAS_UNIX_SOCKETS = hasattr(socket, 'AF_UNIX')
+
+
+def default_socket_path():
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR') or default_cache_dir(), SOCKET_NAME)
+
+
+def open_uart(cls, port, **kwargs):
+    """Return console `cls` (e.g. UART) for `port`. In a job of the daemon the serial port
+    kept open by the daemon is used.
+    """
+    pool = getattr(_job, 'pool', None)
+    if pool is not None:
+        port = pool.get(port)
+    return cls(port=port, **kwargs)
+
+
+def close_uart(uart):
+    """Close console `uart` opened by open_uart(). In a job of the daemon the serial port
+    stays open, only resources of the console (e.g. event loop, transcript file) are released.
+    """
+    uart.close(keep_port=getattr(_job, 'pool', None) is not None)
+
+
+def forward_job(tool, args, path_args=()):
+    """Run job of `tool` (module name) with parsed `args` by the daemon if it is running and
+    print output of the job. Relative paths in arguments `path_args` are resolved by the
+    client. Return exit code of the job or None if the daemon is not running (or Unix sockets
+    are not supported) or the port is a replayed transcript (it is replayed by the client).
+    """
+    if not HAS_UNIX_SOCKETS or is_replay_port(getattr(args, 'port', None)):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(default_socket_path())
+    except OSError:
+        sock.close()
+        return None
+
+    args = dict(vars(args))
+    for name in path_args:
+        if args.get(name) is not None:
+            args[name] = os.path.abspath(args[name])
+    with sock, sock.makefile('rwb') as f:
+        f.write(json.dumps({'tool': tool, 'args': args}).encode() + b'\n')
+        f.flush()
+        for line in f:
+            message = json.loads(line)
+            if 'retcode' in message:
+                return message['retcode']
+            for name in ('stdout', 'stderr'):
+                if name in message:
+                    stream = getattr(sys, name)
+                    stream.write(message[name])
+                    stream.flush()
+    eprint('Connection to mcom02-flash-daemon is lost')
+    return 1
+
+
+class ThreadStream(object):
+    """Replacement of sys.stdout or sys.stderr of the daemon: output of a job is sent to its
+    client, output of other threads is written to `default` stream.
+    """
+
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def write(self, data):
+        client = getattr(_job, 'client', None)
+        if client is None:
+            return self.default.write(data)
+        client.send({self.name: data})
+        return len(data)
+
+    def flush(self):
+        if getattr(_job, 'client', None) is None:
+            self.default.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+
+class Client(object):
+    """Connection to a client which receives output of the job."""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.connected = True
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:
+            if not self.connected:
+                return
+            try:
+                self.wfile.write(json.dumps(message).encode() + b'\n')
+                self.wfile.flush()
+            except OSError:
+                # Client is interrupted, the job is finished without output
+                self.connected = False
+
+
+def _hung_up(tty):
+    # Port is disconnected (e.g. USB-UART adapter is unplugged or pty is closed)
+    poller = select.poll()
+    poller.register(tty.fileno(), select.POLLIN)
+    errors = select.POLLHUP | select.POLLERR | select.POLLNVAL
+    return any(events & errors for _, events in poller.poll(0))
+
+
+class SerialPool(object):
+    """Serial ports kept open between jobs."""
+
+    def __init__(self):
+        self._ports = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def lock(self, port):
+        """Return lock which serializes jobs on `port`."""
+        with self._lock:
+            return self._locks.setdefault(port, threading.Lock())
+
+    def get(self, port):
+        """Return open serial port `port`. Data received between jobs is dropped as if the
+        port is opened again. Disconnected port is opened again.
+        """
+        tty = self._ports.get(port)
+        if tty is not None:
+            try:
+                if not _hung_up(tty):
+                    tty.reset_input_buffer()
+                    return tty
+            except (OSError, serial.SerialException):
+                pass
+            self.drop(port)
+        tty = self._ports[port] = serial.Serial(port=port)
+        return tty
+
+    def drop(self, port):
+        tty = self._ports.pop(port, None)
+        if tty is not None:
+            tty.close()
+
+    def close(self):
+        for port in list(self._ports):
+            self.drop(port)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        client = Client(self.wfile)
+        try:
+            request = json.loads(self.rfile.readline())
+            tool, args = request['tool'], argparse.Namespace(**request['args'])
+        except (ValueError, KeyError, TypeError):
+            client.send({'stderr': 'Error: Invalid request\n'})
+            client.send({'retcode': 2})
+            return
+        retcode = self.server.flash_daemon.run_job(tool, args, client)
+        client.send({'retcode': retcode})
+
+
+if HAS_UNIX_SOCKETS:
+
+    class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+class Daemon(object):
+    """Server of flashing jobs on Unix socket `path`."""
+
+    def __init__(self, path):
+        self.path = path
+        self.pool = SerialPool()
+        self.jobs = 0
+        self._server = None
+        self._count_lock = threading.Lock()
+
+    def run_job(self, tool, args, client):
+        """Run job of `tool` with `args`, send output to `client`. Return exit code."""
+        if tool not in TOOLS:
+            client.send({'stderr': 'Error: Unknown tool {}\n'.format(tool)})
+            return 2
+        with self._count_lock:
+            self.jobs += 1
+            job_id = self.jobs
+        port = getattr(args, 'port', None)
+        print('Job {}: {} {}'.format(job_id, tool, port))
+        start = time.monotonic()
+        module = importlib.import_module('mcom02_flash_tools.{}'.format(tool))
+
+        with self._count_lock:
+            # Output of jobs is sent to clients (streams may be replaced, e.g. by pytest)
+            for name in ('stdout', 'stderr'):
+                if not isinstance(getattr(sys, name), ThreadStream):
+                    setattr(sys, name, ThreadStream(name, getattr(sys, name)))
+
+        lock = self.pool.lock(port)
+        _job.client = client
+        _job.pool = self.pool
+        try:
+            if not lock.acquire(blocking=False):
+                print('Port {} is busy, waiting...'.format(port))
+                lock.acquire()
+            try:
+                module.run(args)
+                retcode = 0
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    retcode = e.code or 0
+                else:
+                    print(e.code, file=sys.stderr)
+                    retcode = 1
+            except Exception:
+                traceback.print_exc()
+                self.pool.drop(port)
+                retcode = 1
+            finally:
+                lock.release()
+        finally:
+            _job.client = None
+            _job.pool = None
+        print('Job {}: exit code {} in {:.1f} s'.format(job_id, retcode, time.monotonic() - start))
+        return retcode
+
+    def bind(self):
+        """Create socket. Raise RuntimeError if another daemon is running or Unix sockets
+        are not supported.
+        """
+        if not HAS_UNIX_SOCKETS:
+            raise RuntimeError('Unix sockets are not supported on this platform')
+        if os.path.exists(self.path):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            with sock:
+                try:
+                    sock.connect(self.path)
+                except OSError:
+                    # socket of terminated daemon
+                    os.remove(self.path)
+                else:
+                    raise RuntimeError('daemon is already running at {}'.format(self.path))
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._server = _Server(self.path, _Handler)
+        self._server.flash_daemon = self
+        os.chmod(self.path, 0o600)
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def shutdown(self):
+        self._server.shutdown()
+
+    def close(self):
+        for name in ('stdout', 'stderr'):
+            stream = getattr(sys, name)
+            if isinstance(stream, ThreadStream):
+                setattr(sys, name, stream.default)
+        self._server.server_close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        self.pool.close()
+
+
+def main():
+    description = (
+        'Run jobs of mcom02-flash-spi and mcom02-flash-factory in one process which keeps '
+        'serial ports open: the tools forward jobs to the daemon if it is running.'
+    )
+    parser = argparse.ArgumentParser(
+        description=description, formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        '-s',
+        '--socket',
+        default=default_socket_path(),
+        help='Unix socket of the daemon, the tools use ${} or the default one'.format(SOCKET_ENV),
+    )
+    parser.add_argument('--version', action='version', version=__version__)
+    args = parser.parse_args()
+
+    daemon = Daemon(args.socket)
+    try:
+        daemon.bind()
+    except (OSError, RuntimeError) as e:
+        eprint(e)
+        sys.exit(1)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print('Listening on {}'.format(args.socket))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1220 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+#
+
+"""MCom-02 console emulators on a pseudo-terminal.
+
+Emulators allow to run flashing tools without a board: the tool is pointed to the slave side of
+the pseudo-terminal (see `PtyEmulator.port`) and the emulator answers on the master side as the
+target would do. Output is throttled to the configured baud rate so the timing is close to
+a real UART link.
+"""
+
+import argparse
+import binascii
+import os
+import re
+import select
+import struct
+import subprocess
+import sys
+import threading
+import time
+import tty
+import zlib
+
+from mcom02_flash_tools import __version__, stub
+
+
+class CommandRecord(object):
+    """Traffic of one command (round trip) of an emulated session."""
+
+    def __init__(self, phase, start, command=True):
+        self.phase = phase
+        self.start = start
+        self.end = start  # time when the last byte of the answer was sent
+        self.command = command
+        self.rx_bytes = 0  # bytes received by target (host -> target)
+        self.tx_bytes = 0  # bytes sent by target (target -> host)
+
+
+class PhaseStats(object):
+    """Traffic statistics of one phase of an emulated session."""
+
+    def __init__(self, name, records=()):
+        self.name = name
+        self.commands = 0
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.busy = 0.0  # sum of round trip times
+        self.start = None
+        self.end = None
+        for rec in records:
+            self.add(rec)
+
+    def add(self, rec):
+        self.commands += int(rec.command)
+        self.rx_bytes += rec.rx_bytes
+        self.tx_bytes += rec.tx_bytes
+        self.busy += rec.end - rec.start
+        self.start = rec.start if self.start is None else min(self.start, rec.start)
+        self.end = rec.end if self.end is None else max(self.end, rec.end)
+
+    @property
+    def duration(self):
+        if self.start is None:
+            return 0.0
+        return self.end - self.start
+
+    def as_dict(self):
+        return {
+            'commands': self.commands,
+            'rx_bytes': self.rx_bytes,
+            'tx_bytes': self.tx_bytes,
+            'duration': self.duration,
+            'busy': self.busy,
+        }
+
+
+class PtyEmulator(object):
+    """Base class for target console emulators.
+
+    Subclasses implement `handle_line()` (or override `feed()` for non line-based input) and
+    send answers with `send()`. Every command is stored as `CommandRecord` to `self.records`
+    and is accounted to the phase stored in `self.phase` after the command is handled.
+    """
+
+    def __init__(self, baudrate=115200, link_latency=0.0):
+        """Parameters
+        ----------
+        baudrate : int
+            emulated UART speed in bit/sec, 0 or None disables throttling
+        link_latency : float
+            round trip latency of the link in seconds (e.g. latency timer of USB-UART adapter),
+            the answer on every command is delayed by this time
+        """
+        self.baudrate = baudrate
+        self.link_latency = link_latency
+        # Output is corrupted if baudrate is higher (emulation of unreliable link)
+        self.max_baudrate = None
+        self.phase = 'setup'
+        self.records = []
+        self._record = None
+        self._pending = None
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        # write() to master blocks until all data is read by host otherwise
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+        self._line = bytearray()
+        self._line_start = None
+        self._outq = []
+        # Data transmitted to host but not read yet from the pseudo-terminal (as data in
+        # buffers of USB-UART adapter driver). Target transmits data even if host does not read.
+        self._host_buf = bytearray()
+        self._ready_at = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def phase_stats(self, phase):
+        return PhaseStats(phase, [x for x in self.records if x.phase == phase])
+
+    def phases(self):
+        """Return names of phases in order of appearance."""
+        return list(dict.fromkeys(x.phase for x in self.records))
+
+    def begin_record(self, start=None, command=True):
+        """Start new record. Subsequent output of `send()` is accounted to it."""
+        if start is None:
+            start = time.monotonic()
+        self._record = CommandRecord(self.phase, start, command)
+        self.records.append(self._record)
+        return self._record
+
+    def send(self, data):
+        """Queue `data` (str or bytes) for sending to host."""
+        if isinstance(data, str):
+            data = data.encode()
+        if not data:
+            return
+        if self._record is None:
+            self.begin_record(command=False)
+        self._record.tx_bytes += len(data)
+        self._outq.append([self._record, bytearray(data), self._ready_at])
+
+    def delay(self, seconds):
+        """Delay subsequent output by `seconds` (emulation of command execution time)."""
+        self._ready_at = max(time.monotonic(), self._ready_at) + seconds
+
+    def feed(self, data):
+        """Process bytes received from host. Calls `handle_line()` for every complete line."""
+        now = time.monotonic()
+        for ch in data:
+            if self._line_start is None:
+                self._line_start = now
+            if ch == ord('\n'):
+                self.process_line(self._line, self._line_start)
+                self._line = bytearray()
+                self._line_start = None
+            else:
+                self._line.append(ch)
+
+    def process_line(self, line, start):
+        # multiline command (see `handle_line()`) continues the current record
+        rec = self._pending if self._pending is not None else self.begin_record(start)
+        self._record = rec
+        rec.rx_bytes += len(line) + 1
+        self._ready_at = max(self._ready_at, time.monotonic() + self.link_latency)
+        if self.handle_line(line.decode(errors='replace').rstrip('\r')) is False:
+            self._pending = rec
+        else:
+            self._pending = None
+        self._record = None
+        rec.phase = self.phase
+
+    def handle_line(self, line):
+        """Process line received from host. Return False if the line is not a complete command
+        (e.g. a part of multiline input).
+        """
+        raise NotImplementedError
+
+    def tick(self, now):
+        """Called periodically from emulator thread (for timed events)."""
+
+    def _chunk_size(self):
+        if not self.baudrate:
+            return 65536
+        # about 5 ms of data per read()/write()
+        return max(1, int(self.baudrate / 10 * 0.005))
+
+    def _loop(self):
+        rx_next = tx_next = 0.0
+        while not self._stop.is_set():
+            # baudrate can be changed by target command
+            byte_time = 10.0 / self.baudrate if self.baudrate else 0.0
+            now = time.monotonic()
+            with self._lock:
+                self.tick(now)
+            timeout = 0.01
+            rlist, wlist = [], []
+            if now >= rx_next:
+                rlist.append(self._master)
+            else:
+                timeout = min(timeout, rx_next - now)
+            if self._outq:
+                ready = max(tx_next, self._outq[0][2])
+                if now >= ready:
+                    tx_next = max(now, tx_next) + self._transmit() * byte_time
+                    continue
+                timeout = min(timeout, ready - now)
+            if self._host_buf:
+                wlist.append(self._master)
+
+            readable, writable, _ = select.select(rlist, wlist, [], max(timeout, 0))
+            if readable:
+                try:
+                    data = os.read(self._master, self._chunk_size())
+                except OSError:
+                    data = b''
+                if data:
+                    rx_next = max(now, rx_next) + len(data) * byte_time
+                    with self._lock:
+                        self.feed(data)
+            if writable:
+                try:
+                    n = os.write(self._master, self._host_buf)
+                except OSError:
+                    n = 0
+                del self._host_buf[:n]
+
+    def _transmit(self):
+        """Move a chunk of output to the host side. Return count of bytes."""
+        with self._lock:
+            rec, buf, _ = self._outq[0]
+            chunk = buf[: self._chunk_size()]
+            del buf[: len(chunk)]
+            if not buf:
+                self._outq.pop(0)
+            rec.end = time.monotonic()
+        if self.max_baudrate and self.baudrate > self.max_baudrate:
+            chunk = bytes(x ^ 0x55 if i % 3 == 0 else x for i, x in enumerate(chunk))
+        self._host_buf += chunk
+        return len(chunk)
+
+
+class SPIFlashModel(object):
+    """SPI NOR flash memory model with JEDEC ID and software write protection."""
+
+    CMD_WRITE_STATUS_BYTE1 = 0x1
+    CMD_WRITE_DISABLE = 0x4
+    CMD_READ_STATUS = 0x5
+    CMD_WRITE_ENABLE = 0x6
+    CMD_SECTOR_ERASE = 0xD8
+    CMD_READ_MANUF_ID = 0x9F
+    STATUS_WEL = 0x2
+    STATUS_PROTECT = 0xC
+
+    def __init__(
+        self, size=16 * 1024 * 1024, jedec_id=0x20BA18, protected=None, erase_size=0x10000
+    ):
+        self.data = bytearray(b'\xff' * size)
+        self.jedec_id = jedec_id
+        self.erase_size = erase_size
+        # Atmel/Adesto memories are write protected after power-up
+        if protected is None:
+            protected = (jedec_id >> 16) == 0x1F
+        self.protected = protected
+        self.write_enabled = False
+
+    def transfer_byte(self, index, tx):
+        """Return byte sent by flash at position `index` of transaction `tx`."""
+        if tx[0] == self.CMD_READ_MANUF_ID and 1 <= index <= 3:
+            return (self.jedec_id >> (8 * (3 - index))) & 0xFF
+        if tx[0] == self.CMD_READ_STATUS and index >= 1:
+            # erase is completed immediately, busy bit is never set
+            status = self.STATUS_WEL if self.write_enabled else 0
+            return status | (self.STATUS_PROTECT if self.protected else 0)
+        return 0xFF
+
+    def end_transaction(self, tx):
+        if not tx:
+            return
+        if tx[0] == self.CMD_WRITE_ENABLE:
+            self.write_enabled = True
+        elif tx[0] == self.CMD_WRITE_DISABLE:
+            self.write_enabled = False
+        elif tx[0] == self.CMD_WRITE_STATUS_BYTE1 and len(tx) > 1 and self.write_enabled:
+            self.protected = bool(tx[1] & self.STATUS_PROTECT)
+            self.write_enabled = False
+        elif tx[0] == self.CMD_SECTOR_ERASE and len(tx) > 3 and self.write_enabled:
+            offset = int.from_bytes(bytes(tx[1:4]), 'big')
+            self.erase(offset - offset % self.erase_size, self.erase_size)
+            self.write_enabled = False
+
+    def program(self, offset, data):
+        if self.protected:
+            return False
+        self.data[offset : offset + len(data)] = data
+        return True
+
+    def erase(self, offset, size):
+        if self.protected:
+            return False
+        self.data[offset : offset + size] = b'\xff' * size
+        return True
+
+    def program_page(self, offset, data):
+        """Program without erase: bits can be changed from 1 to 0 only."""
+        if self.protected:
+            return False
+        old = self.data[offset : offset + len(data)]
+        self.data[offset : offset + len(data)] = bytes(x & y for x, y in zip(old, data))
+        return True
+
+
+class BootROMEmulator(PtyEmulator):
+    """MCom-02 BootROM UART terminal emulator.
+
+    Supports commands used by mcom02-flash-spi: set, dump, autorun, cache, setflash,
+    Intel-HEX upload, commitspiflash and dumpspiflash. SPI0 controller registers are emulated
+    to access `SPIFlashModel`.
+
+    Traffic is accounted to phases: 'setup' (until first access to SPI0 controller), 'unlock'
+    (SPI0 controller register access), 'write' (setflash, Intel-HEX, commitspiflash and SPI0
+    controller access after sector erase command) and 'check' (dumpspiflash).
+
+    If autorun is enabled then the program uploaded as Intel-HEX with start address is started
+    after end of file record. The program is not executed: it is assumed to be the flasher stub
+    (see `mcom02_flash_tools.stub`) and the stub protocol is emulated. Stub traffic is accounted
+    to phases 'stub' (upload and hello), 'unlock', 'write' (erase and write) and 'check' (CRC).
+    """
+
+    PROMPT = '\r#'
+    RAM_BASE = 0x20000000
+    RAM_SIZE = 0x40000
+
+    GATE_SYS_CTR = 0x3809404C
+    SPI0_BASE = 0x38032000
+    SSIENR = 0x38032008
+    SER = 0x38032010
+    RXFLR = 0x38032024
+    DR = 0x38032060
+
+    def __init__(self, baudrate=115200, flash=None, rev0=False, link_latency=0.0):
+        """Parameters
+        ----------
+        baudrate : int
+            emulated UART speed in bit/sec, 0 or None disables throttling
+        link_latency : float
+            round trip latency of the link in seconds
+        flash : SPIFlashModel
+            flash memory connected to SPI0, if None then 16 MiB Micron flash is used
+        rev0 : bool
+            if True then emulate BootROM rev.0 which prints "Config spi0... Ok" before dump
+        """
+        super().__init__(baudrate, link_latency)
+        self.flash = flash if flash is not None else SPIFlashModel()
+        self.rev0 = rev0
+        self.ram = bytearray(self.RAM_SIZE)
+        self.regs = {self.GATE_SYS_CTR: 0x00000001}
+        self.flash_offset = 0
+        self._ihex_base = 0
+        self._ihex_error = None
+        self._ihex_start = None
+        self._spi_tx = []
+        self._spi_rx = []
+        self._spi_fifo = []
+        self.autorun = True
+        self.stub_running = False
+        self._stub_buf = bytearray()
+        self._stub_hello = b''
+        self.commands = {
+            'set': self.cmd_set,
+            'dump': self.cmd_dump,
+            'autorun': self.cmd_autorun,
+            'cache': self.cmd_noop,
+            'setflash': self.cmd_setflash,
+            'commitspiflash': self.cmd_commitspiflash,
+            'dumpspiflash': self.cmd_dumpspiflash,
+        }
+
+    def handle_line(self, line):
+        self.send(line + '\r\n')
+        if line.startswith(':'):
+            self.phase = 'stub' if self.autorun else 'write'
+            if not self.ihex_record(line):
+                return False
+            if not self.stub_running:
+                self.send('\r\n' + self.PROMPT)
+            return
+
+        argv = line.split()
+        if not argv:
+            self.send('\r\n' + self.PROMPT)
+            return
+
+        handler = self.commands.get(argv[0])
+        try:
+            out = handler(*[int(x, 16) for x in argv[1:]]) if handler else None
+        except (TypeError, ValueError):
+            out = None
+        if out is None:
+            out = 'Incorrect command\r\n'
+        self.send('\r\n' + out + self.PROMPT)
+
+    def ihex_record(self, line):
+        """Process Intel-HEX record. Return True at end of file."""
+        try:
+            rec = bytes.fromhex(line[1:])
+        except ValueError:
+            self._ihex_error = 'Incorrect record'
+            return False
+        if len(rec) < 5 or len(rec) != rec[0] + 5 or sum(rec) & 0xFF:
+            self._ihex_error = 'Checksum error'
+            return False
+
+        rtype, data = rec[3], rec[4:-1]
+        if rtype == 0x00:
+            addr = self._ihex_base + (rec[1] << 8 | rec[2])
+            offset = addr - self.RAM_BASE
+            if 0 <= offset and offset + len(data) <= self.RAM_SIZE:
+                self.ram[offset : offset + len(data)] = data
+            else:
+                self._ihex_error = 'Address out of RAM'
+        elif rtype == 0x02:
+            self._ihex_base = int.from_bytes(data, 'big') << 4
+        elif rtype == 0x04:
+            self._ihex_base = int.from_bytes(data, 'big') << 16
+        elif rtype == 0x05:
+            self._ihex_start = int.from_bytes(data, 'big')
+        elif rtype == 0x01:
+            if self._ihex_error is not None:
+                self.send(self._ihex_error + '\r\n')
+            elif self.autorun and self._ihex_start is not None:
+                self.start_stub()
+            self._ihex_base = 0
+            self._ihex_error = None
+            self._ihex_start = None
+            return True
+        return False
+
+    def cmd_noop(self, value):
+        return ''
+
+    def cmd_autorun(self, value):
+        self.autorun = bool(value)
+        return ''
+
+    def cmd_set(self, addr, value):
+        self.reg_write(addr, value)
+        return ''
+
+    def cmd_dump(self, addr, count):
+        words = [self.reg_read(addr + 4 * i) for i in range(count)]
+        return self.format_dump(addr, words)
+
+    def cmd_setflash(self, offset):
+        self.phase = 'write'
+        self.flash_offset = offset
+        return ''
+
+    def cmd_commitspiflash(self, addr, size):
+        self.phase = 'write'
+        offset = addr - self.RAM_BASE
+        if offset < 0 or offset + size > self.RAM_SIZE:
+            return None
+        if not self.flash.program(self.flash_offset, self.ram[offset : offset + size]):
+            return 'Flash is write protected\r\n'
+        self.flash_offset += size
+        return ''
+
+    def cmd_dumpspiflash(self, offset, count):
+        self.phase = 'check'
+        data = self.flash.data[offset : offset + 4 * count]
+        data += b'\xff' * (4 * count - len(data))
+        words = [int.from_bytes(data[i : i + 4], 'little') for i in range(0, len(data), 4)]
+        prefix = 'Config spi0... Ok\r\n' if self.rev0 else ''
+        return prefix + self.format_dump(offset, words)
+
+    def feed(self, data):
+        if self.stub_running:
+            self.stub_feed(data)
+        else:
+            super().feed(data)
+
+    def start_stub(self):
+        self.stub_running = True
+        self.flash.write_enabled = False
+        hello = struct.pack('<BH', stub.PROTOCOL_VERSION, stub.MAX_PAYLOAD)
+        hello += self.flash.jedec_id.to_bytes(3, 'big')
+        self._stub_hello = hello
+        self.send(stub.encode_frame(stub.MAGIC_STUB, stub.STATUS_OK, 0, hello))
+
+    def stub_feed(self, data):
+        """Receive stub frames as stub/flasher.c does. Every frame is a round trip."""
+        buf = self._stub_buf
+        buf += data
+        while buf:
+            if buf[0] != stub.MAGIC_HOST:
+                del buf[0]
+                continue
+            if len(buf) < stub.HEADER.size:
+                return
+            _, cmd, length, offset = stub.HEADER.unpack_from(buf)
+            if length > stub.MAX_PAYLOAD:
+                size, status = stub.HEADER.size, stub.STATUS_BAD_LENGTH
+            else:
+                size = stub.HEADER.size + length + 4
+                if len(buf) < size:
+                    return
+                crc = zlib.crc32(buf[: size - 4])
+                ok = crc == int.from_bytes(buf[size - 4 : size], 'little')
+                status = stub.STATUS_OK if ok else stub.STATUS_BAD_CRC
+            payload = bytes(buf[stub.HEADER.size : size - 4])
+            del buf[:size]
+            self.begin_record()
+            self._record.rx_bytes += size
+            self._ready_at = max(self._ready_at, time.monotonic() + self.link_latency)
+            if status == stub.STATUS_OK:
+                status, payload = self.stub_command(cmd, offset, payload)
+            else:
+                payload = b''
+            self.send(stub.encode_frame(stub.MAGIC_STUB, status, offset, payload))
+            self._record.phase = self.phase
+            self._record = None
+
+    def stub_command(self, cmd, offset, payload):
+        if cmd == stub.CMD_HELLO:
+            self.phase = 'stub'
+            return stub.STATUS_OK, self._stub_hello
+        if cmd == stub.CMD_UNLOCK:
+            self.phase = 'unlock'
+            self.flash.end_transaction([SPIFlashModel.CMD_WRITE_ENABLE])
+            self.flash.end_transaction([SPIFlashModel.CMD_WRITE_STATUS_BYTE1, 0])
+            return stub.STATUS_OK, b''
+        if cmd == stub.CMD_ERASE:
+            self.phase = 'write'
+            # protected flash ignores commands, the error is detected by CRC check
+            start = offset - offset % stub.ERASE_SIZE
+            self.flash.erase(start, stub.ERASE_SIZE)
+            return stub.STATUS_OK, b''
+        if cmd == stub.CMD_WRITE:
+            self.phase = 'write'
+            self.flash.program_page(offset, payload)
+            return stub.STATUS_OK, b''
+        if cmd == stub.CMD_CRC and len(payload) == 4:
+            self.phase = 'check'
+            size = int.from_bytes(payload, 'little')
+            crc = zlib.crc32(self.flash.data[offset : offset + size])
+            return stub.STATUS_OK, crc.to_bytes(4, 'little')
+        if cmd == stub.CMD_CRC:
+            return stub.STATUS_BAD_LENGTH, b''
+        return stub.STATUS_BAD_COMMAND, b''
+
+    @staticmethod
+    def format_dump(addr, words):
+        return ''.join(
+            '0x{:08x} : 0x{:08x}\r\n'.format(addr + 4 * i, word) for i, word in enumerate(words)
+        )
+
+    def is_spi_reg(self, addr):
+        return self.SPI0_BASE <= addr < self.SPI0_BASE + 0x100 or addr == self.GATE_SYS_CTR
+
+    def reg_write(self, addr, value):
+        if self.is_spi_reg(addr) and self.phase == 'setup':
+            self.phase = 'unlock'
+        if addr == self.DR:
+            if self.regs.get(self.SSIENR):
+                self._spi_fifo.append(value & 0xFF)
+                self.spi_shift()
+            return
+        if addr == self.SSIENR and not value:
+            if self._spi_tx[:1] == [SPIFlashModel.CMD_SECTOR_ERASE]:
+                self.phase = 'write'
+            self.flash.end_transaction(self._spi_tx)
+            self._spi_tx = []
+            self._spi_rx = []
+            self._spi_fifo = []
+        self.regs[addr] = value & 0xFFFFFFFF
+        if addr == self.SER:
+            self.spi_shift()
+
+    def spi_shift(self):
+        """Transfer bytes of TX FIFO if a slave is selected (the transfer starts when TX FIFO
+        is not empty and SER is set).
+        """
+        if not self.regs.get(self.SER):
+            return
+        for byte in self._spi_fifo:
+            self._spi_tx.append(byte)
+            self._spi_rx.append(self.flash.transfer_byte(len(self._spi_tx) - 1, self._spi_tx))
+        self._spi_fifo = []
+
+    def reg_read(self, addr):
+        if self.is_spi_reg(addr) and self.phase == 'setup':
+            self.phase = 'unlock'
+        if addr == self.RXFLR:
+            return len(self._spi_rx)
+        if addr == self.DR:
+            return self._spi_rx.pop(0) if self._spi_rx else 0
+        return self.regs.get(addr, 0)
+
+
+class SparseMemory(object):
+    """Sparse model of target RAM."""
+
+    PAGE_SIZE = 0x10000
+
+    def __init__(self):
+        self.pages = {}
+
+    def write(self, addr, data):
+        data = memoryview(data)
+        while data:
+            page, offset = divmod(addr, self.PAGE_SIZE)
+            n = min(len(data), self.PAGE_SIZE - offset)
+            if page not in self.pages:
+                self.pages[page] = bytearray(self.PAGE_SIZE)
+            self.pages[page][offset : offset + n] = data[:n]
+            addr += n
+            data = data[n:]
+
+    def read(self, addr, size):
+        result = bytearray()
+        while size:
+            page, offset = divmod(addr, self.PAGE_SIZE)
+            n = min(size, self.PAGE_SIZE - offset)
+            result += self.pages.get(page, bytes(self.PAGE_SIZE))[offset : offset + n]
+            addr += n
+            size -= n
+        return bytes(result)
+
+
+class LoopBlockDevice(object):
+    """Host block device backed by a file (via losetup), emulates UMS device of the board."""
+
+    def __init__(self, path):
+        self.path = path
+        self.device = None
+
+    def attach(self):
+        try:
+            out = subprocess.check_output(
+                ['losetup', '--find', '--show', self.path],
+                universal_newlines=True,
+                stderr=subprocess.PIPE,
+            )
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('Emulator: failed to attach loop device: {}'.format(e), file=sys.stderr)
+            return None
+        self.device = out.strip()
+        return self.device
+
+    def detach(self):
+        if self.device is not None:
+            subprocess.call(['losetup', '--detach', self.device])
+            self.device = None
+
+
+class UBootEmulator(PtyEmulator):
+    """U-Boot console emulator for mcom02-flash-factory and mcom02-flash-ums-mmc.
+
+    Supports commands env, setenv, printenv, echo, sf (probe, read, update, erase, protect),
+    fdt, version and ums. Every command is delayed according to the latency model: fixed time
+    from `latency` (looked up by "<command> <subcommand>", "<command>" and "default" keys) plus
+    data dependent time of SPI flash operations from `sf_speed`.
+
+    The board is powered on by the first byte received from host (the tools must be started
+    before the board is powered), then U-Boot prints the banner and waits for a key to stop
+    autoboot. Traffic is accounted to phases named by U-Boot commands ('boot' for the banner).
+    """
+
+    DEFAULT_LATENCY = {
+        'default': 0.0005,
+        'sf probe': 0.005,
+    }
+    # bytes per second
+    DEFAULT_SF_SPEED = {
+        'read': 10e6,
+        'write': 500e3,
+        'erase': 200e3,
+    }
+    DEFAULT_ENV = {
+        'bootdelay': '1',
+        'fdtcontroladdr': '5ff3a000',
+        'loadaddr': '0x40000000',
+        'factoryoffset': '0xff0000',
+        'factorysize': '0x10000',
+    }
+    VERSION = 'U-Boot 2017.01-emulator (Jan 01 2024 - 00:00:00 +0300)'
+
+    def __init__(
+        self,
+        baudrate=115200,
+        prompt='mcom# ',
+        flash=None,
+        env=None,
+        latency=None,
+        sf_speed=None,
+        power_on='input',
+        model='ELVEES Salute-EL24PM2 r1.1 on PM-UKF',
+        write_protect_jumper=False,
+        mmc_images=None,
+        link_latency=0.0,
+        baudrates=(115200, 230400, 460800, 921600, 1500000),
+        max_baudrate=None,
+        cbsize=None,
+    ):
+        """Parameters
+        ----------
+        baudrate : int
+            emulated UART speed in bit/sec, 0 or None disables throttling
+        prompt : str
+            U-Boot command line prompt
+        flash : SPIFlashModel
+            flash memory on SPI bus 0, if None then 16 MiB Micron flash is used
+        env : dict
+            U-Boot environment, if None then `DEFAULT_ENV` is used
+        latency : dict
+            command execution times in seconds, updates `DEFAULT_LATENCY`
+        sf_speed : dict
+            SPI flash read, write and erase speeds in bytes/sec, updates `DEFAULT_SF_SPEED`
+        power_on : str
+            'input' - power on board by the first byte from host, 'start' - power on board
+            when emulator is started, 'prompt' - U-Boot is already at prompt
+        model : str
+            board model from device tree
+        write_protect_jumper : bool
+            if True then SPI flash write protection can not be disabled
+        mmc_images : dict
+            MMC device number -> path to file. Used as block device for UMS
+        link_latency : float
+            round trip latency of the link in seconds
+        baudrates : list
+            baudrates supported by "setenv baudrate" (CONFIG_SYS_BAUDRATE_TABLE)
+        max_baudrate : int
+            output is corrupted at higher baudrates (emulation of unreliable link)
+        cbsize : int
+            size of command line buffer (CONFIG_SYS_CBSIZE), characters of longer command line
+            are dropped, None - unlimited
+        """
+        super().__init__(baudrate, link_latency)
+        self.cbsize = cbsize
+        self.baudrates = baudrates
+        self.max_baudrate = max_baudrate
+        self._new_baudrate = None
+        self.prompt = prompt
+        self.flash = flash if flash is not None else SPIFlashModel(protected=False)
+        self.env = dict(self.DEFAULT_ENV if env is None else env)
+        self.latency = dict(self.DEFAULT_LATENCY, **(latency or {}))
+        self.sf_speed = dict(self.DEFAULT_SF_SPEED, **(sf_speed or {}))
+        self.power_on = power_on
+        self.model = model
+        self.write_protect_jumper = write_protect_jumper
+        self.mmc_images = mmc_images or {}
+        self.memory = SparseMemory()
+        self.locked = []
+        self.sf_probed = False
+        self.retcode = 0
+        self.state = 'prompt' if power_on == 'prompt' else 'off'
+        self._autoboot_end = None
+        self._ums = None
+        self._ymodem = None
+        self.commands = {
+            'crc32': self.cmd_crc32,
+            'echo': self.cmd_echo,
+            'env': self.cmd_env,
+            'fdt': self.cmd_fdt,
+            'loady': self.cmd_loady,
+            'printenv': lambda argv: self.env_print(argv[1:]),
+            'setenv': lambda argv: self.env_set(argv[1:]),
+            'sf': self.cmd_sf,
+            'ums': self.cmd_ums,
+            'version': self.cmd_version,
+        }
+
+    def start(self):
+        if self.power_on == 'start':
+            with self._lock:
+                self.boot()
+        super().start()
+
+    def stop(self):
+        super().stop()
+        if self._ums is not None:
+            self._ums.detach()
+            self._ums = None
+
+    def boot(self):
+        self.phase = 'boot'
+        self.send(
+            '\r\nU-Boot SPL 2017.01-emulator\r\nDDR0: 1 GiB\r\n\r\n\r\n{}\r\n\r\n'
+            'Model: {}\r\nDRAM:  1 GiB\r\nSF: Detected n25q128 with page size 256 Bytes, '
+            'erase size 64 KiB, total 16 MiB\r\nIn:    serial\r\nOut:   serial\r\n'
+            'Err:   serial\r\n'.format(self.VERSION, self.model)
+        )
+        bootdelay = int(self.env.get('bootdelay', '0'))
+        self.send('Hit any key to stop autoboot: {:2d} '.format(bootdelay))
+        self.state = 'autoboot'
+        self._autoboot_end = time.monotonic() + bootdelay
+
+    def tick(self, now):
+        if self.state == 'autoboot' and now >= self._autoboot_end:
+            self.send('\x08\x08\x08  0 \r\nStarting kernel ...\r\n\r\n')
+            self.state = 'linux'
+
+    def feed(self, data):
+        if self.state == 'ymodem':
+            # binary data, Ctrl-C is not special
+            self.ymodem_feed(data)
+            return
+        for chunk in re.split(b'(\x03)', data):
+            if not chunk:
+                continue
+            if self.state == 'off':
+                # power on the board, the data is received by nobody
+                self.boot()
+            elif self.state == 'autoboot':
+                self.phase = 'boot'
+                self.send('\x08\x08\x08  0 \r\n' + self.prompt)
+                self.state = 'prompt'
+                super().feed(chunk[1:])
+            elif self.state == 'baudrate':
+                # wait for ENTER at new baudrate
+                if b'\r' in chunk:
+                    self.baudrate = self._new_baudrate
+                    self.state = 'prompt'
+                    self.send(self.prompt)
+                    super().feed(chunk[chunk.index(b'\r') + 1 :])
+            elif chunk == b'\x03':
+                self.ctrl_c()
+            elif self.state == 'prompt':
+                super().feed(chunk)
+
+    def ctrl_c(self):
+        self.begin_record()
+        if self.state == 'ums':
+            self._ums.detach()
+            self._ums = None
+            self.send('\r\n' + self.prompt)
+            self.state = 'prompt'
+        elif self.state == 'prompt':
+            self._line = bytearray()
+            self._line_start = None
+            self.send('<INTERRUPT>\r\n' + self.prompt)
+        self._record = None
+
+    def expand(self, line):
+        def value(m):
+            name = m.group(2) or m.group(1)
+            return str(self.retcode) if name == '?' else self.env.get(name, '')
+
+        return re.sub(r'\$(?:\{(\w+|\?)\}|(\w+|\?))', value, line)
+
+    def get_latency(self, argv):
+        for key in (' '.join(argv[:2]), argv[0], 'default'):
+            if key in self.latency:
+                return self.latency[key]
+        return 0.0
+
+    def handle_line(self, line):
+        if self.cbsize is not None:
+            # readline of U-Boot does not accept (and echo) characters after the buffer is full
+            line = line[: self.cbsize - 1]
+        self.send(line + '\r\n')
+        self.phase = 'console'
+        # Commands separated by ';' are executed sequentially, variables are expanded
+        # right before execution of each command (as hush does)
+        for i, part in enumerate(line.split(';')):
+            argv = self.expand(part).split()
+            if argv:
+                if i == 0:
+                    self.phase = argv[0]
+                self.execute(argv)
+            if self.state != 'prompt':
+                return
+        self.send(self.prompt)
+
+    def execute(self, argv):
+        handler = self.commands.get(argv[0])
+        self.delay(self.get_latency(argv))
+        if handler is None:
+            rc, out = 1, "Unknown command '{}' - try 'help'".format(argv[0])
+        else:
+            try:
+                rc, out = handler(argv)
+            except (IndexError, ValueError):
+                rc, out = 1, 'Usage: {}'.format(argv[0])
+        self.retcode = rc
+        if out:
+            self.send(out + '\r\n')
+
+    def cmd_echo(self, argv):
+        return 0, ' '.join(argv[1:])
+
+    def cmd_version(self, argv):
+        return 0, '\r\n{}\r\narm-linux-gnueabihf-gcc (GCC) 7.3.0\r\nGNU ld 2.29.1'.format(
+            self.VERSION
+        )
+
+    def cmd_fdt(self, argv):
+        if argv[1] == 'addr':
+            return 0, ''
+        if argv[1] == 'list' and argv[2:] == ['/', 'model']:
+            return 0, 'model = "{}";'.format(self.model)
+        return 1, 'Usage: fdt'
+
+    def cmd_env(self, argv):
+        sub, args = argv[1], argv[2:]
+        if sub == 'print':
+            return self.env_print(args)
+        if sub == 'set':
+            return self.env_set(args)
+        if sub == 'export':
+            return self.env_export(args)
+        if sub == 'import':
+            return self.env_import(args)
+        return 1, 'Usage: env'
+
+    def env_print(self, names):
+        if names:
+            missing = [x for x in names if x not in self.env]
+            lines = ['{}={}'.format(x, self.env[x]) for x in names if x in self.env]
+            lines += ['## Error: "{}" not defined'.format(x) for x in missing]
+            return int(bool(missing)), '\r\n'.join(lines)
+        lines = ['{}={}'.format(k, v) for k, v in sorted(self.env.items())]
+        size = sum(len(x) + 1 for x in lines) + 1
+        lines.append('\r\nEnvironment size: {}/{} bytes'.format(size, 0x10000 - 4))
+        return 0, '\r\n'.join(lines)
+
+    def env_set(self, args):
+        if args[0] == 'baudrate' and len(args) > 1:
+            baudrate = int(args[1])
+            if baudrate not in self.baudrates:
+                return 1, '## Baudrate {} bps not supported'.format(baudrate)
+            self._new_baudrate = baudrate
+            self.state = 'baudrate'
+            self.env['baudrate'] = args[1]
+            return 0, '## Switch baudrate to {} bps and press ENTER ...'.format(baudrate)
+        if len(args) == 1:
+            self.env.pop(args[0], None)
+        else:
+            self.env[args[0]] = ' '.join(args[1:])
+        return 0, ''
+
+    def env_export(self, args):
+        if args[:2] != ['-c', '-s']:
+            return 1, 'Usage: env export'
+        size, addr = int(args[2], 16), int(args[3], 16)
+        names = args[4:] or sorted(self.env)
+        data = b''.join('{}={}\0'.format(x, self.env[x]).encode() for x in names if x in self.env)
+        data += b'\0'
+        if len(data) > size - 4:
+            return 1, '## Error: Environment export error'
+        data += bytes(size - 4 - len(data))
+        self.memory.write(addr, zlib.crc32(data).to_bytes(4, 'little') + data)
+        return 0, ''
+
+    def env_import(self, args):
+        if args[:2] != ['-d', '-c']:
+            return 1, 'Usage: env import'
+        addr, size = int(args[2], 16), int(args[3], 16)
+        raw = self.memory.read(addr, size)
+        data = raw[4:]
+        if zlib.crc32(data) != int.from_bytes(raw[:4], 'little'):
+            return 1, '## Error: bad CRC, import failed'
+        env = {}
+        for item in data.split(b'\0'):
+            if not item:
+                break
+            name, value = item.decode().split('=', 1)
+            env[name] = value
+        self.env = env
+        return 0, ''
+
+    def is_locked(self, offset, size):
+        return any(offset < end and start < offset + size for start, end in self.locked)
+
+    def cmd_sf(self, argv):
+        sub = argv[1]
+        if sub == 'probe':
+            self.sf_probed = True
+            return 0, (
+                'SF: Detected n25q128 with page size 256 Bytes, erase size {} KiB, '
+                'total {} MiB'.format(self.flash.erase_size // 1024, len(self.flash.data) >> 20)
+            )
+        if not self.sf_probed:
+            return 1, "No SPI flash selected. Please run `sf probe'"
+
+        if sub == 'protect':
+            offset, size = int(argv[3], 16), int(argv[4], 16)
+            if argv[2] == 'lock':
+                self.locked.append((offset, offset + size))
+                return 0, ''
+            if self.write_protect_jumper:
+                return 1, 'SF: Failed to unlock 0x{:x} bytes at 0x{:x}'.format(size, offset)
+            self.locked = [x for x in self.locked if not (offset <= x[0] and x[1] <= offset + size)]
+            return 0, ''
+
+        if sub == 'read':
+            addr, offset, size = [int(x, 16) for x in argv[2:5]]
+            self.memory.write(addr, self.flash.data[offset : offset + size])
+            self.delay(size / self.sf_speed['read'])
+            return (
+                0,
+                'device 0 offset 0x{:x}, size 0x{:x}\r\nSF: {} bytes @ 0x{:x} Read: OK'.format(
+                    offset, size, size, offset
+                ),
+            )
+
+        if sub == 'erase':
+            offset, size = int(argv[2], 16), int(argv[3], 16)
+            if offset % self.flash.erase_size or size % self.flash.erase_size:
+                return 1, 'SF: Erase offset/length not multiple of erase size'
+            if self.is_locked(offset, size) or self.write_protect_jumper and self.locked:
+                return 1, 'offset 0x{:x} is protected and cannot be erased'.format(offset)
+            self.flash.data[offset : offset + size] = b'\xff' * size
+            self.delay(size / self.sf_speed['erase'])
+            return 0, 'SF: {} bytes @ 0x{:x} Erased: OK'.format(size, offset)
+
+        if sub == 'update':
+            addr, offset, size = [int(x, 16) for x in argv[2:5]]
+            if self.is_locked(offset, size):
+                return 1, 'offset 0x{:x} is protected and cannot be erased'.format(offset)
+            data = self.memory.read(addr, size)
+            written = 0
+            sector = self.flash.erase_size
+            for pos in range(0, size, sector):
+                chunk = data[pos : pos + sector]
+                start = offset + pos
+                if self.flash.data[start : start + len(chunk)] != chunk:
+                    self.flash.data[start : start + len(chunk)] = chunk
+                    written += len(chunk)
+            duration = size / self.sf_speed['read']
+            duration += written / self.sf_speed['erase'] + written / self.sf_speed['write']
+            self.delay(duration)
+            return 0, '{} bytes written, {} bytes skipped in {:.1f}s, speed {} B/s'.format(
+                written, size - written, duration, int(size / max(duration, 1e-3))
+            )
+
+        return 1, 'Usage: sf'
+
+    def cmd_crc32(self, argv):
+        addr, size = int(argv[1], 16), int(argv[2], 16)
+        crc = zlib.crc32(self.memory.read(addr, size))
+        return 0, 'crc32 for {:08x} ... {:08x} ==> {:08x}'.format(addr, addr + size - 1, crc)
+
+    def cmd_loady(self, argv):
+        addr = int(argv[1], 16) if len(argv) > 1 else int(self.env['loadaddr'], 16)
+        self._ymodem = {'addr': addr, 'buf': bytearray(), 'data': bytearray(), 'seq': 1}
+        self.state = 'ymodem'
+        return 0, '## Ready for binary (ymodem) download to 0x{:08X} at {} bps...\r\nC'.format(
+            addr, self.baudrate
+        )
+
+    def ymodem_feed(self, data):
+        """Receive YMODEM packets of "loady" command. Every packet is a round trip."""
+        ym = self._ymodem
+        buf = ym['buf']
+        buf += data
+        while buf and self.state == 'ymodem':
+            if buf[0] in (0x01, 0x02):
+                size = 128 if buf[0] == 0x01 else 1024
+                if len(buf) < size + 5:
+                    return
+                packet = bytes(buf[: size + 5])
+            else:
+                packet = bytes(buf[:1])
+            del buf[: len(packet)]
+            self.begin_record()
+            self._record.rx_bytes += len(packet)
+            self._ready_at = max(self._ready_at, time.monotonic() + self.link_latency)
+            self.ymodem_packet(ym, packet)
+            self._record.phase = self.phase
+            self._record = None
+
+    def ymodem_packet(self, ym, packet):
+        ack, nak = b'\x06', b'\x15'
+        if packet == b'\x04':  # EOT
+            ym['eot'] = True
+            self.send(ack + b'C')
+            return
+        if len(packet) == 1:
+            if packet == b'\x18':  # CAN
+                self.state = 'prompt'
+                self.retcode = 1
+                self.send('\r\n## Binary (ymodem) download aborted\r\n' + self.prompt)
+            return
+        seq, payload, crc = packet[1], packet[3:-2], int.from_bytes(packet[-2:], 'big')
+        if seq + packet[2] != 0xFF or binascii.crc_hqx(payload, 0) != crc:
+            self.send(nak)
+        elif seq == 0 and 'size' not in ym:
+            # header: file name and size
+            ym['size'] = int(payload.split(b'\0')[1].split()[0])
+            self.send(ack + b'C')
+        elif seq == 0 and ym.get('eot'):
+            # empty header after the end of file finishes the batch
+            size = ym.get('size', len(ym['data']))
+            self.memory.write(ym['addr'], ym['data'][:size])
+            self.env['filesize'] = '{:x}'.format(size)
+            self.state = 'prompt'
+            self.retcode = 0
+            self.send(
+                ack
+                + '\r\n## Total Size      = 0x{0:08x} = {0} Bytes\r\n{1}'.format(
+                    size, self.prompt
+                ).encode()
+            )
+        elif seq == ym['seq'] & 0xFF:
+            ym['data'] += payload
+            ym['seq'] += 1
+            self.send(ack)
+        elif seq == (ym['seq'] - 1) & 0xFF:
+            # repeated packet (ACK was lost)
+            self.send(ack)
+        else:
+            self.send(nak)
+
+    def cmd_ums(self, argv):
+        dev = int(argv[3])
+        if argv[2] != 'mmc' or dev not in self.mmc_images:
+            return 1, 'MMC Device {} not found'.format(dev)
+        self._ums = LoopBlockDevice(self.mmc_images[dev])
+        self._ums.attach()
+        size = os.path.getsize(self.mmc_images[dev]) // 512
+        self.state = 'ums'
+        return 0, 'UMS: LUN 0, dev mmc {}, offset 0x00000000, size 0x{:08x}\r\n|'.format(dev, size)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='MCom-02 console emulator. Prints path to pseudo-terminal which can be used '
+        'as serial port for flashing tools.',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument('-b', '--baudrate', type=int, default=115200, help='emulated UART speed')
+    parser.add_argument(
+        '--jedec-id', type=lambda x: int(x, 16), default='20ba18', help='SPI flash JEDEC ID'
+    )
+    parser.add_argument(
+        '--link-latency', type=float, default=0.0, help='round trip latency of the link, s'
+    )
+    parser.add_argument('--version', action='version', version=__version__)
+    subparsers = parser.add_subparsers(dest='target', required=True, help='emulated target')
+    parser_bootrom = subparsers.add_parser(
+        'bootrom',
+        help='BootROM UART terminal (for mcom02-flash-spi)',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser_bootrom.add_argument('--rev0', action='store_true', help='emulate BootROM rev.0')
+    parser_uboot = subparsers.add_parser(
+        'uboot',
+        help='U-Boot console (for mcom02-flash-factory and mcom02-flash-ums-mmc)',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser_uboot.add_argument('--prompt', default='mcom# ', help='U-Boot command line prompt')
+    parser_uboot.add_argument(
+        '--latency', type=float, default=0.0005, help='default command execution time, s'
+    )
+    parser_uboot.add_argument(
+        '--mmc-image',
+        action='append',
+        default=[],
+        metavar='DEV:FILE',
+        help='file used as MMC device for UMS (requires losetup)',
+    )
+    args = parser.parse_args()
+
+    flash = SPIFlashModel(jedec_id=args.jedec_id)
+    if args.target == 'bootrom':
+        emulator = BootROMEmulator(
+            baudrate=args.baudrate, flash=flash, rev0=args.rev0, link_latency=args.link_latency
+        )
+    else:
+        flash.protected = False
+        mmc_images = {int(x.split(':', 1)[0]): x.split(':', 1)[1] for x in args.mmc_image}
+        emulator = UBootEmulator(
+            baudrate=args.baudrate,
+            prompt=args.prompt,
+            flash=flash,
+            latency={'default': args.latency},
+            mmc_images=mmc_images,
+            link_latency=args.link_latency,
+        )
+    with emulator:
+        print(emulator.port, flush=True)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
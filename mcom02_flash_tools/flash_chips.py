@@ -0,0 +1,96 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+
+"""SPI NOR flash memories supported by mcom02-flash-spi.
+
+Memory is identified by JEDEC ID: manufacturer, memory type and capacity bytes returned by
+Read Identification command (0x9F). Memories are erased by sector erase command (0xD8) and
+are addressed by 3 bytes, so the capacity is at most 16 MiB.
+"""
+
+MAN_ID_ATMEL = 0x1F
+MAN_ID_MICRON = 0x20
+MAN_ID_MACRONIX = 0xC2
+MAN_ID_WINBOND = 0xEF
+MANUFACTURERS = {
+    MAN_ID_ATMEL: "Atmel/Adesto",
+    MAN_ID_MICRON: "Micron",
+    MAN_ID_MACRONIX: "Macronix",
+    MAN_ID_WINBOND: "Winbond",
+}
+
+# Write protection is disabled after power-up
+UNLOCK_NONE = 'none'
+# Sectors are protected after power-up, Global Unprotect: Write Status Register byte 1 with 0
+UNLOCK_GLOBAL = 'global'
+
+KiB = 1024
+MiB = 1024 * KiB
+
+
+class FlashChip(object):
+    """Parameters of SPI NOR flash memory."""
+
+    def __init__(self, jedec_id, name, size, sector_size=64 * KiB, erased=0xFF, unlock=UNLOCK_NONE):
+        """Parameters
+        ----------
+        jedec_id : int
+            3-byte JEDEC ID
+        name : str
+            part number
+        size : int
+            capacity in bytes, None if unknown
+        sector_size : int
+            size of sector erased by sector erase command (0xD8)
+        erased : int
+            value of bytes of erased sector
+        unlock : str
+            procedure to disable software write protection (UNLOCK_NONE or UNLOCK_GLOBAL)
+        """
+        self.jedec_id = jedec_id
+        self.name = name
+        self.size = size
+        self.sector_size = sector_size
+        self.erased = erased
+        self.unlock = unlock
+
+    @property
+    def manufacturer(self):
+        return MANUFACTURERS.get(self.jedec_id >> 16, "Unknown")
+
+    def __str__(self):
+        return "{} {} (JEDEC ID 0x{:06x})".format(self.manufacturer, self.name, self.jedec_id)
+
+
+FLASH_CHIPS = {
+    x.jedec_id: x
+    for x in [
+        FlashChip(0x1F4401, "AT25DF041A", 512 * KiB, unlock=UNLOCK_GLOBAL),
+        FlashChip(0x1F4501, "AT25DF081A", 1 * MiB, unlock=UNLOCK_GLOBAL),
+        FlashChip(0x1F4602, "AT25DF161", 2 * MiB, unlock=UNLOCK_GLOBAL),
+        FlashChip(0x1F4700, "AT25DF321", 4 * MiB, unlock=UNLOCK_GLOBAL),
+        FlashChip(0x1F4701, "AT25DF321A", 4 * MiB, unlock=UNLOCK_GLOBAL),
+        FlashChip(0x1F4800, "AT25DF641", 8 * MiB, unlock=UNLOCK_GLOBAL),
+        FlashChip(0x20BA16, "N25Q032A", 4 * MiB),
+        FlashChip(0x20BA17, "N25Q064A", 8 * MiB),
+        FlashChip(0x20BA18, "N25Q128A", 16 * MiB),
+        FlashChip(0xC22016, "MX25L3233F", 4 * MiB),
+        FlashChip(0xC22017, "MX25L6433F", 8 * MiB),
+        FlashChip(0xC22018, "MX25L12835F", 16 * MiB),
+        FlashChip(0xEF4016, "W25Q32", 4 * MiB),
+        FlashChip(0xEF4017, "W25Q64", 8 * MiB),
+        FlashChip(0xEF4018, "W25Q128", 16 * MiB),
+    ]
+}
+
+
+def find_chip(jedec_id):
+    """Return FlashChip for `jedec_id`. Unknown memory has unknown capacity, 64 KiB sectors
+    and Atmel/Adesto memories are unlocked by Global Unprotect.
+    """
+    chip = FLASH_CHIPS.get(jedec_id)
+    if chip is None:
+        unlock = UNLOCK_GLOBAL if jedec_id >> 16 == MAN_ID_ATMEL else UNLOCK_NONE
+        chip = FlashChip(jedec_id, "Unknown", None, unlock=unlock)
+    return chip
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+#
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+#
+
+"""Parallel flashing of many boards with mcom02-flash-spi.
+
+Every board is flashed by its own mcom02-flash-spi process with its own UART session, so a
+stuck or failed port does not stall the others. Progress of the boards is parsed from output
+of the processes.
+"""
+
+import argparse
+import glob
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+from mcom02_flash_tools import __version__, eprint
+
+# Progress lines of mcom02-flash-spi: "Block: 3/10, size: 49152", "Erasing sector: 1/2, ..."
+PROGRESS_RE = re.compile(r'^(?:Block|Erasing sector): (\d+)/(\d+)')
+# Lines which start phases of mcom02-flash-spi
+PHASES = [
+    ('Starting flasher stub', 'stub'),
+    ('Erasing', 'erase'),
+    ('Writing to flash', 'write'),
+    ('Checking...', 'check'),
+]
+ERROR_PREFIX = 'Error: '
+
+
+class Board(object):
+    """State of flashing of the board connected to `port`."""
+
+    def __init__(self, port, image):
+        self.port = port
+        self.image = image
+        self.phase = 'waiting'
+        self.done = 0
+        self.total = 0
+        self.start = None
+        self.end = None
+        self.retcode = None
+        self.error = None
+        self.timed_out = False
+        self.process = None
+
+    @property
+    def finished(self):
+        return self.end is not None
+
+    @property
+    def result(self):
+        if not self.finished:
+            return 'running'
+        if self.timed_out:
+            return 'TIMEOUT'
+        return 'OK' if self.retcode == 0 else 'FAILED'
+
+    def duration(self, now=None):
+        if self.start is None:
+            return 0.0
+        end = self.end if self.end is not None else (now or time.monotonic())
+        return end - self.start
+
+    def update(self, line):
+        """Update state by output line of mcom02-flash-spi."""
+        for prefix, phase in PHASES:
+            if line.startswith(prefix):
+                self.phase = phase
+                self.done = self.total = 0
+        match = PROGRESS_RE.match(line)
+        if match:
+            self.done, self.total = int(match.group(1)), int(match.group(2))
+        if line.startswith(ERROR_PREFIX):
+            self.error = line[len(ERROR_PREFIX) :]
+
+    def as_dict(self):
+        return {
+            'port': self.port,
+            'image': self.image,
+            'result': self.result,
+            'retcode': self.retcode,
+            'duration': self.duration(),
+            'phase': self.phase,
+            'error': self.error,
+        }
+
+
+def flash_board(board, tool_args, log_dir=None):
+    """Flash `board` with mcom02-flash-spi and `tool_args`. Output of the tool is written to
+    `log_dir` if specified.
+    """
+    cmd = [sys.executable, '-m', 'mcom02_flash_tools.mcom02_flash_spi', '-p', board.port]
+    cmd += list(tool_args) + [board.image]
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    log = None
+    if log_dir is not None:
+        name = re.sub(r'[^\w.-]', '_', board.port.strip('/')) + '.log'
+        log = open(os.path.join(log_dir, name), 'w')
+    board.start = time.monotonic()
+    board.phase = 'setup'
+    try:
+        board.process = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+            env=env,
+            universal_newlines=True,
+            errors='replace',
+        )
+        for line in board.process.stdout:
+            if log is not None:
+                log.write(line)
+            board.update(line.strip())
+        board.retcode = board.process.wait()
+    except OSError as e:
+        board.error = str(e)
+        board.retcode = -1
+    finally:
+        if log is not None:
+            log.close()
+        board.end = time.monotonic()
+
+
+def natural_key(name):
+    """Key of natural sort order: "/dev/ttyUSB2" is before "/dev/ttyUSB10"."""
+    return [int(x) if x.isdigit() else x for x in re.split(r'(\d+)', name)]
+
+
+def expand_ports(patterns):
+    """Return list of ports matching `patterns` (port names or glob patterns). Ports are
+    listed in order of `patterns`, ports matching a glob pattern are sorted in natural order
+    (see natural_key()). Duplicate ports are listed once.
+    """
+    ports = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern), key=natural_key)
+        else:
+            matches = [pattern]
+        ports.extend(x for x in matches if x not in ports)
+    return ports
+
+
+def format_progress(boards, now):
+    """Return line with aggregated progress of `boards`."""
+    counts = {}
+    blocks = {}
+    for board in boards:
+        state = board.result if board.finished else board.phase
+        counts[state] = counts.get(state, 0) + 1
+        if not board.finished and board.total:
+            done, total = blocks.get(board.phase, (0, 0))
+            blocks[board.phase] = (done + board.done, total + board.total)
+    order = ['waiting', 'setup', 'stub', 'erase', 'write', 'check', 'OK', 'FAILED', 'TIMEOUT']
+    states = ', '.join('{}: {}'.format(x, counts[x]) for x in order if x in counts)
+    line = '[{:7.1f} s] {}'.format(now, states)
+    if blocks:
+        line += ' | ' + ', '.join(
+            '{} {}/{} blocks'.format(phase, done, total) for phase, (done, total) in blocks.items()
+        )
+    return line
+
+
+def print_report(boards, wall_time):
+    """Print table of results of `boards`."""
+    port_width = max(len('Port'), *(len(x.port) for x in boards))
+    print('{:<{}}  {:<8} {:>10}  {}'.format('Port', port_width, 'Result', 'Duration', 'Error'))
+    for board in boards:
+        print(
+            '{:<{}}  {:<8} {:>8.1f} s  {}'.format(
+                board.port, port_width, board.result, board.duration(), board.error or ''
+            )
+        )
+    succeeded = sum(1 for x in boards if x.result == 'OK')
+    print('Succeeded: {}/{}, wall time: {:.1f} s'.format(succeeded, len(boards), wall_time))
+    if wall_time > 0:
+        print('Boards per hour: {:.1f}'.format(succeeded * 3600 / wall_time))
+
+
+def flash_fleet(boards, tool_args, timeout=None, interval=5.0, log_dir=None):
+    """Flash `boards` concurrently. A board is killed if it is not flashed in `timeout`
+    seconds. Aggregated progress is printed every `interval` seconds. Return wall time.
+    """
+    start = time.monotonic()
+    threads = [
+        threading.Thread(target=flash_board, args=(x, tool_args, log_dir), daemon=True)
+        for x in boards
+    ]
+    for thread in threads:
+        thread.start()
+
+    next_report = start + interval
+    reported = set()
+    while True:
+        now = time.monotonic()
+        for board in boards:
+            if board.finished and board.port not in reported:
+                reported.add(board.port)
+                print(
+                    '{}: {} in {:.1f} s{}'.format(
+                        board.port,
+                        board.result,
+                        board.duration(),
+                        ': {}'.format(board.error) if board.error else '',
+                    )
+                )
+            elif (
+                timeout
+                and not board.finished
+                and not board.timed_out
+                and board.process is not None
+                and board.duration(now) > timeout
+            ):
+                board.timed_out = True
+                board.error = 'Not flashed in {} s'.format(timeout)
+                board.process.kill()
+        if len(reported) == len(boards):
+            break
+        if now >= next_report:
+            print(format_progress(boards, now - start))
+            next_report = now + interval
+        time.sleep(0.1)
+
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - start
+
+
+def main():
+    description = (
+        'Flash SPI flash memory of many boards in parallel with mcom02-flash-spi: every port '
+        'is flashed by its own process, aggregated progress and table of results are printed.'
+    )
+    parser = argparse.ArgumentParser(
+        description=description, formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument(
+        'images',
+        nargs='+',
+        help='binary file for all boards or one file per port (in order of -p options, ports of '
+        'a glob pattern are sorted naturally: ttyUSB2 before ttyUSB10)',
+    )
+    parser.add_argument(
+        '-p',
+        dest='ports',
+        action='append',
+        required=True,
+        help='serial port or glob pattern (e.g. "/dev/ttyUSB*"), can be repeated',
+    )
+    parser.add_argument(
+        '-t',
+        '--timeout',
+        type=float,
+        default=1800,
+        help='maximum flashing time of a board in seconds, 0 - infinite',
+    )
+    parser.add_argument(
+        '-i', '--interval', type=float, default=5.0, help='progress report interval in seconds'
+    )
+    parser.add_argument(
+        '--tool-args', default='', help='additional arguments for mcom02-flash-spi (quoted)'
+    )
+    parser.add_argument('--log-dir', help='directory for output of mcom02-flash-spi per port')
+    parser.add_argument('--report', help='save results of the boards to JSON file')
+    parser.add_argument('--version', action='version', version=__version__)
+    args = parser.parse_args()
+
+    ports = expand_ports(args.ports)
+    if not ports:
+        parser.error('no serial ports match {}'.format(', '.join(args.ports)))
+    if len(args.images) not in (1, len(ports)):
+        parser.error(
+            'one image or one image per port is required ({} ports: {})'.format(
+                len(ports), ' '.join(ports)
+            )
+        )
+    for image in args.images:
+        if not os.path.exists(image):
+            eprint("File '{}' is not found".format(image))
+            sys.exit(1)
+    images = args.images * len(ports) if len(args.images) == 1 else args.images
+    if args.log_dir is not None:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    boards = [Board(port, image) for port, image in zip(ports, images)]
+    print('Flashing {} boards: {}'.format(len(boards), ' '.join(ports)))
+    if len(args.images) > 1:
+        for board in boards:
+            print('  {}: {}'.format(board.port, board.image))
+    wall_time = flash_fleet(
+        boards, shlex.split(args.tool_args), args.timeout, args.interval, args.log_dir
+    )
+    print_report(boards, wall_time)
+
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(
+                {'wall_time': wall_time, 'boards': [x.as_dict() for x in boards]}, f, indent=4
+            )
+
+    sys.exit(0 if all(x.result == 'OK' for x in boards) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+
+"""Streaming Intel-HEX encoder for BootROM upload.
+
+Binary data is encoded block by block directly from memoryview slices (e.g. of memory-mapped
+image file) into a reusable buffer, so host memory does not depend on image size.
+"""
+
+import binascii
+import mmap
+import os
+from contextlib import contextmanager
+
+RECORD_DATA = 0x00
+RECORD_EOF = 0x01
+RECORD_EXTENDED_LINEAR_ADDRESS = 0x04
+
+
+@contextmanager
+def map_file(file_name):
+    """Context manager returning read-only memoryview of the file mapped to memory."""
+    with open(file_name, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty file can not be mapped
+            yield memoryview(b'')
+            return
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield memoryview(mm)
+        finally:
+            try:
+                mm.close()
+            except BufferError:
+                # slices of the view are still alive, mapping is closed by garbage collector
+                pass
+
+
+def align_block(block):
+    """Return memoryview of `block` padded with 0xFF to 2 byte boundary (workaround for
+    rf#2088). Block of odd size is copied.
+    """
+    view = memoryview(block)
+    if len(view) % 2 != 0:
+        view = memoryview(bytes(view) + b'\xff')
+    return view
+
+
+class IHexEncoder(object):
+    """Encode binary blocks to Intel-HEX records (with end of file record).
+
+    Encoded data is placed to the buffer which is reused by the next encode() call.
+    """
+
+    def __init__(self, max_block_size, record_size=16, newline=b'\n'):
+        """Parameters
+        ----------
+        max_block_size : int
+            maximum size of block passed to encode()
+        record_size : int
+            count of data bytes per record
+        newline : bytes
+            record delimiter
+        """
+        # records must not cross 64 KiB boundary
+        assert 0x10000 % record_size == 0
+        self.record_size = record_size
+        self.newline = newline
+        self._buf = bytearray(self.encoded_size(max_block_size, 0xFFFF))
+
+    def record_len(self, size):
+        """Length of record with `size` data bytes."""
+        return 1 + 2 * (5 + size) + len(self.newline)
+
+    def encoded_size(self, size, base_addr):
+        """Maximum length of encoded block of `size` bytes at `base_addr`."""
+        full, rest = divmod(size, self.record_size)
+        data_len = full * self.record_len(self.record_size) + (rest and self.record_len(rest))
+        # extended linear address record per 64 KiB and at start, end of file record
+        segments = ((base_addr & 0xFFFF) + size) // 0x10000 + 1
+        return data_len + (segments + 1) * self.record_len(2)
+
+    def _record(self, pos, rtype, addr, data, hexdata):
+        """Put record to the buffer at `pos`. Return position after the record."""
+        size = len(data)
+        checksum = size + (addr >> 8 & 0xFF) + (addr & 0xFF) + rtype + sum(data)
+        buf = self._buf
+        buf[pos : pos + 9] = b':%02X%04X%02X' % (size, addr & 0xFFFF, rtype)
+        pos += 9
+        buf[pos : pos + len(hexdata)] = hexdata
+        pos += len(hexdata)
+        buf[pos : pos + 2] = b'%02X' % (-checksum & 0xFF)
+        pos += 2
+        buf[pos : pos + len(self.newline)] = self.newline
+        return pos + len(self.newline)
+
+    def encode(self, data, base_addr):
+        """Encode `data` (bytes-like object) to be loaded at `base_addr`.
+
+        Returns
+        -------
+        memoryview
+            encoded records, valid until the next encode() call
+        """
+        assert base_addr % self.record_size == 0
+        needed = self.encoded_size(len(data), base_addr)
+        if needed > len(self._buf):
+            self._buf.extend(bytes(needed - len(self._buf)))
+        view = memoryview(data)
+        hexdata = binascii.hexlify(view).upper()
+        pos = 0
+        # extended linear address is 0 by default
+        upper = 0
+        for offset in range(0, len(view), self.record_size):
+            addr = base_addr + offset
+            chunk = view[offset : offset + self.record_size]
+            if addr >> 16 != upper:
+                upper = addr >> 16
+                ela = upper.to_bytes(2, 'big')
+                pos = self._record(pos, RECORD_EXTENDED_LINEAR_ADDRESS, 0, ela, b'%04X' % upper)
+            hexchunk = hexdata[2 * offset : 2 * (offset + len(chunk))]
+            pos = self._record(pos, RECORD_DATA, addr, chunk, hexchunk)
+        pos = self._record(pos, RECORD_EOF, 0, b'', b'')
+        return memoryview(self._buf)[:pos]
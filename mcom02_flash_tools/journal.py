@@ -0,0 +1,98 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+
+"""Progress journal of mcom02-flash-spi.
+
+Journal is a JSON file stored per image, serial port and board (see journal_path()). It keeps
+state of every block written by BootROM: the file is rewritten after each commitspiflash,
+so the state survives loss of the link. The journal is valid only for the same layout of
+blocks (see Journal.params).
+"""
+
+import hashlib
+import json
+import os
+import re
+
+from mcom02_flash_tools.cache import default_cache_dir
+
+BLOCK_NONE = 0
+BLOCK_COMMITTED = 1
+BLOCK_VERIFIED = 2
+
+
+def default_journal_dir():
+    return os.path.join(default_cache_dir(), 'journal')
+
+
+def journal_path(directory, image, port, board, jedec_id):
+    """Return path of journal of `image` (bytes-like object) flashed via `port` to `board`
+    with flash memory `jedec_id`.
+    """
+    digest = hashlib.sha256(image).hexdigest()
+    # port is a path (e.g. /dev/ttyUSB0)
+    port, board = (re.sub(r'[^\w.-]', '_', x) for x in (port, board))
+    return os.path.join(directory, '{}-{}-{}-{:06x}.json'.format(digest, port, board, jedec_id))
+
+
+class Journal(object):
+    """State of blocks: BLOCK_NONE, BLOCK_COMMITTED (commitspiflash is done) or
+    BLOCK_VERIFIED (data is read back and compared).
+    """
+
+    def __init__(self, path, params, block_count):
+        """Parameters
+        ----------
+        path : str
+            journal file
+        params : dict
+            layout of blocks (e.g. block size), stored journal with other params is ignored
+        block_count : int
+            count of blocks
+        """
+        self.path = path
+        self.params = params
+        self.blocks = [BLOCK_NONE] * block_count
+        self.erased = False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            if data['params'] == params and len(data['blocks']) == block_count:
+                self.blocks = data['blocks']
+                self.erased = data['erased']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def committed(self):
+        """Return count of consecutive blocks committed from the start."""
+        for i, state in enumerate(self.blocks):
+            if state == BLOCK_NONE:
+                return i
+        return len(self.blocks)
+
+    def reset(self):
+        self.blocks = [BLOCK_NONE] * len(self.blocks)
+        self.erased = False
+        self.save()
+
+    def set_block(self, index, state):
+        self.blocks[index] = state
+        self.save()
+
+    def set_erased(self):
+        self.erased = True
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'params': self.params, 'blocks': self.blocks, 'erased': self.erased}, f)
+        os.replace(tmp, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
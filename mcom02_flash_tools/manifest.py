@@ -0,0 +1,154 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+
+"""Flash manifests of mcom02-flash-spi.
+
+Manifest is a YAML or JSON file with regions of flash memory written in one session. A region
+is a file or a fill with byte value. File paths are relative to the manifest:
+
+    regions:
+      - file: u-boot.img
+        offset: 0x0
+      - file: board.dtb
+        offset: 0x80000
+        size: 0x10000     # optional, maximum size of the file
+      - fill: 0xff
+        offset: 0xf0000
+        size: 0x10000
+
+Flash memory is erased by sectors, so every region must start at sector boundary and regions
+must not share sectors. YAML manifests require PyYAML.
+"""
+
+import json
+import os
+
+
+def parse_int(value, name):
+    """Return integer `value` of manifest field `name`, strings are parsed as Python
+    literals (e.g. "0x80000").
+    """
+    if isinstance(value, str):
+        try:
+            return int(value, 0)
+        except ValueError:
+            pass
+    elif isinstance(value, int) and not isinstance(value, bool):
+        return value
+    raise ValueError("{} must be integer, got {!r}".format(name, value))
+
+
+class Region(object):
+    """Region of flash memory: `size` bytes at `offset` filled from file `file_name` or with
+    byte `fill`.
+    """
+
+    def __init__(self, offset, size, file_name=None, fill=None):
+        self.offset = offset
+        self.size = size
+        self.file_name = file_name
+        self.fill = fill
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+    def __str__(self):
+        source = self.file_name if self.file_name is not None else "fill 0x{:02x}".format(self.fill)
+        return "{} at 0x{:x}, {} bytes".format(source, self.offset, self.size)
+
+    def read(self):
+        """Return data of the region."""
+        if self.file_name is None:
+            return bytes([self.fill]) * self.size
+        with open(self.file_name, 'rb') as f:
+            return f.read(self.size)
+
+
+class Manifest(object):
+    """Regions of flash memory sorted by offset."""
+
+    def __init__(self, regions):
+        self.regions = sorted(regions, key=lambda x: x.offset)
+
+    @classmethod
+    def load(cls, path):
+        """Load manifest from YAML or JSON (if `path` has .json extension) file. Raises
+        ValueError if the manifest is not valid.
+        """
+        with open(path) as f:
+            if path.endswith('.json'):
+                data = json.load(f)
+            else:
+                try:
+                    import yaml
+                except ImportError:
+                    raise ValueError("PyYAML is required for YAML manifests")
+                try:
+                    data = yaml.safe_load(f)
+                except yaml.YAMLError as e:
+                    raise ValueError(str(e))
+
+        if not isinstance(data, dict) or not isinstance(data.get('regions'), list):
+            raise ValueError("manifest must contain list of regions")
+        base = os.path.dirname(os.path.abspath(path))
+        regions = []
+        for i, item in enumerate(data['regions']):
+            name = "region {}".format(i + 1)
+            if not isinstance(item, dict) or ('file' in item) == ('fill' in item):
+                raise ValueError("{} must have either file or fill".format(name))
+            offset = parse_int(item.get('offset'), "{} offset".format(name))
+            size = item.get('size')
+            if size is not None:
+                size = parse_int(size, "{} size".format(name))
+            if 'fill' in item:
+                fill = parse_int(item['fill'], "{} fill".format(name))
+                if not 0 <= fill <= 0xFF:
+                    raise ValueError("{} fill must be a byte value".format(name))
+                if size is None:
+                    raise ValueError("{} size is required for fill".format(name))
+                regions.append(Region(offset, size, fill=fill))
+                continue
+            file_name = os.path.join(base, str(item['file']))
+            try:
+                file_size = os.path.getsize(file_name)
+            except OSError:
+                raise ValueError("{} file '{}' is not found".format(name, file_name))
+            if size is not None and file_size > size:
+                raise ValueError(
+                    "{} file '{}' is larger than region size 0x{:x}".format(name, file_name, size)
+                )
+            regions.append(Region(offset, file_size, file_name=file_name))
+        if not regions:
+            raise ValueError("manifest must contain list of regions")
+        return cls(regions)
+
+    def validate(self, sector_size):
+        """Raise ValueError if regions are not aligned to `sector_size` or share sectors."""
+        prev = None
+        for region in self.regions:
+            if region.offset < 0 or region.size <= 0:
+                raise ValueError("region {} is empty or has negative offset".format(region))
+            if region.offset % sector_size != 0:
+                raise ValueError(
+                    "region {} is not aligned to sector size 0x{:x}".format(region, sector_size)
+                )
+            if prev is not None and -(-prev.end // sector_size) * sector_size > region.offset:
+                raise ValueError("regions {} and {} overlap".format(prev, region))
+            prev = region
+
+    def build_image(self):
+        """Return image with data of regions (gaps are filled with 0xFF), list of (offset,
+        size) of regions with data and list of regions filled with 0xFF.
+        """
+        image = bytearray(b'\xff' * max(x.end for x in self.regions))
+        regions = []
+        fills = []
+        for region in self.regions:
+            if region.fill == 0xFF:
+                fills.append((region.offset, region.size))
+                continue
+            image[region.offset : region.end] = region.read()
+            regions.append((region.offset, region.size))
+        return image, regions, fills
@@ -10,18 +10,22 @@ import sys
 import serial
 
 import mcom02_flash_tools
+from mcom02_flash_tools.daemon import close_uart, forward_job, open_uart
+from mcom02_flash_tools.trace import trace_run
+from mcom02_flash_tools.transcript import is_replay_port
+
+# Arguments with paths resolved by the client of mcom02-flash-daemon
+PATH_ARGS = ('trace', 'prometheus', 'record')
 
 
 def spi_probe(console, spi_bus_cs):
     console.run_with_retcode('sf probe {}:{}'.format(*spi_bus_cs), errmsg='SPI Flash probe error')
 
 
-def spi_unlock(console):
-    rc, _ = console.run_with_retcode(
-        'sf protect unlock ${factoryoffset} ${factorysize}', check=False
-    )
+def spi_unlock(console, offset='${factoryoffset}', size='${factorysize}'):
+    rc, _ = console.run_with_retcode('sf protect unlock {} {}'.format(offset, size), check=False)
     if rc:
-        print(
+        mcom02_flash_tools.progress(
             'Warning: Can not disable SPI Flash software write protection.\n'
             '  Software write protection is already disabled or write protection jumper is set.\n'
             '  If flashing will fail then check write protection jumper.'
@@ -32,92 +36,33 @@ def spi_lock(console):
     console.run_with_retcode('sf protect lock ${factoryoffset} ${factorysize}')
 
 
-def cmd_flash(console, args):
-    keys = []
-    for var in args.setting:
-        key, value = var
-        keys.append(key)
-        console.run_with_retcode('setenv {} {}'.format(key, value))
-
-    console.run_with_retcode(
-        'env export -c -s ${{factorysize}} ${{loadaddr}} {}'.format(' '.join(keys))
-    )
-    spi_probe(console, args.spi)
-    spi_unlock(console)
-    console.run_with_retcode(
-        'sf update ${loadaddr} ${factoryoffset} ${factorysize}',
-        errmsg='Flashing error. Please check write protection jumper.',
-    )
-    if args.lock:
-        spi_lock(console)
+def cmd_flash(session, args):
+    session.factory_flash(dict(args.setting), args.spi, args.lock)
     if args.verbose:
         print('')
     print('Factory settings successfully flashed')
 
 
-def cmd_clear(console, args):
-    spi_probe(console, args.spi)
-    spi_unlock(console)
-    console.run_with_retcode(
-        'sf erase ${factoryoffset} ${factorysize}',
-        errmsg='Factory settings clear error. Please check write protection ' 'jumper.',
-    )
-    if args.lock:
-        spi_lock(console)
+def cmd_clear(session, args):
+    session.factory_clear(args.spi, args.lock)
     if args.verbose:
         print('')
     print('Factory settings successfully cleared')
 
 
-def cmd_print(console, args):
-    def get_var_int(name):
-        _, resp = console.run_with_retcode('env print {}'.format(name))
-        _, value = resp.split('=', 1)
-        return int(value, 16)
-
-    # backup original environment
-    loadaddr = get_var_int('loadaddr')
-    factorysize = get_var_int('factorysize')
-
-    # env_backup_size must be equal to CONFIG_ENV_SIZE but this value is unavailable
-    # from U-Boot command line. Using factorysize because factorysize equal to sector size.
-    env_backup_size = factorysize
-    env_backup_addr = loadaddr + factorysize
-
-    # BUG: env export command will create incorrect buffer if used CONFIG_SYS_REDUNDAND_ENVIRONMENT
-    console.run_with_retcode(
-        'env export -c -s {:#x} {:#x}'.format(env_backup_size, env_backup_addr)
-    )
-    spi_probe(console, args.spi)
-    console.run_with_retcode(
-        'sf read ${loadaddr} ${factoryoffset} ${factorysize}', errmsg='Read from SPI Flash error'
-    )
-    retcode, _ = console.run_with_retcode(
-        'env import -d -c ${loadaddr} ${factorysize}', check=False
-    )
-    if retcode:
+def cmd_print(session, args):
+    settings = session.factory_read(args.spi).settings
+    if settings is None:
         print('{}' if args.json else 'Factory settings sector is null or corrupted')
         return
 
-    _, resp = console.run_with_retcode('env print')
-
-    # restore original environment
-    console.run_with_retcode(
-        'env import -d -c {:#x} {:#x}'.format(env_backup_addr, env_backup_size)
-    )
-    resp = resp.split('\n\n')[0]
     if args.verbose:
         print('')
     if args.json:
-        variables_list = resp.split('\n')
-        variables = {}
-        for s in variables_list:
-            name, value = s.split('=', 1)
-            variables[name] = value
-        print(json.dumps(variables, sort_keys=True, indent=4))
+        print(json.dumps(settings, sort_keys=True, indent=4))
     else:
         print('Factory settings:\n')
-        print(resp)
+        print('\n'.join('{}={}'.format(name, value) for name, value in settings.items()))
 
 
 def main():
@@ -158,6 +103,56 @@ def main():
         action='store_true',
         help='verbose mode (will show all UART transactions)',
     )
+    parser.add_argument(
+        '-b',
+        '--baudrate',
+        type=int,
+        default=115200,
+        help='maximum UART baudrate, if greater than 115200 then the fastest reliable baudrate '
+        'is negotiated with U-Boot and the original one is restored on exit',
+    )
+    parser.add_argument(
+        '-w',
+        '--window',
+        type=int,
+        default=1,
+        help='count of fast U-Boot commands (e.g. setenv) sent without waiting for the prompt, '
+        'greater than 1 enables pipelining which requires the terminal to buffer the input '
+        'while a command is executed',
+    )
+    parser.add_argument(
+        '--retcode-mode',
+        choices=['auto', 'inline', 'separate'],
+        default='auto',
+        help='how to get return codes of U-Boot commands: inline - in the same round trip '
+        'as the command, separate - with "echo $?" command, auto - inline if supported',
+    )
+    parser.add_argument(
+        '--async-uart',
+        action='store_true',
+        help='use asyncio UART transport: the port is read when data is received instead of '
+        'polling with timeout',
+    )
+    parser.add_argument(
+        '--no-daemon',
+        action='store_true',
+        help='run in this process even if mcom02-flash-daemon is running',
+    )
+    parser.add_argument(
+        '--trace',
+        metavar='FILE',
+        help='save timeline of U-Boot commands to Chrome trace JSON file (open in '
+        'chrome://tracing or ui.perfetto.dev) and print summary with latency histogram',
+    )
+    parser.add_argument(
+        '--prometheus', metavar='FILE', help='save metrics of the run to Prometheus textfile'
+    )
+    parser.add_argument(
+        '--record',
+        metavar='FILE',
+        help='record data sent and received by UART to transcript FILE, the transcript is '
+        'replayed with -p replay:FILE[@SPEED]',
+    )
     parser.add_argument('--version', action='version', version=mcom02_flash_tools.__version__)
     subparsers = parser.add_subparsers(dest='command', help='commands')
     parser_flash = subparsers.add_parser(
@@ -187,27 +182,66 @@ def main():
         '-j', '--json', action='store_true', help='output settings in JSON format'
     )
     args = parser.parse_args()
+    if args.async_uart and (args.record or is_replay_port(args.port)):
+        parser.error('--async-uart can not be used with --record and replay of transcript')
+
+    if not args.no_daemon:
+        retcode = forward_job('mcom02_flash_factory', args, PATH_ARGS)
+        if retcode is not None:
+            sys.exit(retcode)
+    run(args)
 
+
+def run(args):
+    """Run command with parsed arguments `args` (job of mcom02-flash-daemon)."""
+    labels = {'tool': 'mcom02-flash-factory', 'port': args.port, 'command': args.command}
+    with trace_run(args.trace, args.prometheus, labels):
+        _run(args)
+
+
+def _run(args):
+    # mcom02_flash_tools.api imports this module
+    from mcom02_flash_tools import api
+
+    uart_class = mcom02_flash_tools.UART
+    if args.async_uart:
+        # asyncio is not imported by clients of mcom02-flash-daemon
+        from mcom02_flash_tools.aio import SyncUART
+
+        uart_class = SyncUART
     try:
-        console = mcom02_flash_tools.UART(prompt='\nmcom# ', port=args.port, verbose=args.verbose)
+        console = open_uart(
+            uart_class,
+            args.port,
+            verbose=args.verbose,
+            window=args.window,
+            retcode_mode=args.retcode_mode,
+            record=args.record,
+            **api.uart_options(api.UBOOT),
+        )
     except serial.SerialException as e:
         mcom02_flash_tools.eprint(e)
         sys.exit(1)
 
     show_waiting_status = args.command != 'print' or not args.json
-    ok = console.wait_for_uboot(timeout=args.timeout, show_status=show_waiting_status)
-    if not ok:
-        mcom02_flash_tools.eprint(
-            'U-Boot terminal does not respond. Set the boot mode to SPI '
-            'and reset the board power (do not use warm reset).'
-        )
-        sys.exit(1)
+    session = api.FlashSession(console, api.UBOOT, progress=print if show_waiting_status else None)
     command_functions = {
         'flash': cmd_flash,
         'clear': cmd_clear,
         'print': cmd_print,
     }
-    command_functions[args.command](console, args)
+    try:
+        session.connect(timeout=args.timeout)
+        session.set_baudrate(args.baudrate)
+        command_functions[args.command](session, args)
+    except mcom02_flash_tools.FlashToolsError as e:
+        mcom02_flash_tools.eprint(e)
+        sys.exit(1)
+    finally:
+        try:
+            session.close()
+        finally:
+            close_uart(console)
 
 
 if __name__ == '__main__':
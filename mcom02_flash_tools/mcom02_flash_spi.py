@@ -5,36 +5,178 @@
 
 # SPDX-License-Identifier: MIT
 
+import itertools
 import os
 import platform
 import struct
 import sys
+import time
+import weakref
+import zlib
 from argparse import ArgumentParser
-from io import StringIO
+from contextlib import contextmanager
 
-from intelhex import IntelHex
 from serial import SerialException
 
-from mcom02_flash_tools import UART, __version__, eprint
+from mcom02_flash_tools import (
+    UART,
+    CommandError,
+    FlashMemoryError,
+    FlashToolsError,
+    VerificationError,
+    __version__,
+    eprint,
+    progress,
+)
+from mcom02_flash_tools.cache import BlockCache, default_cache_dir
+from mcom02_flash_tools.daemon import close_uart, forward_job, open_uart
+from mcom02_flash_tools.flash_chips import UNLOCK_GLOBAL, find_chip
+from mcom02_flash_tools.ihex import IHexEncoder, align_block, map_file
+from mcom02_flash_tools.journal import BLOCK_COMMITTED, BLOCK_NONE, BLOCK_VERIFIED
+from mcom02_flash_tools.manifest import Manifest
+from mcom02_flash_tools.profile import Profile, default_profile_path
+from mcom02_flash_tools.stub import FlasherStub
+from mcom02_flash_tools.trace import span, trace_run
+from mcom02_flash_tools.transcript import is_replay_port
 
+# RAM area for Intel-HEX blocks written to flash by commitspiflash
+UPLOAD_BASE_ADDR = 0x20000000
+UPLOAD_BLOCK_SIZE = 0xC000
+CHECK_BLOCK_SIZE = 0x2000
+# Block sizes measured by --autotune. The sizes are even (see rf#2088), upload block
+# must fit in the RAM area.
+UPLOAD_BLOCK_SIZES = (0x2000, 0x4000, 0x8000, 0xC000)
+CHECK_BLOCK_SIZES = (0x800, 0x1000, 0x2000, 0x4000)
+# UART baudrate of BootROM terminal
+BAUDRATE = 115200
+# Size of SPI flash sector erased by sector erase command (0xD8)
+SECTOR_SIZE = 0x10000
+# Size of flash memory addressed by 3-byte addresses of SPI commands
+ADDRESS_SPACE_SIZE = 0x1000000
+# Line delimiter of BootROM terminal
+NEWLINE = '\n'
+# Length of dumpspiflash output line "0x%08x : 0x%08x\r\n"
+DUMP_LINE_LEN = 25
+# Arguments with paths resolved by the client of mcom02-flash-daemon
+PATH_ARGS = ('file_name', 'stub', 'cache_dir', 'profile', 'trace', 'prometheus', 'record')
 
-def send_cmd(tty, cmd):
-    res = tty.run(cmd, timeout=10, strip_echo=False)
+
+def check_response(cmd, res):
+    """Return error message if BootROM response `res` on `cmd` is incorrect, None otherwise."""
     if res is None:
-        eprint("Device does not respond on {}".format(cmd))
-        sys.exit(1)
+        return "Device does not respond on {}".format(cmd)
     if res.strip() == '#':
-        eprint("BootROM received empty response")
-        sys.exit(1)
+        return "BootROM received empty response"
     if "Incorrect command" in res:
-        eprint("BootROM received incorrect command:\n{}".format(res))
-        sys.exit(1)
+        return "BootROM received incorrect command:\n{}".format(res)
     if cmd not in res:
-        eprint("BootROM received incorrect command arguments:\n{}".format(res))
-        sys.exit(1)
+        return "BootROM received incorrect command arguments:\n{}".format(res)
+    return None
+
+
+def send_cmd(tty, cmd, timeout=10):
+    res = tty.run(cmd, timeout=timeout, strip_echo=False)
+    error = check_response(cmd, res)
+    if error is not None:
+        raise CommandError(error)
     return res
 
 
+def send_cmds(tty, cmds):
+    """Send commands pipelined (see UART.run_batch()). Return list of responses."""
+    resps = tty.run_batch(cmds, timeout=10, strip_echo=False)
+    for cmd, res in zip(cmds, resps):
+        error = check_response(cmd, res)
+        if error is not None:
+            raise CommandError(error)
+    return resps
+
+
+def _set_cmd(addr, val):
+    # We must not use 0x prefix for hexadecimals.
+    # See MCom-02 errata rf#1354
+    return "set {:x} {:x}".format(addr, val)
+
+
+def _parse_dump(resp):
+    resp = resp.split('\n')[2:][0]
+    return int(resp.split(' : ')[1], 0)
+
+
+class BootROMRegisters(object):
+    """Register access via MCom-02 BootROM terminal.
+
+    Writes are queued and sent in one pipelined burst (see send_cmds()) together with the next
+    read or by flush(). Written and read values are kept in `shadow`: a write of the known
+    value is not sent and a read of the known register does not need a round trip. Registers
+    in `volatile` (e.g. FIFO data and level registers) are never shadowed.
+    """
+
+    def __init__(self, tty, volatile=(), shadow=None):
+        """Parameters
+        ----------
+        tty : UART
+            BootROM terminal
+        volatile : iterable
+            addresses of registers which are always accessed
+        shadow : dict
+            known register values (address to value), the dict is updated
+        """
+        self.tty = tty
+        self.volatile = set(volatile)
+        self.shadow = shadow if shadow is not None else {}
+        self._queue = []
+
+    def invalidate(self, keep=()):
+        """Forget shadow values of all registers except `keep` addresses."""
+        for addr in list(self.shadow):
+            if addr not in keep:
+                del self.shadow[addr]
+
+    def write(self, addr, val):
+        if addr not in self.volatile:
+            if self.shadow.get(addr) == val:
+                return
+            self.shadow[addr] = val
+        self._queue.append(_set_cmd(addr, val))
+
+    def write_many(self, values):
+        """Queue writes of list of (addr, val) pairs"""
+        for addr, val in values:
+            self.write(addr, val)
+
+    def read(self, addr):
+        return self.read_many([addr])[0]
+
+    def read_many(self, addrs):
+        """Return values of registers at `addrs`. Queued writes and reads of unknown
+        registers are sent in one burst.
+        """
+        unknown = [x for x in addrs if x in self.volatile or x not in self.shadow]
+        if not unknown:
+            return [self.shadow[addr] for addr in addrs]
+        cmds = self._queue + ["dump {:x} 1".format(addr) for addr in unknown]
+        self._queue = []
+        resps = send_cmds(self.tty, cmds)[len(cmds) - len(unknown) :]
+        values = iter(_parse_dump(resp) for resp in resps)
+        result = []
+        for addr in addrs:
+            if addr in self.volatile or addr not in self.shadow:
+                value = next(values)
+                if addr not in self.volatile:
+                    self.shadow[addr] = value
+            else:
+                value = self.shadow[addr]
+            result.append(value)
+        return result
+
+    def flush(self):
+        """Send queued writes."""
+        if self._queue:
+            send_cmds(self.tty, self._queue)
+            self._queue = []
+
+
 class SPI0Controller(object):
     """Manage SPI controller via MCom-02 BootROM terminal"""
 
@@ -52,167 +194,592 @@ class SPI0Controller(object):
     DR = 0x38032060
     SS_TOGGLE = 0x380320F4
     FRAME_SIZE_8BIT = 0x7
+    # SPI clock divider: 12 MHz
+    BAUDR_DIV = 2
+
+    # Known values of registers per terminal. Clock gating and pin function registers are
+    # not changed by BootROM, so they are not read again by the next session. SPI0 registers
+    # are changed by BootROM flash commands (commitspiflash, dumpspiflash).
+    _shadows = weakref.WeakKeyDictionary()
 
     def __init__(self, tty):
         self.tty = tty
+        self.regs = BootROMRegisters(
+            tty, volatile=(self.RXFLR, self.DR), shadow=self._shadows.setdefault(tty, {})
+        )
 
     def write_reg(self, addr, val):
-        # We must not use 0x prefix for hexadecimals.
-        # See MCom-02 errata rf#1354
-        send_cmd(self.tty, "set {:x} {:x}".format(addr, val))
+        self.regs.write(addr, val)
+        self.regs.flush()
+
+    def write_regs(self, values):
+        """Write list of (addr, val) pairs with pipelined commands"""
+        self.regs.write_many(values)
+        self.regs.flush()
 
     def read_reg(self, addr):
-        resp = send_cmd(self.tty, "dump {:x} 1".format(addr))
-        resp = resp.split('\n')[2:][0]
-        return int(resp.split(' : ')[1], 0)
+        return self.regs.read(addr)
+
+    def read_regs(self, addrs):
+        return self.regs.read_many(addrs)
 
     def __enter__(self):
         """Enable SPI clock, setup pins to SPI mode and setup SPI controller"""
-        self.write_reg(self.GATE_SYS_CTR, self.read_reg(self.GATE_SYS_CTR) | self.CLK_SPI0_EN)
+        self.regs.invalidate(keep=(self.GATE_SYS_CTR, self.SWPORTD_CTL))
+        gate_sys_ctr, swportd_ctl = self.regs.read_many([self.GATE_SYS_CTR, self.SWPORTD_CTL])
         gpiod_ctl_value = (1 << 15) | (1 << 16) | (1 << 17) | (1 << 18)
-        self.write_reg(self.SWPORTD_CTL, self.read_reg(self.SWPORTD_CTL) | gpiod_ctl_value)
-        self.write_reg(self.SSIENR, 0)
-        self.write_reg(self.CTRL0, self.FRAME_SIZE_8BIT)
-
-        # Use very small SPI frequency (1 kHz) because SPI controller will deassert SS signal
-        # when TX FIFO will be empty. Data must pass through UART faster than through SPI.
-        self.write_reg(self.BAUDR, 24000)
-        self.write_reg(self.TXFTLR, 256)
-        self.write_reg(self.RXFTLR, 256)
-        self.write_reg(self.SS_TOGGLE, 0)
+        # The writes are sent with the first transfer
+        self.regs.write_many(
+            [
+                (self.GATE_SYS_CTR, gate_sys_ctr | self.CLK_SPI0_EN),
+                (self.SWPORTD_CTL, swportd_ctl | gpiod_ctl_value),
+                (self.SSIENR, 0),
+                (self.SER, 0),
+                (self.CTRL0, self.FRAME_SIZE_8BIT),
+                (self.BAUDR, self.BAUDR_DIV),
+                (self.TXFTLR, 256),
+                (self.RXFTLR, 256),
+                (self.SS_TOGGLE, 0),
+            ]
+        )
 
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        """Restore SPI frequency"""
-        self.write_reg(self.BAUDR, 2)  # back SPI frequency to 12 MHz
+        """Send queued writes"""
+        self.regs.flush()
 
     def transfer(self, send_data, receive_count):
-        """Select SS0, transmit 'send_data' and receive 'receive_count' bytes"""
-
-        def read_byte():
-            while self.read_reg(self.RXFLR) == 0:
-                pass
-            return self.read_reg(self.DR) & 0xFF
-
-        self.write_reg(self.CTRL1, len(send_data) + receive_count)
-        self.write_reg(self.SSIENR, 1)
-        self.write_reg(self.SER, 0x1)
-        for b in send_data:
-            self.write_reg(self.DR, b)
-        for _ in range(receive_count):
-            self.write_reg(self.DR, 0)
+        """Select SS0, transmit 'send_data' and receive 'receive_count' bytes.
 
-        for _ in send_data:
-            read_byte()
+        TX FIFO is filled before SS0 is selected, so the transfer is not interrupted at any
+        SPI frequency. Transfer without receive is queued (see BootROMRegisters) and is sent
+        with the next register access. Received bytes are read by polls of RXFLR, each poll
+        drains all bytes of RX FIFO with pipelined reads of DR.
+        """
+        count = len(send_data) + receive_count
+        values = [
+            (self.CTRL1, count),
+            (self.SSIENR, 1),
+        ]
+        values += [(self.DR, b) for b in send_data]
+        values += [(self.DR, 0)] * receive_count
+        values += [(self.SER, 0x1)]
+        self.regs.write_many(values)
 
         rcv_data = []
-        for _ in range(receive_count):
-            rcv_data.append(read_byte())
+        if receive_count:
+            with span('spi_transfer', 'spi', send=len(send_data), receive=receive_count):
+                while len(rcv_data) < count:
+                    level = min(self.regs.read(self.RXFLR), count - len(rcv_data))
+                    rcv_data += [x & 0xFF for x in self.regs.read_many([self.DR] * level)]
 
-        self.write_reg(self.SSIENR, 0)
+        # SS0 is changed only while the controller is disabled
+        self.regs.write_many([(self.SSIENR, 0), (self.SER, 0)])
 
-        return rcv_data
+        return rcv_data[len(send_data) :]
 
 
-def send_ihex(tty, ihex):
-    sio = StringIO()
-    ihex.write_hex_file(sio)
-    sio.seek(0)
-    res = tty.run(sio.read().strip())
-    if res is None:
-        eprint("The device does not respond on writing a file")
-        sys.exit(1)
+def send_ihex(tty, records):
+    """Send Intel-HEX records (see IHexEncoder) and wait for prompt"""
+    with span('send_ihex', tx=len(records), baudrate=tty.tty.baudrate) as s:
+        tty.tty.write(records)
+        success, res = tty.wait_for_string(tty.prompt, timeout=5)
+        s.set(rx=len(res))
+    if not success:
+        raise CommandError("The device does not respond on writing a file")
     return res
 
 
-def split_bin_to_ihex(file_name, base_addr, max_block_size):
-    """Split a binary file to the blocks and load the blocks to IntelHex
-    objects. Return the list of IntelHex objects.
+def erased_sectors(image, sector_size=SECTOR_SIZE, erased=0xFF):
+    """Return offsets of sectors which contain only `erased` bytes. Incomplete last sector is
+    not included: data after the image end is not erased.
+    """
+    erased = bytes([erased]) * sector_size
+    return [
+        offset
+        for offset in range(0, len(image) - sector_size + 1, sector_size)
+        if image[offset : offset + sector_size] == erased
+    ]
+
+
+def data_ranges(size, skipped=(), sector_size=SECTOR_SIZE):
+    """Return list of (offset, size) ranges of `size` bytes excluding sectors at `skipped`
+    offsets.
+    """
+    return exclude_sectors([(0, size)], skipped, sector_size)
+
+
+def exclude_sectors(ranges, skipped, sector_size=SECTOR_SIZE):
+    """Return list of (offset, size) ranges of `ranges` excluding sectors at `skipped`
+    offsets.
     """
-    # Block size must be aligned to 2 byte boundary (workaround for rf#2088)
-    assert max_block_size % 2 == 0
-    ihex_list = []
-    with open(file_name, 'rb') as f:
+    skipped = sorted(skipped)
+    result = []
+    for start, length in ranges:
+        end = start + length
+        for offset in skipped:
+            if offset + sector_size <= start or offset >= end:
+                continue
+            if offset > start:
+                result.append((start, offset - start))
+            start = offset + sector_size
+        if end > start:
+            result.append((start, end - start))
+    return result
+
+
+def image_layout(image, regions=None, fills=(), sparse=False, chip=None):
+    """Return ranges of `image` to write (see data_ranges()) and sorted offsets of sectors to
+    erase.
+
+    Parameters
+    ----------
+    image : bytes-like object
+        image of flash memory
+    regions : list
+        (offset, size) of regions to write, the whole image by default
+    fills : list
+        (offset, size) of regions filled with 0xFF, their sectors are erased
+    sparse : bool
+        if True then sectors of `regions` filled with erased value are erased instead of
+        writing
+    chip : FlashChip
+        sector size and erased value of flash memory, 64 KiB sectors erased to 0xFF by default
+    """
+    sector_size, erased = (chip.sector_size, chip.erased) if chip else (SECTOR_SIZE, 0xFF)
+    if regions is None:
+        regions = [(0, len(image))]
+    skipped = set()
+    for offset, size in fills:
+        skipped.update(range(offset - offset % sector_size, offset + size, sector_size))
+    if sparse:
+        skipped.update(
+            x
+            for x in erased_sectors(image, sector_size, erased)
+            if any(start <= x and x + sector_size <= start + size for start, size in regions)
+        )
+    skipped = sorted(skipped)
+    return exclude_sectors(regions, skipped, sector_size), skipped
+
+
+@contextmanager
+def load_image(file_name, manifest=None):
+    """Context manager returning image, regions and fills (see image_layout()) of the file or
+    of the `manifest` (see Manifest) if specified.
+    """
+    if manifest is None:
+        with map_file(file_name) as image:
+            yield image, None, ()
+    else:
+        yield manifest.build_image()
+
+
+def clip_ranges(ranges, size):
+    """Return part of `ranges` below `size`."""
+    return [(start, min(length, size - start)) for start, length in ranges if start < size]
+
+
+def split_ranges(ranges, block_size, boundary=None):
+    """Yield (offset, size) of blocks of `ranges`. `block_size` is size of blocks or iterator
+    of sizes of consecutive blocks. If `boundary` is specified then blocks do not cross
+    multiples of `boundary` (e.g. flash sector boundaries).
+    """
+    sizes = itertools.repeat(block_size) if isinstance(block_size, int) else block_size
+    for start, length in ranges:
+        offset = start
+        while offset < start + length:
+            size = min(next(sizes), start + length - offset)
+            if boundary is not None:
+                size = min(size, boundary - offset % boundary)
+            yield offset, size
+            offset += size
+
+
+def encode_upload(image, newline, blocks):
+    """Yield Intel-HEX records of the image `blocks` (see split_ranges()) uploaded to RAM one
+    by one. The blocks are encoded while the file is sent, records are valid until the next
+    block is requested.
+    """
+    encoder = IHexEncoder(max(UPLOAD_BLOCK_SIZES), newline=newline)
+    for offset, size in blocks:
+        yield encoder.encode(align_block(image[offset : offset + size]), UPLOAD_BASE_ADDR)
+
+
+def prepare_cache(cache, image, newline, ranges, upload_size=UPLOAD_BLOCK_SIZE, boundary=None):
+    """Return cache entry with Intel-HEX records ('upload' stream) of `ranges` (see
+    data_ranges()) of the image split by split_ranges(). The entry is created if the cache
+    does not have it.
+    """
+    key = BlockCache.key(
+        image,
+        '{:x}'.format(UPLOAD_BASE_ADDR),
+        '{:x}'.format(upload_size),
+        '{:x}'.format(boundary or 0),
+        newline.hex(),
+        '{:08x}'.format(zlib.crc32(repr(ranges).encode())),
+    )
+    entry = cache.get(key)
+    if entry is None:
+        progress("Preparing image cache...")
+        entry = cache.put(
+            key,
+            {'upload': encode_upload(image, newline, split_ranges(ranges, upload_size, boundary))},
+        )
+    return entry
+
+
+def erase_sectors(tty, offsets):
+    """Erase flash sectors at `offsets` with commands sent through SPI0 controller."""
+    CMD_READ_STATUS = 0x5
+    CMD_WRITE_ENABLE = 0x6
+    CMD_SECTOR_ERASE = 0xD8
+    STATUS_BUSY = 0x1
+    # Maximum sector erase time of supported memories is 3 s
+    ERASE_TIMEOUT = 10
+
+    # Checked before the first sector is erased, so the flash is not left half-erased
+    for offset in offsets:
+        if not 0 <= offset < ADDRESS_SPACE_SIZE:
+            raise FlashMemoryError(
+                "Sector offset 0x{:x} is beyond 3-byte addressing (0x{:x} bytes)".format(
+                    offset, ADDRESS_SPACE_SIZE
+                )
+            )
+
+    with SPI0Controller(tty) as spi:
+        for i, offset in enumerate(offsets):
+            progress("Erasing sector: {}/{}, offset: 0x{:x}".format(i + 1, len(offsets), offset))
+            spi.transfer([CMD_WRITE_ENABLE], 0)
+            spi.transfer([CMD_SECTOR_ERASE] + list(offset.to_bytes(3, 'big')), 0)
+            time_end = time.monotonic() + ERASE_TIMEOUT
+            while spi.transfer([CMD_READ_STATUS], 1)[0] & STATUS_BUSY:
+                if time.monotonic() > time_end:
+                    raise FlashMemoryError("Sector erase at 0x{:x} is not completed".format(offset))
+
+
+def write_bin_to_flash(
+    tty,
+    image,
+    ranges,
+    block_size=UPLOAD_BLOCK_SIZE,
+    cached=None,
+    tuner=None,
+    verify_size=None,
+    retries=0,
+    journal=None,
+    start=0,
+    boundary=None,
+):
+    """Write `ranges` (see data_ranges()) of `image` (bytes-like object) to flash by blocks
+    of `block_size` which do not cross multiples of `boundary`. Intel-HEX records are taken
+    from `cached` entry (see prepare_cache()) if specified. If `tuner` (see Autotuner) is
+    specified then its block sizes are used and throughput is measured.
+
+    If `verify_size` is specified then every block is read back by dumpspiflash blocks of
+    `verify_size` right after commitspiflash. Block with wrong data is written again up to
+    `retries` times, writing is stopped if the block is still wrong.
+
+    State of every written block is stored to `journal` (see Journal) if specified. Blocks
+    before index `start` are not written (they are written by the interrupted run).
+
+    Returns
+    -------
+    list
+        dict per block: 'offset', 'size', 'attempts' (0 if the block is not written),
+        'verified' (None if the block is not read back) and 'skipped' (True if the block is
+        before `start`)
+    """
+    if tuner is not None:
+        block_size = tuner.block_sizes()
+    blocks = list(split_ranges(ranges, block_size, boundary))
+    if cached is not None:
+        uploads = itertools.islice(cached.chunks('upload'), start, None)
+    else:
+        uploads = encode_upload(image, tty.newline.encode(), blocks[start:])
+    report = [
+        {'offset': offset, 'size': size, 'attempts': 0, 'verified': None, 'skipped': i < start}
+        for i, (offset, size) in enumerate(blocks)
+    ]
+    if journal is not None:
+        for block, state in zip(report[:start], journal.blocks):
+            block['verified'] = True if state == BLOCK_VERIFIED else None
+    flash_offset = None
+    for i, (block, records) in enumerate(zip(report[start:], uploads), start):
+        # Size is aligned to 2 byte boundary (see align_block())
+        block_size = block['size'] + block['size'] % 2
+        progress("Block: {}/{}, size: {}".format(i + 1, len(blocks), block_size))
         while True:
-            block = bytearray(f.read(max_block_size))
-            if not block:
+            # BootROM moves flash offset after commitspiflash
+            if block['offset'] != flash_offset:
+                send_cmd(tty, "setflash {:x}".format(block['offset']))
+            write_start = time.monotonic()
+            send_ihex(tty, records)
+            send_cmd(tty, "commitspiflash {:x} {:x}".format(UPLOAD_BASE_ADDR, block_size))
+            if tuner is not None:
+                tuner.add(block_size, time.monotonic() - write_start)
+            flash_offset = block['offset'] + block_size
+            block['attempts'] += 1
+            if verify_size is None:
                 break
-            # Align the last block to 2 byte boundary (workaround for rf#2088)
-            if len(block) % 2 != 0:
-                block.append(0xFF)
-            ihex = IntelHex()
-            ihex.frombytes(block, base_addr)
-            ihex_list.append(ihex)
-    return ihex_list
-
-
-def write_bin_to_flash(tty, file_name):
-    base_addr = 0x20000000
-    max_block_size = 0xC000
-    ihex_list = split_bin_to_ihex(file_name, base_addr, max_block_size)
-    send_cmd(tty, "setflash 0")
-    for i, ihex in enumerate(ihex_list):
-        print("Block: {}/{}, size: {}".format(i + 1, len(ihex_list), len(ihex)))
-        send_ihex(tty, ihex)
-        send_cmd(tty, "commitspiflash {:x} {:x}".format(base_addr, len(ihex)))
-
-
-def dump2bytes(list_string):
-    # BootROM rev.0 prints additional string "Config spi0... Ok" before data
-    # so we have to filter this string out
-    if not list_string[0].startswith("0x"):
-        list_string = list_string[1:]
-
-    bytes = bytearray()
-    for s in list_string:
-        addr, word = s.split(' : ')
-        bytes += bytearray(struct.pack('<I', int(word, 0)))
-    return bytes
-
-
-def check_block(tty, data, offset, size):
-    dump_count = int((size + 3) / 4)
-    dump = send_cmd(tty, "dumpspiflash {:x} {:x}".format(offset, dump_count))
-    received = dump2bytes(dump.split("\n")[2:][:-1])
-    return received[:size] == data[offset:][:size]
-
-
-def check_file(tty, file_name, count):
-    max_block_size = 0x2000
-    with open(file_name, 'rb') as f:
-        if count is None:
-            data = f.read()
-        else:
-            data = f.read(count)
-    block_count = int((len(data) + max_block_size - 1) / max_block_size)
-    for i, block_offset in enumerate(range(0, len(data), max_block_size)):
-        block_size = min(max_block_size, len(data) - block_offset)
-        print("Block: {}/{}, size: {}".format(i + 1, block_count, block_size))
-        if not check_block(tty, data, block_offset, block_size):
-            return False
+            block['verified'] = verify_block(
+                tty, image, block['offset'], block['size'], verify_size
+            )
+            if block['verified'] or block['attempts'] > retries:
+                break
+            progress("Block {} is corrupted, writing it again".format(i + 1))
+        if journal is not None:
+            state = {None: BLOCK_COMMITTED, True: BLOCK_VERIFIED, False: BLOCK_NONE}
+            journal.set_block(i, state[block['verified']])
+        if block['verified'] is False:
+            break
+    return report
+
+
+def print_block_report(report):
+    """Print report of write_bin_to_flash()."""
+    print("Block  Offset      Size      Attempts  Result")
+    for i, block in enumerate(report):
+        result = {True: "OK", False: "FAILED", None: "NOT WRITTEN"}[block['verified']]
+        if block['skipped']:
+            result = "SKIPPED" if block['verified'] is None else "SKIPPED, OK"
+        print(
+            "{:<6} 0x{:08x}  {:<9} {:<9} {}".format(
+                i + 1, block['offset'], block['size'], block['attempts'], result
+            )
+        )
+    rewritten = sum(1 for x in report if x['attempts'] > 1)
+    print("Blocks written again: {}".format(rewritten))
+
+
+class DumpDecoder(object):
+    """Streaming decoder of dumpspiflash output. Words are written to preallocated buffer
+    as the output lines are received. Every word of the block must be received exactly once,
+    so a line with corrupted address does not replace a missing word.
+    """
+
+    def __init__(self, max_size):
+        self.buf = bytearray((max_size + 3) // 4 * 4)
+        # Count of lines received per word
+        self.received = bytearray(len(self.buf) // 4)
+        self.offset = 0
+        self.count = 0
+        self._line = bytearray()
+
+    def start(self, offset, count):
+        """Start decoding of output of "dumpspiflash `offset` `count`"."""
+        self.offset = offset
+        self.count = count
+        # Data of the previous block must not be taken for a missing word
+        self.buf[: 4 * count] = bytes(4 * count)
+        self.received[:count] = bytes(count)
+        self._line.clear()
+
+    def feed(self, chunk):
+        """Decode received data. Lines other than "0x%08x : 0x%08x" are skipped: command echo,
+        prompt and "Config spi0... Ok" printed by BootROM rev.0.
+        """
+        lines = (self._line + chunk).split(b'\n')
+        self._line = lines.pop()
+        received = self.received
+        for line in lines:
+            if not line.startswith(b'0x'):
+                continue
+            try:
+                addr, word = line.split(b' : ')
+                pos = int(addr, 16) - self.offset
+                if 0 <= pos < 4 * self.count and pos % 4 == 0:
+                    struct.pack_into('<I', self.buf, pos, int(word, 16))
+                    # ValueError after 255 lines of the word, checking fails anyway
+                    received[pos // 4] += 1
+            except (ValueError, struct.error):
+                # corrupted line, the word is not received and checking fails
+                continue
+
+    def data(self, size):
+        """Return first `size` decoded bytes or None if the output is incomplete or a word is
+        received more than once.
+        """
+        if self.received[: self.count] != b'\x01' * self.count:
+            return None
+        return self.buf[:size]
+
+
+def check_blocks(tty, image, blocks, tuner=None, show_progress=False):
+    """Compare flash data with `image` (bytes-like object) by dumpspiflash `blocks` (list of
+    (offset, size)). Output of dumpspiflash is decoded while it is received. Request of the
+    next block is sent before output of the current one is received (if command pipelining
+    is enabled by UART window), so the link is not idle while the host compares data.
+    If `tuner` (see Autotuner) is specified then throughput is measured.
+    """
+    if not blocks:
+        return True
+    window = 2 if tty.window > 1 else 1
+    decoder = DumpDecoder(max(size for _, size in blocks))
+    view = memoryview(image)
+    sent = 0
+    for i, (offset, size) in enumerate(blocks):
+        start = time.monotonic()
+        tx = rx = 0
+        while sent < len(blocks) and sent < i + window:
+            count = (blocks[sent][1] + 3) // 4
+            cmd = "dumpspiflash {:x} {:x}{}".format(blocks[sent][0], count, tty.newline)
+            tty.tty.write(cmd.encode())
+            sent += 1
+            tx += len(cmd)
+        if show_progress:
+            progress("Block: {}/{}, size: {}".format(i + 1, len(blocks), size))
+        count = (size + 3) // 4
+        decoder.start(offset, count)
+        # Output line of every word is sent with 10 bits per character
+        timeout = 10 + 2 * count * DUMP_LINE_LEN * 10 / tty.tty.baudrate
+        with span('dumpspiflash', offset=offset, size=size, baudrate=tty.tty.baudrate) as s:
+            try:
+                for chunk in tty.read_until(tty.prompt, timeout):
+                    decoder.feed(chunk)
+                    rx += len(chunk)
+                if decoder.data(size) != view[offset : offset + size]:
+                    # Skip output of the requests in flight
+                    for _ in range(sent - i - 1):
+                        for _ in tty.read_until(tty.prompt, timeout):
+                            pass
+                    return False
+            except CommandError:
+                raise CommandError("Device does not respond on dumpspiflash")
+            finally:
+                s.set(tx=tx, rx=rx)
+        if tuner is not None:
+            tuner.add(size, time.monotonic() - start)
     return True
 
 
-def unlock_write_protect(tty):
-    CMD_WRITE_STATUS_BYTE1 = 0x1
-    CMD_WRITE_DISABLE = 0x4
-    CMD_WRITE_ENABLE = 0x6
+def verify_block(tty, image, offset, size, block_size):
+    """Compare flash data with `size` bytes of `image` at `offset` by dumpspiflash blocks
+    of `block_size`.
+    """
+    return check_blocks(tty, image, list(split_ranges([(offset, size)], block_size)))
+
+
+def resume_point(tty, image, journal, blocks, block_size, verify_all=False):
+    """Return index of block to continue writing from according to `journal` (see Journal).
+    The last committed block of `blocks` (see split_ranges()) is read back by dumpspiflash
+    blocks of `block_size`: the block is written again if it is wrong.
+
+    The journal is found by the image, port, board and JEDEC ID, so it may be left by other
+    board of the same model. If `verify_all` is True then all committed blocks are read back
+    and writing is continued from the first wrong block, so blocks before the resume point
+    are marked as verified only if their data is checked on this board.
+    """
+    committed = journal.committed()
+    if committed == 0:
+        progress("Journal of interrupted run is not found, writing from the start")
+        return 0
+    for i in range(0 if verify_all else committed - 1, committed):
+        offset, size = blocks[i]
+        progress("Checking committed block {}/{}...".format(i + 1, len(blocks)))
+        if not verify_block(tty, image, offset, size, block_size):
+            journal.set_block(i, BLOCK_NONE)
+            committed = i
+            break
+        journal.set_block(i, BLOCK_VERIFIED)
+    progress("Resuming from block {}/{}".format(committed + 1, len(blocks)))
+    return committed
+
+
+def check_file(tty, image, count, ranges, block_size=CHECK_BLOCK_SIZE, tuner=None):
+    """Check `ranges` (see data_ranges()) of first `count` bytes of `image` by blocks of
+    `block_size`. If `tuner` (see Autotuner) is specified then its block sizes are used and
+    throughput is measured.
+    """
+    data = image[:count]
+    if tuner is not None:
+        block_size = tuner.block_sizes()
+    blocks = list(split_ranges(clip_ranges(ranges, len(data)), block_size))
+    return check_blocks(tty, data, blocks, tuner, show_progress=True)
+
+
+def read_jedec_id(tty):
     CMD_READ_MANUF_ID = 0x9F
-    MAN_ID_ATMEL = 0x1F
-    MAN_ID_MICRON = 0x20
-    MANUFACTURERS = {MAN_ID_ATMEL: "Atmel/Adesto", MAN_ID_MICRON: "Micron"}
 
     with SPI0Controller(tty) as spi:
         flash_id = spi.transfer([CMD_READ_MANUF_ID], 3)
-        man_id = flash_id[0]
-        man_str = MANUFACTURERS.get(man_id, "Unknown")
-        print("SPI Flash manufacturer: {}".format(man_str))
-        if man_id == MAN_ID_ATMEL:
+    return flash_id[0] << 16 | flash_id[1] << 8 | flash_id[2]
+
+
+def probe_flash(jedec_id, size):
+    """Report flash memory with `jedec_id` and return its FlashChip. Raise FlashMemoryError
+    if image of `size` bytes does not fit in the memory. Capacity of unknown memory is
+    limited by 3-byte addressing.
+    """
+    chip = find_chip(jedec_id)
+    progress("SPI Flash: {}".format(chip))
+    if chip.size is None:
+        if size > ADDRESS_SPACE_SIZE:
+            raise FlashMemoryError(
+                "Capacity of the flash memory is unknown and file size ({} bytes) exceeds "
+                "3-byte addressing ({} bytes)".format(size, ADDRESS_SPACE_SIZE)
+            )
+        progress(
+            "Warning: Capacity of the flash memory is unknown, file size is checked only "
+            "against 3-byte addressing"
+        )
+    elif size > chip.size:
+        raise FlashMemoryError(
+            "File size ({} bytes) exceeds capacity of the flash memory ({} bytes)".format(
+                size, chip.size
+            )
+        )
+    return chip
+
+
+def unlock_write_protect(tty, chip):
+    CMD_WRITE_STATUS_BYTE1 = 0x1
+    CMD_WRITE_DISABLE = 0x4
+    CMD_WRITE_ENABLE = 0x6
+
+    if chip.unlock == UNLOCK_GLOBAL:
+        with SPI0Controller(tty) as spi:
             spi.transfer([CMD_WRITE_ENABLE], 0)
             spi.transfer([CMD_WRITE_STATUS_BYTE1, 0], 0)
             spi.transfer([CMD_WRITE_DISABLE], 0)
-            print("Software write protect is disabled")
+        progress("Software write protect is disabled")
+
+
+def uart_class(args):
+    """Return class of UART console selected by --async-uart option."""
+    if args.async_uart:
+        # asyncio is not imported by clients of mcom02-flash-daemon
+        from mcom02_flash_tools.aio import SyncUART
+
+        return SyncUART
+    return UART
+
+
+def profile_block_sizes(profile, board):
+    """Return upload and check block sizes stored in `profile` for `board` or default ones."""
+    upload_size = profile.block_size(board, BAUDRATE, 'upload', UPLOAD_BLOCK_SIZE)
+    check_size = profile.block_size(board, BAUDRATE, 'check', CHECK_BLOCK_SIZE)
+    # Sizes from edited profile may violate alignment
+    if upload_size not in UPLOAD_BLOCK_SIZES:
+        upload_size = UPLOAD_BLOCK_SIZE
+    if check_size not in CHECK_BLOCK_SIZES:
+        check_size = CHECK_BLOCK_SIZE
+    return upload_size, check_size
+
+
+def save_profile(profile, board, tuners):
+    """Store throughput measured by `tuners` (dict of operation to Autotuner) in `profile`."""
+    for operation, tuner in tuners.items():
+        rates = tuner.rates()
+        for size in sorted(rates):
+            progress(
+                "{} block size {}: {:.0f} B/s".format(operation.capitalize(), size, rates[size])
+            )
+        size = profile.update(board, BAUDRATE, operation, rates)
+        if size is not None:
+            progress("Selected {} block size: {}".format(operation, size))
+    profile.save()
+    progress("Profile is saved to {}".format(profile.path))
 
 
 def main():
@@ -225,10 +792,13 @@ def main():
         "The script to program the on-board SPI flash memory "
         "with a binary file via MCom-02 Bootrom UART terminal. "
         "The file is written starting from the zero page "
-        "of the SPI flash memory."
+        "of the SPI flash memory. If the board runs U-Boot then --uboot option allows to "
+        "write the file via U-Boot terminal much faster."
     )
     parser = ArgumentParser(description=description)
-    parser.add_argument("file_name", help="binary file for programming")
+    parser.add_argument(
+        "file_name", help="binary file for programming or manifest of regions with --manifest"
+    )
     parser.add_argument(
         "-p",
         dest="port",
@@ -244,49 +814,315 @@ def main():
         "if not specified all the data is checked "
         "(default: %(default)s)",
     )
+    parser.add_argument(
+        "-w",
+        "--window",
+        type=int,
+        default=1,
+        help="count of BootROM commands sent without waiting for the prompt, greater than 1 "
+        "enables pipelining which requires the terminal to buffer the input while a command "
+        "is executed (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--async-uart",
+        action="store_true",
+        help="use asyncio UART transport: the port is read when data is received instead of "
+        "polling with timeout",
+    )
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="run in this process even if mcom02-flash-daemon is running",
+    )
+    parser.add_argument(
+        "--stub",
+        metavar="HEX_FILE",
+        help="flasher stub in Intel-HEX format (see stub/ directory of the project): the stub "
+        "is loaded to RAM by BootROM and the file is sent in binary frames, this is about "
+        "9 times faster than flashing by BootROM (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--uboot",
+        action="store_true",
+        help="use U-Boot terminal instead of BootROM: the file is sent with YMODEM, "
+        "written with \"sf update\" and checked with CRC32",
+    )
+    parser.add_argument(
+        "-b",
+        "--baudrate",
+        type=int,
+        default=115200,
+        help="maximum UART baudrate in U-Boot mode, if greater than 115200 then the fastest "
+        "reliable baudrate is negotiated with U-Boot (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-s",
+        "--spi",
+        type=int,
+        nargs=2,
+        metavar=("bus", "cs"),
+        default=[0, 0],
+        help="SPI bus and chip select numbers of flash memory in U-Boot mode "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=int,
+        help="time in seconds to wait for U-Boot terminal, default - infinite",
+    )
+    parser.add_argument(
+        "--sparse",
+        action="store_true",
+        help="erase 64 KiB sectors of the file filled with 0xFF with sector erase command "
+        "instead of writing and checking them, this reduces flashing time of files with "
+        "large padding",
+    )
+    parser.add_argument(
+        "--manifest",
+        action="store_true",
+        help="file_name is a manifest (YAML or JSON) of files and fills written at their "
+        "offsets in one session, 64 KiB sectors of fills with 0xFF are erased instead of "
+        "writing",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="keep Intel-HEX blocks of the file in the cache, repeated "
+        "flashing of the same file starts without preparation of the file",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=default_cache_dir(),
+        help="cache directory, implies --cache (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=1024,
+        metavar="MB",
+        help="maximum size of the cache, least recently used files are removed from the cache "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--prewarm",
+        action="store_true",
+        help="only put the file to the cache and exit, the board is not required, implies "
+        "--cache",
+    )
+    parser.add_argument(
+        "--verify-each",
+        action="store_true",
+        help="read back every block right after writing, write corrupted blocks again and "
+        "stop on the block which is still corrupted, -c is ignored",
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=3,
+        help="count of repeated writes of corrupted block with --verify-each "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue interrupted writing of the file: the last block committed by "
+        "the interrupted run is checked and writing is continued from it",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="do not write, only check that flash memory contains the file",
+    )
+    parser.add_argument(
+        "--autotune",
+        action="store_true",
+        help="write and check the file by blocks of different sizes, measure throughput and "
+        "save the fastest block sizes to the profile of the board",
+    )
+    parser.add_argument(
+        "--board",
+        default="default",
+        help="board model, block sizes are stored in the profile per board model "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--profile",
+        default=default_profile_path(),
+        help="profile file with block sizes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="save timeline of UART commands and phases to Chrome trace JSON file (open in "
+        "chrome://tracing or ui.perfetto.dev) and print summary with latency histogram",
+    )
+    parser.add_argument(
+        "--prometheus",
+        metavar="FILE",
+        help="save metrics of the run (duration, throughput, latency histograms) to "
+        "Prometheus textfile, e.g. for textfile collector of node_exporter",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="FILE",
+        help="record data sent and received by UART with timestamps to transcript FILE, "
+        "the transcript is replayed with -p replay:FILE[@SPEED] (SPEED is a number or max)",
+    )
     parser.add_argument("--version", action='version', version=__version__)
     args = parser.parse_args()
+    use_cache = args.cache or args.prewarm or args.cache_dir != parser.get_default("cache_dir")
+    if not args.uboot and args.baudrate != 115200:
+        parser.error("-b/--baudrate is supported only in U-Boot mode (--uboot)")
+    if args.uboot and args.stub is not None:
+        parser.error("--stub is not supported in U-Boot mode (--uboot)")
+    if args.uboot and args.sparse:
+        parser.error("--sparse is not supported in U-Boot mode (--uboot)")
+    if args.uboot and use_cache:
+        parser.error("cache is not supported in U-Boot mode (--uboot)")
+    if args.verify_each and (args.uboot or args.stub is not None):
+        parser.error("--verify-each is supported only in BootROM mode without --stub")
+    if args.autotune and (args.uboot or args.stub is not None or use_cache):
+        parser.error("--autotune is supported only in BootROM mode without --stub and cache")
+    if args.resume and (args.uboot or args.stub is not None or args.autotune):
+        parser.error("--resume is supported only in BootROM mode without --stub and --autotune")
+    if args.manifest and (args.uboot or args.stub is not None):
+        parser.error("--manifest is supported only in BootROM mode without --stub")
+    if args.verify and (
+        args.stub is not None or args.verify_each or args.resume or args.autotune or args.prewarm
+    ):
+        parser.error(
+            "--verify can not be used with --stub, --verify-each, --resume, --autotune and "
+            "--prewarm"
+        )
+    if args.async_uart and (args.record or is_replay_port(args.port)):
+        parser.error("--async-uart can not be used with --record and replay of transcript")
+    args.use_cache = use_cache
+
+    if not args.no_daemon and not args.prewarm:
+        retcode = forward_job('mcom02_flash_spi', args, PATH_ARGS)
+        if retcode is not None:
+            sys.exit(retcode)
+    run(args)
+
+
+def run(args):
+    """Flash or check the file with parsed arguments `args` (job of mcom02-flash-daemon)."""
+    labels = {'tool': 'mcom02-flash-spi', 'port': args.port}
+    with trace_run(args.trace, args.prometheus, labels):
+        _run(args)
 
+
+def _run(args):
     file_name = args.file_name
     if not os.path.exists(file_name):
         eprint("File '%s' is not found" % file_name)
         sys.exit(1)
 
     try:
-        tty = UART(prompt='\r#', port=args.port)
-    except SerialException:
-        eprint("Failed to open device '%s'" % args.port)
-        sys.exit(1)
-
-    if tty.run("") is None:
-        eprint(
-            "Terminal does not respond. Set the boot mode to UART "
-            "and reset the board power (do not use warm reset)"
-        )
+        profile = Profile(args.profile)
+    except ValueError as e:
+        eprint("Failed to read profile '{}': {}".format(args.profile, e))
         sys.exit(1)
 
-    # Disable DDR retention to avoid large current on DDRx_VDDQ (see rf#1160).
-    send_cmd(tty, "set 38095024 0")
+    cache = None
+    if args.use_cache:
+        cache = BlockCache(args.cache_dir, args.cache_size * 1024 * 1024)
 
-    send_cmd(tty, "autorun 0")
-    send_cmd(tty, "cache 1")
+    manifest = None
+    if args.manifest:
+        try:
+            manifest = Manifest.load(file_name)
+            manifest.validate(SECTOR_SIZE)
+        except (OSError, ValueError) as e:
+            eprint("Failed to read manifest '{}': {}".format(file_name, e))
+            sys.exit(1)
+        for i, region in enumerate(manifest.regions):
+            print("Region {}/{}: {}".format(i + 1, len(manifest.regions), region))
 
-    unlock_write_protect(tty)
+    if args.prewarm:
+        block_sizes = profile_block_sizes(profile, args.board)
+        with load_image(file_name, manifest) as (image, regions, fills):
+            # Flash memory is not known, default sector size is used
+            ranges, _ = image_layout(image, regions, fills, args.sparse)
+            entry = prepare_cache(
+                cache, image, NEWLINE.encode(), ranges, block_sizes[0], SECTOR_SIZE
+            )
+        print("File is cached in {}".format(entry.path))
+        sys.exit(0)
 
-    print("Writing to flash...")
-    write_bin_to_flash(tty, file_name)
+    # mcom02_flash_tools.api imports this module
+    from mcom02_flash_tools import api
 
-    print("Checking...")
-    checking_succeeded = check_file(tty, file_name, args.count)
+    stub_ihex = None
+    if args.stub is not None:
+        try:
+            stub_ihex = FlasherStub.read_ihex(args.stub)
+        except CommandError as e:
+            print("Warning: {}\n  Flashing is done by BootROM".format(e))
 
-    send_cmd(tty, "cache 0")
+    mode = api.UBOOT if args.uboot else api.BOOTROM
+    try:
+        uart = open_uart(
+            uart_class(args),
+            args.port,
+            window=args.window,
+            record=args.record,
+            **api.uart_options(mode),
+        )
+    except SerialException:
+        eprint("Failed to open device '%s'" % args.port)
+        sys.exit(1)
 
-    if checking_succeeded:
-        print("Checking succeeded")
-        sys.exit(0)
-    else:
-        eprint("Checking failed")
+    session = api.FlashSession(uart, mode, progress=print)
+    try:
+        session.connect(timeout=args.timeout if args.uboot else None)
+        if args.uboot:
+            session.set_baudrate(args.baudrate)
+        if args.verify:
+            session.verify_spi(
+                file_name,
+                manifest,
+                args.count,
+                args.sparse,
+                args.board,
+                profile,
+                spi=args.spi,
+            )
+        else:
+            result = session.flash_spi(
+                file_name,
+                manifest,
+                args.count,
+                args.sparse,
+                stub_ihex,
+                cache,
+                args.verify_each,
+                args.retries,
+                args.resume,
+                args.autotune,
+                args.board,
+                profile,
+                spi=args.spi,
+            )
+            if args.verify_each:
+                print_block_report(result.blocks)
+    except VerificationError as e:
+        if args.verify_each:
+            print_block_report(e.result.blocks)
+        eprint(e)
+        sys.exit(1)
+    except FlashToolsError as e:
+        eprint(e)
         sys.exit(1)
+    finally:
+        try:
+            session.close()
+        finally:
+            close_uart(uart)
+
+    print("Checking succeeded")
+    sys.exit(0)
 
 
 if __name__ == "__main__":
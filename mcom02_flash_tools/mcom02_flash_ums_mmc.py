@@ -6,25 +6,13 @@
 #
 
 import argparse
-import subprocess
 import sys
-import time
 
-from mcom02_flash_tools import UART, __version__, eprint
+from serial import SerialException
 
-exp_str_timeout = 10
-usb_device_init_delay = 5
-
-
-def uboot_break(tty):
-    tty.run('\x03', timeout=exp_str_timeout)  # send Ctrl-C to stop probably running process
-
-
-def get_block_devices():
-    out = subprocess.check_output(
-        ['lsblk', '-o', 'name', '--list', '--nodeps'], universal_newlines=True
-    )
-    return out.split()[1:]
+from mcom02_flash_tools import UART, FlashToolsError, __version__, eprint
+from mcom02_flash_tools.api import UBOOT, FlashSession
+from mcom02_flash_tools.trace import trace_run
 
 
 def main():
@@ -54,82 +42,49 @@ def main():
         help='time in seconds to wait for U-Boot terminal, 0 - infinite',
     )
     parser.add_argument('--prompt', default='mcom#', help='U-Boot command line prompt')
+    parser.add_argument(
+        '-b',
+        '--baudrate',
+        type=int,
+        default=115200,
+        help='maximum UART baudrate, if greater than 115200 then the fastest reliable baudrate '
+        'is negotiated with U-Boot and the original one is restored on exit',
+    )
     parser.add_argument('--version', action='version', version=__version__)
     parser.add_argument('--status', action='store_true', help='show progress of dd utility')
+    parser.add_argument(
+        '--trace',
+        metavar='FILE',
+        help='save timeline of U-Boot commands and dd to Chrome trace JSON file (open in '
+        'chrome://tracing or ui.perfetto.dev) and print summary with latency histogram',
+    )
+    parser.add_argument(
+        '--prometheus', metavar='FILE', help='save metrics of the run to Prometheus textfile'
+    )
     args = parser.parse_args()
 
-    tty = UART(prompt=args.prompt, port=args.port)
-    wait_uboot = None if not args.wait_uboot else args.wait_uboot
-    ok = tty.wait_for_uboot(timeout=wait_uboot)
-    if not ok:
-        eprint(
-            'U-Boot terminal does not respond. Set the boot mode to SPI '
-            'and reset the board power (do not use warm reset).'
-        )
-        sys.exit(1)
-    tty.run('')  # hitting key to stop autoboot
+    labels = {'tool': 'mcom02-flash-ums-mmc', 'port': args.port}
+    with trace_run(args.trace, args.prometheus, labels):
+        write_image(args)
 
-    uboot_version = tty.get_uboot_version()
-    if uboot_version is not None:
-        print('Found U-Boot: {}'.format(uboot_version))
-    else:
-        eprint('No U-Boot terminal found.')
-        sys.exit(1)
-
-    print('Board model: ', tty.get_uboot_board_model(timeout=exp_str_timeout))
-    print('Enabling USB Mass storage on target...')
-    block_device_list_before_init = get_block_devices()
-    tty.tty.write('ums 0 mmc {}\n'.format(args.mmcdev).encode())
-    time.sleep(usb_device_init_delay)
-
-    ok, resp = tty.wait_for_string(
-        [
-            f'UMS: LUN 0, dev {args.mmcdev}'.format(args.mmcdev),  # for U-Boot < 2021.04
-            f'UMS: LUN 0, dev mmc {args.mmcdev}'.format(args.mmcdev),  # for U-Boot >= 2021.04
-        ],
-        timeout=exp_str_timeout,
-    )
 
-    if not ok:
-        eprint('Failed to enable UMS for MMC {}. U-Boot response {}.'.format(args.mmcdev, resp))
-        sys.exit(1)
-
-    block_device_list_after_init = get_block_devices()
-    usb_devices_diff = set(block_device_list_after_init) - set(block_device_list_before_init)
-    if len(usb_devices_diff) == 0:
-        eprint('No USB device connections from board.')
-        sys.exit(1)
-    if len(usb_devices_diff) > 1:
-        eprint('Too many USB device connections.')
+def write_image(args):
+    wait_uboot = None if not args.wait_uboot else args.wait_uboot
+    try:
+        tty = UART(prompt=args.prompt, port=args.port)
+    except SerialException:
+        eprint("Failed to open device '{}'".format(args.port))
         sys.exit(1)
-
-    board_usb_device = usb_devices_diff.pop()
-    print('Writing image {} to /dev/{}...'.format(args.image, board_usb_device))
-
-    cmd = [
-        'dd',
-        'if={}'.format(args.image),
-        'of=/dev/{}'.format(board_usb_device),
-        'bs=4M',
-        'oflag=direct',
-    ]
-    if args.status:
-        cmd.append('status=progress')
+    session = FlashSession(tty, UBOOT, progress=print)
     try:
-        process = subprocess.Popen(cmd, stdout=sys.stdout, stderr=sys.stderr)
-        process.communicate()
-        errcode = process.returncode
-    finally:  # terminate child process in case KeyboardInterrupt (Ctrl+C), etc
-        if process.poll() is None:
-            print('Terminating child process...')
-            process.terminate()
-            process.kill()
-
-    if errcode:
-        eprint('Failed to write image to USB device')
+        session.connect(timeout=wait_uboot)
+        session.set_baudrate(args.baudrate)
+        session.ums_write(args.image, args.mmcdev, args.status)
+    except FlashToolsError as e:
+        eprint(e)
         sys.exit(1)
-
-    uboot_break(tty)
+    finally:
+        session.close()
     print("Done")
 
 
@@ -0,0 +1,309 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+
+"""Microbenchmarks of host-side hot paths of mcom02-flash-spi: search of the prompt in large
+responses, encoding and sending of Intel-HEX records, decoding of dumpspiflash output and
+comparison of flash data with the image. The code works with FakeSerial which answers
+without delays, so the results show only the host CPU time and memory.
+
+Every case is run at least `repeat` times and for `min_time` seconds for throughput (the best
+run is taken) and once more with tracemalloc for peak memory. Results are compared with the
+baseline saved by a previous run (see compare()).
+"""
+
+import binascii
+import collections
+import json
+import os
+import struct
+import time
+import tracemalloc
+
+from mcom02_flash_tools import UART
+from mcom02_flash_tools.mcom02_flash_spi import (
+    CHECK_BLOCK_SIZE,
+    NEWLINE,
+    UPLOAD_BLOCK_SIZE,
+    DumpDecoder,
+    check_blocks,
+    encode_upload,
+    send_ihex,
+    split_ranges,
+)
+
+BASELINE_VERSION = 1
+# Image sizes used by default: 64 KiB, 1 MiB and 32 MiB
+SIZES = (64 * 1024, 1024 * 1024, 32 * 1024 * 1024)
+# Size of data returned by one read() of FakeSerial, USB-UART adapters deliver data by
+# small chunks
+CHUNK_SIZE = 4096
+PROMPT = '\r#'
+# Default regression thresholds: allowed relative decrease of throughput and increase of
+# peak memory
+MAX_SLOWDOWN = 0.25
+MAX_MEMORY_GROWTH = 0.1
+# Minimum total time of runs of a case, short cases are repeated for stable results
+MIN_TIME = 0.5
+
+
+class FakeSerial(object):
+    """Serial port which answers data written by the host with `respond(data)` (bytes or
+    None) immediately. The answer is returned by read() in chunks of `chunk_size` bytes.
+    """
+
+    def __init__(self, respond, chunk_size=CHUNK_SIZE):
+        self.respond = respond
+        self.chunk_size = chunk_size
+        self.port = 'fake'
+        self.baudrate = 115200
+        self.timeout = None
+        self._pending = collections.deque()
+        self._pos = 0
+
+    def write(self, data):
+        response = self.respond(data)
+        if response:
+            self._pending.append(response)
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        if not self._pending:
+            return 0
+        return min(self.chunk_size, len(self._pending[0]) - self._pos)
+
+    def read(self, size=1):
+        if not self._pending:
+            return b''
+        data = self._pending[0][self._pos : self._pos + min(size, self.chunk_size)]
+        self._pos += len(data)
+        if self._pos == len(self._pending[0]):
+            self._pending.popleft()
+            self._pos = 0
+        return data
+
+    def reset_input_buffer(self):
+        self._pending.clear()
+        self._pos = 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def dump_output(image, offset, size):
+    """Return dumpspiflash output for `size` bytes of `image` at `offset`."""
+    data = bytes(image[offset : offset + size])
+    data += b'\xff' * (-len(data) % 4)
+    return b''.join(
+        b'0x%08x : 0x%08x\r\n' % (offset + 4 * i, word)
+        for i, (word,) in enumerate(struct.iter_unpack('<I', data))
+    )
+
+
+class Workload(object):
+    """Random image of `size` bytes and data prepared for the cases."""
+
+    def __init__(self, size):
+        self.size = size
+        self.image = os.urandom(size)
+        self.check_blocks = list(split_ranges([(0, size)], CHECK_BLOCK_SIZE))
+        self.upload_blocks = list(split_ranges([(0, size)], UPLOAD_BLOCK_SIZE))
+        self._dumps = None
+
+    @property
+    def dumps(self):
+        """Dict of offset to dumpspiflash output of check blocks (with prompt)."""
+        if self._dumps is None:
+            self._dumps = {
+                offset: dump_output(self.image, offset, size) + PROMPT.encode()
+                for offset, size in self.check_blocks
+            }
+        return self._dumps
+
+
+def _bootrom_uart(respond):
+    return UART(prompt=PROMPT, port=FakeSerial(respond), newline=NEWLINE)
+
+
+def case_wait_for_string(workload):
+    """Receive response of twice the image size (hex dump) and search the prompt in it."""
+    response = binascii.hexlify(workload.image, b'\n', 32) + PROMPT.encode()
+
+    def run():
+        uart = _bootrom_uart(lambda data: response)
+        uart.tty.write(b'\n')
+        success, _ = uart.wait_for_string(PROMPT, timeout=None)
+        assert success
+        return len(response)
+
+    return run
+
+
+def case_dump_decode(workload):
+    """Decode dumpspiflash output of the image received in chunks."""
+    dumps = workload.dumps
+
+    def run():
+        decoder = DumpDecoder(CHECK_BLOCK_SIZE)
+        for offset, size in workload.check_blocks:
+            decoder.start(offset, (size + 3) // 4)
+            dump = memoryview(dumps[offset])
+            for pos in range(0, len(dump), CHUNK_SIZE):
+                decoder.feed(dump[pos : pos + CHUNK_SIZE])
+            assert decoder.data(size) == workload.image[offset : offset + size]
+        return workload.size
+
+    return run
+
+
+def case_ihex_encode(workload):
+    """Encode the image to Intel-HEX upload blocks."""
+
+    def run():
+        for records in encode_upload(workload.image, NEWLINE.encode(), workload.upload_blocks):
+            assert records
+        return workload.size
+
+    return run
+
+
+def case_send_ihex(workload):
+    """Encode and send Intel-HEX upload blocks, every block is answered by the prompt."""
+
+    def run():
+        uart = _bootrom_uart(lambda data: PROMPT.encode())
+        for records in encode_upload(workload.image, NEWLINE.encode(), workload.upload_blocks):
+            send_ihex(uart, records)
+        return workload.size
+
+    return run
+
+
+def case_check_blocks(workload):
+    """Request dumpspiflash blocks of the image, decode and compare them with the image."""
+    dumps = workload.dumps
+
+    def respond(data):
+        _, offset, _ = bytes(data).split()
+        return bytes(data) + dumps[int(offset, 16)]
+
+    def run():
+        assert check_blocks(_bootrom_uart(respond), workload.image, workload.check_blocks)
+        return workload.size
+
+    return run
+
+
+CASES = collections.OrderedDict(
+    [
+        ('wait_for_string', case_wait_for_string),
+        ('dump_decode', case_dump_decode),
+        ('ihex_encode', case_ihex_encode),
+        ('send_ihex', case_send_ihex),
+        ('check_blocks', case_check_blocks),
+    ]
+)
+
+
+def measure(run, repeat=1, min_time=MIN_TIME):
+    """Return throughput (bytes/s) of the best call of `run` (returns count of processed
+    bytes) and peak memory (bytes) allocated by one more call. `run` is called at least
+    `repeat` times and until the calls take `min_time` seconds.
+    """
+    best = None
+    total = 0.0
+    runs = 0
+    while runs < repeat or total < min_time:
+        start = time.perf_counter()
+        processed = run()
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+        total += duration
+        runs += 1
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'bytes': processed, 'seconds': best, 'throughput': processed / best, 'peak': peak}
+
+
+def run_suite(sizes=SIZES, cases=None, repeat=1, min_time=MIN_TIME, report=None):
+    """Run `cases` (names of CASES, all by default) for image `sizes`. Return dict of
+    "case/size" to result of measure() with `repeat` and `min_time`. `report` is called with
+    the key and the result of every case.
+    """
+    results = collections.OrderedDict()
+    for size in sizes:
+        workload = Workload(size)
+        for name in cases or CASES:
+            key = '{}/{}'.format(name, size)
+            results[key] = measure(CASES[name](workload), repeat, min_time)
+            if report is not None:
+                report(key, results[key])
+    return results
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump({'version': BASELINE_VERSION, 'results': results}, f, indent=4)
+
+
+def load_baseline(path):
+    with open(path) as f:
+        baseline = json.load(f)
+    if baseline.get('version') != BASELINE_VERSION:
+        raise ValueError('unsupported baseline version {}'.format(baseline.get('version')))
+    return baseline['results']
+
+
+def compare(results, baseline, max_slowdown=MAX_SLOWDOWN, max_memory_growth=MAX_MEMORY_GROWTH):
+    """Return list of regressions (text) of `results` relative to `baseline`: throughput is
+    lower by more than `max_slowdown` or peak memory is higher by more than
+    `max_memory_growth` (fractions). Cases missing in the baseline are skipped.
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if result['throughput'] < base['throughput'] * (1 - max_slowdown):
+            regressions.append(
+                '{}: throughput {:.1f} MB/s, baseline {:.1f} MB/s'.format(
+                    key, result['throughput'] / 1e6, base['throughput'] / 1e6
+                )
+            )
+        if result['peak'] > base['peak'] * (1 + max_memory_growth):
+            regressions.append(
+                '{}: peak memory {:.1f} MB, baseline {:.1f} MB'.format(
+                    key, result['peak'] / 1e6, base['peak'] / 1e6
+                )
+            )
+    return regressions
+
+
+def parse_size(text):
+    """Return size in bytes for text with optional suffix K or M (e.g. "64K")."""
+    units = {'K': 1024, 'M': 1024 * 1024}
+    text = text.strip().upper()
+    if text[-1:] in units:
+        return int(text[:-1]) * units[text[-1]]
+    return int(text)
+
+
+def format_header():
+    return '{:<16} {:>10} {:>10} {:>12} {:>14}'.format(
+        'Case', 'Image, B', 'Time, s', 'Speed, MB/s', 'Peak mem, KiB'
+    )
+
+
+def format_result(key, result):
+    name, size = key.split('/')
+    return '{:<16} {:>10} {:>10.3f} {:>12.2f} {:>14.0f}'.format(
+        name, size, result['seconds'], result['throughput'] / 1e6, result['peak'] / 1024
+    )
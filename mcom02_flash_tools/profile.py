@@ -0,0 +1,102 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+
+"""Block size profiles of mcom02-flash-spi.
+
+Throughput of BootROM upload (Intel-HEX and commitspiflash) and readback (dumpspiflash)
+depends on block size: every command has fixed overhead (round trip, flash program or read
+setup), large blocks are limited by BootROM buffers and command timeouts. Autotuner measures
+throughput of blocks of different sizes while the file is flashed. The measured throughput
+and the best block sizes are stored in JSON profile per board model and UART baudrate:
+
+    {"<board>@<baudrate>": {"upload": {"block_size": 49152, "rates": {"8192": 5012.3}}}}
+"""
+
+import itertools
+import json
+import os
+
+
+def default_profile_path():
+    """Profile path according to XDG Base Directory Specification."""
+    base = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.path.expanduser('~'), '.config')
+    return os.path.join(base, 'mcom02-flash-tools', 'profile.json')
+
+
+class Autotuner(object):
+    """Measure throughput of operation for block sizes used in turn."""
+
+    def __init__(self, candidates, boundary=None):
+        """Parameters
+        ----------
+        candidates : list
+            block sizes to measure
+        boundary : int
+            blocks do not cross multiples of `boundary` (see split_ranges()), every
+            candidate is used for blocks of the whole `boundary` interval
+        """
+        self.candidates = candidates
+        self.boundary = boundary
+        # block size -> [bytes, seconds]
+        self._samples = {}
+
+    def block_sizes(self):
+        """Return iterator of sizes of consecutive blocks."""
+        if self.boundary is None:
+            return itertools.cycle(self.candidates)
+        return itertools.cycle([x for x in self.candidates for _ in range(-(-self.boundary // x))])
+
+    def add(self, size, seconds):
+        """Account block of `size` bytes processed in `seconds`. Blocks of other sizes than
+        candidates (e.g. the last block of the file) are ignored.
+        """
+        if size in self.candidates:
+            sample = self._samples.setdefault(size, [0, 0.0])
+            sample[0] += size
+            sample[1] += seconds
+
+    def rates(self):
+        """Return dict of block size to throughput in bytes per second."""
+        return {size: count / seconds for size, (count, seconds) in self._samples.items()}
+
+
+class Profile(object):
+    """Block sizes and throughput per board model and baudrate stored in JSON file."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = {}
+
+    @staticmethod
+    def key(board, baudrate):
+        return '{}@{}'.format(board, baudrate)
+
+    def block_size(self, board, baudrate, operation, default):
+        """Return the best block size of `operation` ('upload' or 'check') or `default` if
+        it is not measured.
+        """
+        entry = self.data.get(self.key(board, baudrate), {}).get(operation, {})
+        return entry.get('block_size', default)
+
+    def update(self, board, baudrate, operation, rates):
+        """Merge measured `rates` (see Autotuner.rates()) with stored ones and select block
+        size with maximum throughput. Return the selected block size.
+        """
+        entry = self.data.setdefault(self.key(board, baudrate), {}).setdefault(operation, {})
+        stored = entry.setdefault('rates', {})
+        stored.update({str(size): rate for size, rate in rates.items()})
+        if stored:
+            entry['block_size'] = int(max(stored, key=stored.get))
+        return entry.get('block_size')
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, indent=4, sort_keys=True)
+        os.replace(tmp, self.path)
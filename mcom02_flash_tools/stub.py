@@ -0,0 +1,226 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+
+"""Host side of the flasher stub protocol.
+
+Flasher stub (see stub/flasher.c) is a small program loaded to on-chip RAM through BootROM
+Intel-HEX upload. It receives binary frames from host over UART0, programs SPI flash on SPI0
+and answers on every frame. Host and stub frames have the same layout:
+
+    magic (1) | command or status (1) | length (2) | offset (4) | payload | CRC32 (4)
+
+Multibyte fields are little endian, CRC32 (zlib.crc32) covers header and payload. Host frames
+start with MAGIC_HOST, stub frames start with MAGIC_STUB. Stub answers on every frame with
+the same offset and status. Frames with bad CRC are answered with STATUS_BAD_CRC and are sent
+again by host. After start stub sends hello frame (see FlasherStub.hello()).
+"""
+
+import struct
+import zlib
+from io import StringIO
+
+from intelhex import IntelHex
+
+from mcom02_flash_tools import CommandError, progress
+from mcom02_flash_tools.trace import span
+
+MAGIC_HOST = 0xA5
+MAGIC_STUB = 0x5A
+PROTOCOL_VERSION = 1
+# Maximum payload size supported by stub/flasher.c
+MAX_PAYLOAD = 4096
+HEADER = struct.Struct('<BBHI')
+
+CMD_HELLO = ord('H')
+CMD_UNLOCK = ord('U')
+CMD_ERASE = ord('E')
+CMD_WRITE = ord('W')
+CMD_CRC = ord('C')
+
+STATUS_OK = 0
+STATUS_BAD_CRC = 1
+STATUS_BAD_COMMAND = 2
+STATUS_BAD_LENGTH = 3
+
+# Stub is linked to the RAM area used for Intel-HEX blocks by mcom02-flash-spi
+STUB_ADDR = 0x20000000
+STUB_MAX_SIZE = 0xC000
+
+# Size of erase block (SPI flash command 0xD8)
+ERASE_SIZE = 0x10000
+
+
+def encode_frame(magic, cmd, offset, payload=b''):
+    header = HEADER.pack(magic, cmd, len(payload), offset)
+    return header + payload + struct.pack('<I', zlib.crc32(payload, zlib.crc32(header)))
+
+
+def decode_frame(buf):
+    """Find frame in bytearray `buf` and remove it with all preceding bytes from `buf`.
+
+    Returns
+    -------
+    tuple
+        (magic, cmd, offset, payload) or None if `buf` does not contain complete frame. Bytes
+        preceding the frame magic and bad frames are removed from `buf`.
+    """
+    while len(buf) >= HEADER.size + 4:
+        magic, cmd, length, offset = HEADER.unpack_from(buf)
+        if magic not in (MAGIC_HOST, MAGIC_STUB):
+            del buf[0]
+            continue
+        end = HEADER.size + length
+        if len(buf) < end + 4:
+            return None
+        (crc,) = struct.unpack_from('<I', buf, end)
+        if zlib.crc32(buf[:end]) != crc:
+            del buf[0]
+            continue
+        payload = bytes(buf[HEADER.size : end])
+        del buf[: end + 4]
+        return magic, cmd, offset, payload
+    return None
+
+
+class FlasherStub(object):
+    """Program SPI flash with the flasher stub."""
+
+    def __init__(self, tty, timeout=5, retries=5):
+        """Parameters
+        ----------
+        tty : UART
+            UART connected to BootROM terminal
+        timeout : float
+            time in seconds to wait for answer on every frame
+        retries : int
+            count of attempts to send a frame
+        """
+        self.tty = tty
+        self.timeout = timeout
+        self.retries = retries
+        self.max_payload = None
+        self.jedec_id = None
+        self._buf = bytearray()
+
+    @staticmethod
+    def read_ihex(file_name):
+        """Read stub Intel-HEX file. Raise CommandError if the file is not a valid stub."""
+        try:
+            ihex = IntelHex(file_name)
+        except Exception as e:
+            raise CommandError('Can not read flasher stub {}: {}'.format(file_name, e))
+        start = (ihex.start_addr or {}).get('EIP')
+        if start is None:
+            raise CommandError('Flasher stub {} has no start address'.format(file_name))
+        if ihex.minaddr() < STUB_ADDR or ihex.maxaddr() >= STUB_ADDR + STUB_MAX_SIZE:
+            raise CommandError(
+                'Flasher stub {} must be placed in 0x{:08x}-0x{:08x}'.format(
+                    file_name, STUB_ADDR, STUB_ADDR + STUB_MAX_SIZE - 1
+                )
+            )
+        return ihex
+
+    def load(self, ihex):
+        """Upload stub to RAM and start it with BootROM autorun."""
+        sio = StringIO()
+        ihex.write_hex_file(sio)
+        self.tty.run('autorun 1')
+        # BootROM starts the program after end of file record, so there is no prompt
+        self.tty.tty.write(sio.getvalue().strip().replace('\n', self.tty.newline).encode())
+        self.tty.tty.write(self.tty.newline.encode())
+        self.hello()
+
+    def hello(self):
+        """Wait for hello frame: protocol version, maximum payload and JEDEC ID of flash."""
+        payload = self._receive(CMD_HELLO, 0)
+        if payload is None:
+            raise CommandError('Flasher stub does not respond')
+        version, self.max_payload = struct.unpack_from('<BH', payload)
+        if version != PROTOCOL_VERSION:
+            raise CommandError('Unsupported flasher stub protocol version {}'.format(version))
+        self.jedec_id = int.from_bytes(payload[3:6], 'big')
+
+    def _receive(self, cmd, offset):
+        """Return payload of answer on (`cmd`, `offset`) or None on timeout."""
+        while True:
+            frame = decode_frame(self._buf)
+            if frame is None:
+                data = self.tty.read_bytes(max(1, self.tty.tty.in_waiting), self.timeout)
+                if not data:
+                    return None
+                self._buf += data
+                continue
+            magic, status, answer_offset, payload = frame
+            if magic != MAGIC_STUB:
+                continue
+            if cmd == CMD_HELLO and answer_offset == offset:
+                return payload
+            if status in (STATUS_BAD_CRC, STATUS_BAD_LENGTH):
+                # header or data of the frame is corrupted
+                raise _Resend()
+            if answer_offset != offset:
+                continue
+            if status != STATUS_OK:
+                raise CommandError(
+                    'Flasher stub error {} on command {} at 0x{:x}'.format(status, chr(cmd), offset)
+                )
+            return payload
+
+    def command(self, cmd, offset=0, payload=b''):
+        """Send command frame and return payload of answer."""
+        frame = encode_frame(MAGIC_HOST, cmd, offset, payload)
+        for _ in range(self.retries):
+            with span('stub', cmd=chr(cmd), tx=len(frame), baudrate=self.tty.tty.baudrate) as s:
+                self.tty.tty.write(frame)
+                try:
+                    answer = self._receive(cmd, offset)
+                except _Resend:
+                    continue
+                s.set(rx=len(answer or b''))
+            if answer is not None:
+                return answer
+        raise CommandError('Flasher stub does not answer on command {}'.format(chr(cmd)))
+
+    def unlock(self):
+        self.command(CMD_UNLOCK)
+
+    def erase(self, offset):
+        self.command(CMD_ERASE, offset)
+
+    def write(self, offset, data):
+        for pos in range(0, len(data), self.max_payload):
+            self.command(CMD_WRITE, offset + pos, bytes(data[pos : pos + self.max_payload]))
+
+    def crc32(self, offset, size):
+        return struct.unpack('<I', self.command(CMD_CRC, offset, struct.pack('<I', size)))[0]
+
+    def write_file(self, data, sparse=False):
+        """Erase and write `data` from zero offset by erase blocks. If `sparse` is True then
+        blocks filled with 0xFF are only erased. Return count of bytes which are not written.
+        """
+        block_count = (len(data) + ERASE_SIZE - 1) // ERASE_SIZE
+        skipped = 0
+        for i, offset in enumerate(range(0, len(data), ERASE_SIZE)):
+            block = data[offset : offset + ERASE_SIZE]
+            progress("Block: {}/{}, size: {}".format(i + 1, block_count, len(block)))
+            self.erase(offset)
+            if sparse and block == b'\xff' * len(block):
+                skipped += len(block)
+                continue
+            self.write(offset, block)
+        return skipped
+
+    def check_file(self, data):
+        """Compare CRC32 of flash data with CRC32 of `data` by erase blocks."""
+        block_count = (len(data) + ERASE_SIZE - 1) // ERASE_SIZE
+        for i, offset in enumerate(range(0, len(data), ERASE_SIZE)):
+            block = data[offset : offset + ERASE_SIZE]
+            progress("Block: {}/{}, size: {}".format(i + 1, block_count, len(block)))
+            if self.crc32(offset, len(block)) != zlib.crc32(block):
+                return False
+        return True
+
+
+class _Resend(Exception):
+    """Frame is received by stub with bad CRC"""
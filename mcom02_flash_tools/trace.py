@@ -0,0 +1,352 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+
+"""Tracing of UART commands and flashing phases.
+
+Instrumented code wraps commands and phases in span():
+
+    with span('run', tx=len(data), baudrate=tty.baudrate) as s:
+        ...
+        s.set(rx=len(resp))
+
+Spans are recorded by the Tracer of the current context (see tracing()) and cost one
+context variable lookup if tracing is not enabled. Arguments 'tx' and 'rx' of a span are
+counts of bytes sent to and received from the target, 'baudrate' marks spans of UART
+commands: their bytes are summed up in link utilisation (per direction, UART is full
+duplex).
+
+The recorded spans are saved as Chrome trace JSON (chrome://tracing, ui.perfetto.dev), as
+Prometheus textfile (node_exporter textfile collector) and as text summary with latency
+histograms.
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+
+# Tracer of the current context
+_tracer = contextvars.ContextVar('tracer', default=None)
+
+# Upper bounds of latency histogram buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+# Category of spans of commands shown in the latency histogram
+COMMAND = 'command'
+# Bits per byte on UART line: start bit, 8 data bits and stop bit
+BITS_PER_BYTE = 10
+# Prefix of Prometheus metric names
+METRIC_PREFIX = 'mcom02_flash'
+
+
+class _NullSpan(object):
+    """Span returned by span() if tracing is not enabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span(object):
+    """Time interval of a command or phase recorded by `tracer`."""
+
+    __slots__ = ('tracer', 'name', 'cat', 'args', 'start')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add(self, time.perf_counter())
+
+    def set(self, **args):
+        """Add arguments (e.g. count of received bytes) known at the end of the span."""
+        self.args.update(args)
+
+
+def span(name, cat=COMMAND, **args):
+    """Return context manager which records span `name` of category `cat` (e.g. 'command',
+    'wait', 'phase') with `args` by the tracer of the current context.
+    """
+    tracer = _tracer.get()
+    if tracer is None:
+        return _NULL_SPAN
+    return Span(tracer, name, cat, args)
+
+
+@contextlib.contextmanager
+def tracing(tracer):
+    """Context manager which records spans to `tracer`."""
+    token = _tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _tracer.reset(token)
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class SpanStats(object):
+    """Statistics of spans with the same name."""
+
+    def __init__(self, name, cat):
+        self.name = name
+        self.cat = cat
+        self.durations = []
+        self.tx = 0
+        self.rx = 0
+        # Line time of sent and received bytes
+        self.tx_time = 0.0
+        self.rx_time = 0.0
+
+    def add(self, duration, args):
+        self.durations.append(duration)
+        tx = args.get('tx', 0)
+        rx = args.get('rx', 0)
+        self.tx += tx
+        self.rx += rx
+        if args.get('baudrate'):
+            self.tx_time += tx * BITS_PER_BYTE / args['baudrate']
+            self.rx_time += rx * BITS_PER_BYTE / args['baudrate']
+
+    @property
+    def total(self):
+        return sum(self.durations)
+
+    def buckets(self):
+        """Return cumulative counts of durations for BUCKETS bounds."""
+        return [sum(1 for x in self.durations if x <= bound) for bound in BUCKETS]
+
+
+class Tracer(object):
+    """Recorder of spans of one run of a tool."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = None
+        self.succeeded = None
+        # (name, category, start, duration, args, thread id)
+        self.events = []
+
+    def add(self, span, end):
+        self.events.append(
+            (span.name, span.cat, span.start, end - span.start, span.args, threading.get_ident())
+        )
+
+    def finish(self, succeeded):
+        self.end = time.perf_counter()
+        self.succeeded = succeeded
+
+    @property
+    def duration(self):
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def stats(self):
+        """Return dict of span name to SpanStats in order of the first span."""
+        stats = {}
+        for name, cat, _, duration, args, _ in self.events:
+            if name not in stats:
+                stats[name] = SpanStats(name, cat)
+            stats[name].add(duration, args)
+        return stats
+
+    def link_stats(self):
+        """Return bytes sent and received by UART commands and link utilisation of both
+        directions: ratio of line time of the bytes to duration of the run.
+        """
+        stats = [x for x in self.stats().values() if x.tx_time or x.rx_time]
+        duration = self.duration or 1.0
+        return (
+            sum(x.tx for x in stats),
+            sum(x.rx for x in stats),
+            sum(x.tx_time for x in stats) / duration,
+            sum(x.rx_time for x in stats) / duration,
+        )
+
+    def chrome_trace(self):
+        """Return trace in Chrome trace event format."""
+        pid = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'mcom02-flash'}}]
+        for name, cat, start, duration, args, tid in self.events:
+            events.append(
+                {
+                    'name': name,
+                    'cat': cat,
+                    'ph': 'X',
+                    'ts': (start - self.start) * 1e6,
+                    'dur': duration * 1e6,
+                    'pid': pid,
+                    'tid': tid,
+                    'args': args,
+                }
+            )
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write_chrome_trace(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f)
+
+    def prometheus(self, labels=None):
+        """Return metrics in Prometheus text format with `labels` (dict) of every sample."""
+
+        def sample(name, value, **extra):
+            items = dict(labels or {}, **extra)
+            label_text = ','.join(
+                '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                for k, v in items.items()
+            )
+            return '{}_{}{{{}}} {}'.format(METRIC_PREFIX, name, label_text, value)
+
+        def header(name, kind, text):
+            return [
+                '# HELP {}_{} {}'.format(METRIC_PREFIX, name, text),
+                '# TYPE {}_{} {}'.format(METRIC_PREFIX, name, kind),
+            ]
+
+        tx, rx, tx_utilisation, rx_utilisation = self.link_stats()
+        stats = self.stats()
+        lines = header('duration_seconds', 'gauge', 'Duration of the run.')
+        lines.append(sample('duration_seconds', self.duration))
+        lines += header('success', 'gauge', '1 if the run succeeded.')
+        lines.append(sample('success', int(bool(self.succeeded))))
+        lines += header('uart_bytes', 'gauge', 'Bytes transferred by UART commands.')
+        lines.append(sample('uart_bytes', tx, direction='tx'))
+        lines.append(sample('uart_bytes', rx, direction='rx'))
+        lines += header('link_utilisation_ratio', 'gauge', 'Line time of UART bytes per run time.')
+        lines.append(sample('link_utilisation_ratio', tx_utilisation, direction='tx'))
+        lines.append(sample('link_utilisation_ratio', rx_utilisation, direction='rx'))
+        lines += header('phase_seconds', 'gauge', 'Duration of flashing phases.')
+        for x in stats.values():
+            if x.cat == 'phase':
+                lines.append(sample('phase_seconds', x.total, phase=x.name))
+        lines += header('span_seconds', 'histogram', 'Duration of commands and waits.')
+        for x in stats.values():
+            if x.cat == 'phase':
+                continue
+            for bound, count in zip(BUCKETS, x.buckets()):
+                lines.append(sample('span_seconds_bucket', count, span=x.name, le=bound))
+            lines.append(sample('span_seconds_bucket', len(x.durations), span=x.name, le='+Inf'))
+            lines.append(sample('span_seconds_sum', x.total, span=x.name))
+            lines.append(sample('span_seconds_count', len(x.durations), span=x.name))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, labels=None):
+        # The file is replaced atomically, so the collector does not read a partial file
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus(labels))
+        os.replace(tmp_path, path)
+
+    def summary(self):
+        """Return text summary: statistics of spans and latency histogram of commands."""
+        tx, rx, tx_utilisation, rx_utilisation = self.link_stats()
+        lines = [
+            'Trace summary: {:.2f} s, UART sent {} B, received {} B, link utilisation: '
+            'TX {:.1f} %, RX {:.1f} %'.format(
+                self.duration, tx, rx, tx_utilisation * 100, rx_utilisation * 100
+            )
+        ]
+        stats = self.stats()
+        phases = [x for x in stats.values() if x.cat == 'phase']
+        if phases:
+            lines.append(
+                'Phases: ' + ', '.join('{} {:.2f} s'.format(x.name, x.total) for x in phases)
+            )
+        lines.append(
+            '{:<16} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10}'.format(
+                'Span', 'Count', 'Total s', 'Mean ms', 'p95 ms', 'Max ms', 'Sent B', 'Recv B'
+            )
+        )
+        for x in stats.values():
+            if x.cat == 'phase':
+                continue
+            durations = sorted(x.durations)
+            lines.append(
+                '{:<16} {:>7} {:>9.3f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10} {:>10}'.format(
+                    x.name,
+                    len(durations),
+                    x.total,
+                    x.total / len(durations) * 1e3,
+                    _percentile(durations, 0.95) * 1e3,
+                    durations[-1] * 1e3,
+                    x.tx,
+                    x.rx,
+                )
+            )
+        commands = [d for x in stats.values() if x.cat == COMMAND for d in x.durations]
+        if commands:
+            lines.append('Latency of commands:')
+            previous = 0
+            counts = []
+            for bound in BUCKETS + (float('inf'),):
+                count = sum(1 for x in commands if x <= bound)
+                counts.append((bound, count - previous))
+                previous = count
+            width = max(count for _, count in counts)
+            for bound, count in counts:
+                if not count:
+                    continue
+                label = '> {:g} ms'.format(BUCKETS[-1] * 1e3) if bound == float('inf') else None
+                lines.append(
+                    '  {:>10} {:>7} {}'.format(
+                        label or '<= {:g} ms'.format(bound * 1e3),
+                        count,
+                        '#' * max(1, round(40 * count / width)),
+                    )
+                )
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def trace_run(trace_file=None, prometheus_file=None, labels=None):
+    """Context manager which traces a run of a tool if `trace_file` (Chrome trace) or
+    `prometheus_file` is specified. At exit the files are written and the summary is printed
+    to stderr. The run succeeds if the block is completed or exits with zero code.
+    """
+    if trace_file is None and prometheus_file is None:
+        yield None
+        return
+    tracer = Tracer()
+    succeeded = False
+    try:
+        with tracing(tracer):
+            yield tracer
+        succeeded = True
+    except SystemExit as e:
+        succeeded = not e.code
+        raise
+    finally:
+        tracer.finish(succeeded)
+        for path, write in [
+            (trace_file, tracer.write_chrome_trace),
+            (prometheus_file, lambda x: tracer.write_prometheus(x, labels)),
+        ]:
+            if path is None:
+                continue
+            try:
+                write(path)
+            except OSError as e:
+                print('Error: Failed to write {}: {}'.format(path, e), file=sys.stderr)
+        print(tracer.summary(), file=sys.stderr)
@@ -0,0 +1,256 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+#
+# SPDX-License-Identifier: MIT
+
+"""Recording and replay of serial port transcripts.
+
+RecordingSerial (see `record` argument of UART) writes every chunk of data sent to and
+received from the port with timestamps to a transcript file. ReplaySerial is a fake serial
+port which plays the transcript back to UART: received data is returned with the recorded
+delay after the preceding data sent by the host (scaled by `speed` or without delays) and
+data sent by the host is compared with the recorded one. The tools open ReplaySerial for
+port name "replay:FILE" or "replay:FILE@SPEED" (SPEED is a number or "max"):
+
+    mcom02-flash-spi --record session.jsonl -p /dev/ttyUSB0 image.bin
+    mcom02-flash-spi -p replay:session.jsonl@max image.bin
+
+The transcript is a JSON Lines file: header {"version": 1, "port": ..., "baudrate": ...}
+followed by events {"t": seconds, "tx": data, "duration": seconds}, {"t": seconds, "rx": data}
+and {"t": seconds, "baudrate": value}. Time of "tx" is the end of the write, "duration" of the
+write is stored if it is long (e.g. the port is slower than the host). Data is stored as
+Latin-1 text, so the terminal output stays readable.
+"""
+
+import collections
+import json
+import time
+
+from mcom02_flash_tools import ReplayError
+
+VERSION = 1
+REPLAY_PREFIX = 'replay:'
+# Shorter duration of write to the port is not recorded
+MIN_WRITE_DURATION = 0.001
+
+
+def is_replay_port(port):
+    return isinstance(port, str) and port.startswith(REPLAY_PREFIX)
+
+
+class RecordingSerial(object):
+    """Wrapper of serial port `tty` which records the exchange to transcript file `path`.
+    The file is line buffered, so the transcript is kept if the tool is killed.
+    """
+
+    def __init__(self, tty, path):
+        self.tty = tty
+        self._file = open(path, 'w', buffering=1)
+        self._start = time.monotonic()
+        header = {'version': VERSION, 'port': tty.port, 'baudrate': tty.baudrate}
+        self._file.write(json.dumps(header) + '\n')
+
+    def _log(self, key, value, **extra):
+        event = {'t': round(time.monotonic() - self._start, 6), key: value}
+        event.update(extra)
+        self._file.write(json.dumps(event) + '\n')
+
+    def read(self, size=1):
+        data = self.tty.read(size)
+        if data:
+            self._log('rx', data.decode('latin-1'))
+        return data
+
+    def write(self, data):
+        # Write blocks until the data is sent, responses are timed from the end of the data
+        start = time.monotonic()
+        result = self.tty.write(data)
+        duration = time.monotonic() - start
+        extra = {'duration': round(duration, 6)} if duration >= MIN_WRITE_DURATION else {}
+        self._log('tx', bytes(data).decode('latin-1'), **extra)
+        return result
+
+    @property
+    def baudrate(self):
+        return self.tty.baudrate
+
+    @baudrate.setter
+    def baudrate(self, value):
+        self._log('baudrate', value)
+        self.tty.baudrate = value
+
+    def close(self):
+        self._file.close()
+        self.tty.close()
+
+    def detach(self):
+        """Close the transcript file and return the wrapped port which stays open."""
+        self._file.close()
+        return self.tty
+
+    def __getattr__(self, name):
+        return getattr(self.tty, name)
+
+
+def load_transcript(path):
+    """Return header and list of events (time, key, value, duration) of transcript file."""
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get('version') != VERSION:
+            raise ValueError('unsupported transcript version {}'.format(header.get('version')))
+        events = []
+        for line in f:
+            event = json.loads(line)
+            t = event.pop('t')
+            duration = event.pop('duration', 0.0)
+            ((key, value),) = event.items()
+            if key in ('tx', 'rx'):
+                value = value.encode('latin-1')
+            events.append((t, key, value, duration))
+    return header, events
+
+
+class ReplaySerial(object):
+    """Fake serial port which replays transcript file `path` (see RecordingSerial).
+
+    Parameters
+    ----------
+    path : str
+        transcript file
+    speed : float
+        replay speed relative to the recorded one, None - without delays
+    strict : bool
+        if True then ReplayError is raised when the host sends data which differs from the
+        recorded one, otherwise the difference is added to `divergences`
+    timeout : float
+        read timeout in seconds, None - infinite
+    """
+
+    def __init__(self, path, speed=1.0, strict=True, timeout=None):
+        header, events = load_transcript(path)
+        self.path = path
+        self.port = header.get('port')
+        self.baudrate = header.get('baudrate')
+        self.timeout = timeout
+        self.speed = speed or None
+        self.strict = strict
+        self.divergences = []
+        self.is_open = True
+        # Baudrate changes are made by the host, they are not replayed
+        self._events = collections.deque(x for x in events if x[1] != 'baudrate')
+        self._rx = bytearray()
+        # Recorded data of the current tx event which is not sent by the host yet
+        self._expected = bytearray()
+        self._write_duration = 0.0
+        self._sent = 0
+        # Host time and transcript time of the last data sent by the host
+        self._anchor = (time.monotonic(), 0.0)
+
+    @classmethod
+    def from_url(cls, url, timeout=None):
+        """Return ReplaySerial for port name "replay:FILE" or "replay:FILE@SPEED"."""
+        path = url[len(REPLAY_PREFIX) :]
+        speed = 1.0
+        if '@' in path:
+            head, tail = path.rsplit('@', 1)
+            try:
+                speed = None if tail == 'max' else float(tail)
+                path = head
+            except ValueError:
+                pass
+        return cls(path, speed, timeout=timeout)
+
+    @property
+    def remaining(self):
+        """Count of events which are not replayed."""
+        return len(self._events) + bool(self._expected)
+
+    def _due(self, t):
+        # Host time when data recorded at transcript time `t` is received
+        host_time, transcript_time = self._anchor
+        if self.speed is None:
+            return host_time
+        return host_time + (t - transcript_time) / self.speed
+
+    def _release(self, now, force=False):
+        # Move received data which is due (all preceding data if `force`) to input buffer
+        while self._events and self._events[0][1] == 'rx':
+            t, _, data, _ = self._events[0]
+            if not force and self._due(t) > now:
+                break
+            self._rx += data
+            self._events.popleft()
+
+    def _diverge(self, message):
+        if self.strict:
+            raise ReplayError('Replay of {}: {}'.format(self.path, message))
+        self.divergences.append(message)
+
+    def write(self, data):
+        data = bytes(data)
+        pos = 0
+        while pos < len(data):
+            if not self._expected:
+                # Data recorded before the host sent the next data is received anyway
+                self._release(time.monotonic(), force=True)
+                if not self._events:
+                    self._diverge('unexpected data after the end {!r}'.format(data[pos:]))
+                    return len(data)
+                t, _, expected, self._write_duration = self._events.popleft()
+                self._expected = bytearray(expected)
+                self._anchor = (time.monotonic(), t)
+            count = min(len(self._expected), len(data) - pos)
+            chunk = data[pos : pos + count]
+            expected = bytes(self._expected[:count])
+            if chunk != expected:
+                i = next(i for i in range(count) if chunk[i] != expected[i])
+                self._diverge(
+                    'host sent {!r} at byte {}, recorded {!r}'.format(
+                        chunk[i : i + 16], self._sent + i, expected[i : i + 16]
+                    )
+                )
+            del self._expected[:count]
+            self._sent += count
+            pos += count
+            if not self._expected and self.speed is not None:
+                # Write takes the recorded time of sending the data
+                time.sleep(self._write_duration / self.speed)
+            # Responses are timed from the end of the sent data
+            self._anchor = (time.monotonic(), self._anchor[1])
+        return len(data)
+
+    def read(self, size=1):
+        now = time.monotonic()
+        deadline = now + self.timeout if self.timeout is not None else None
+        while True:
+            self._release(now)
+            if self._rx:
+                data = bytes(self._rx[:size])
+                del self._rx[:size]
+                return data
+            wait_until = deadline
+            if self._events and self._events[0][1] == 'rx' and not self._expected:
+                due = self._due(self._events[0][0])
+                wait_until = due if deadline is None else min(due, deadline)
+            if wait_until is None:
+                raise ReplayError(
+                    'Replay of {}: host waits for data which is not recorded'.format(self.path)
+                )
+            if now >= wait_until:
+                return b''
+            time.sleep(wait_until - now)
+            now = time.monotonic()
+
+    @property
+    def in_waiting(self):
+        if not self._expected:
+            self._release(time.monotonic())
+        return len(self._rx)
+
+    def reset_input_buffer(self):
+        self._rx.clear()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
@@ -0,0 +1,329 @@
+// SPDX-License-Identifier: MIT
+// Copyright 2024 RnD Center "ELVEES", JSC
+//
+// Second-stage SPI flash programmer for MCom-02.
+//
+// The program is loaded to on-chip RAM through BootROM UART terminal (Intel-HEX upload with
+// "autorun 1") and programs SPI flash on SPI0 with data received in binary frames over UART0.
+// Frame format is described in mcom02_flash_tools/stub.py:
+//
+//   magic (1) | command or status (1) | length (2) | offset (4) | payload | CRC32 (4)
+//
+// Multibyte fields are little endian, CRC32 (as zlib.crc32) covers header and payload.
+
+#include <stdint.h>
+
+#define REG(addr) (*(volatile uint32_t *)(addr))
+
+#define GATE_SYS_CTR 0x3809404C
+#define CLK_SPI0_EN (1 << 19)
+#define SWPORTD_CTL 0x3803402C
+#define SPI0_PINS ((1 << 15) | (1 << 16) | (1 << 17) | (1 << 18))
+
+#define UART0_BASE 0x38028000
+#define UART_RBR (UART0_BASE + 0x00)
+#define UART_THR (UART0_BASE + 0x00)
+#define UART_LSR (UART0_BASE + 0x14)
+#define LSR_DR (1 << 0)
+#define LSR_THRE (1 << 5)
+
+#define SPI0_BASE 0x38032000
+#define SPI_CTRL0 (SPI0_BASE + 0x00)
+#define SPI_SSIENR (SPI0_BASE + 0x08)
+#define SPI_SER (SPI0_BASE + 0x10)
+#define SPI_BAUDR (SPI0_BASE + 0x14)
+#define SPI_SR (SPI0_BASE + 0x28)
+#define SPI_DR (SPI0_BASE + 0x60)
+#define SPI_SS_TOGGLE (SPI0_BASE + 0xF4)
+#define SR_BUSY (1 << 0)
+#define SR_TFNF (1 << 1)
+#define SR_RFNE (1 << 3)
+#define SPI_FIFO_DEPTH 32
+#define FRAME_SIZE_8BIT 0x7
+
+#define FLASH_WRITE_STATUS 0x01
+#define FLASH_PAGE_PROGRAM 0x02
+#define FLASH_READ 0x03
+#define FLASH_READ_STATUS 0x05
+#define FLASH_WRITE_ENABLE 0x06
+#define FLASH_READ_ID 0x9F
+#define FLASH_BLOCK_ERASE 0xD8
+#define FLASH_STATUS_WIP (1 << 0)
+#define FLASH_PAGE_SIZE 256
+
+#define MAGIC_HOST 0xA5
+#define MAGIC_STUB 0x5A
+#define PROTOCOL_VERSION 1
+#define MAX_PAYLOAD 4096
+#define HEADER_SIZE 8
+
+#define CMD_HELLO 'H'
+#define CMD_UNLOCK 'U'
+#define CMD_ERASE 'E'
+#define CMD_WRITE 'W'
+#define CMD_CRC 'C'
+
+#define STATUS_OK 0
+#define STATUS_BAD_CRC 1
+#define STATUS_BAD_COMMAND 2
+#define STATUS_BAD_LENGTH 3
+
+static uint32_t crc_table[256];
+static uint8_t frame[HEADER_SIZE + MAX_PAYLOAD + 4];
+static uint8_t page[4 + FLASH_PAGE_SIZE];
+
+void main(void);
+
+void __attribute__((naked, section(".text.start"))) _start(void)
+{
+	__asm__ volatile("ldr sp, =__stack_top\n"
+			 "b main\n");
+}
+
+static void crc_init(void)
+{
+	for (uint32_t i = 0; i < 256; i++) {
+		uint32_t c = i;
+
+		for (int k = 0; k < 8; k++)
+			c = c & 1 ? 0xEDB88320 ^ (c >> 1) : c >> 1;
+		crc_table[i] = c;
+	}
+}
+
+static uint32_t crc_update(uint32_t crc, const uint8_t *buf, uint32_t len)
+{
+	while (len--)
+		crc = crc_table[(crc ^ *buf++) & 0xFF] ^ (crc >> 8);
+	return crc;
+}
+
+static uint32_t get_le(const uint8_t *buf, int size)
+{
+	uint32_t value = 0;
+
+	while (size--)
+		value = value << 8 | buf[size];
+	return value;
+}
+
+static void put_le(uint8_t *buf, uint32_t value, int size)
+{
+	for (int i = 0; i < size; i++, value >>= 8)
+		buf[i] = value & 0xFF;
+}
+
+static uint8_t uart_getc(void)
+{
+	while (!(REG(UART_LSR) & LSR_DR))
+		;
+	return REG(UART_RBR) & 0xFF;
+}
+
+static void uart_putc(uint8_t c)
+{
+	while (!(REG(UART_LSR) & LSR_THRE))
+		;
+	REG(UART_THR) = c;
+}
+
+static void spi_init(void)
+{
+	REG(GATE_SYS_CTR) |= CLK_SPI0_EN;
+	REG(SWPORTD_CTL) |= SPI0_PINS;
+	REG(SPI_SSIENR) = 0;
+	REG(SPI_CTRL0) = FRAME_SIZE_8BIT;
+	REG(SPI_BAUDR) = 2;  // 12 MHz
+	REG(SPI_SS_TOGGLE) = 0;
+	REG(SPI_SER) = 1;
+}
+
+// Transmit `tx_len` bytes and then receive `rx_len` bytes in one SPI transaction.
+// Slave select is deasserted when TX FIFO is empty so the FIFO is refilled without pauses.
+static void spi_xfer(const uint8_t *tx, uint32_t tx_len, uint8_t *rx, uint32_t rx_len)
+{
+	uint32_t total = tx_len + rx_len, sent = 0, received = 0;
+
+	REG(SPI_SSIENR) = 1;
+	while (received < total) {
+		if (sent < total && sent - received < SPI_FIFO_DEPTH && (REG(SPI_SR) & SR_TFNF)) {
+			REG(SPI_DR) = sent < tx_len ? tx[sent] : 0;
+			sent++;
+		}
+		if (REG(SPI_SR) & SR_RFNE) {
+			uint8_t c = REG(SPI_DR) & 0xFF;
+
+			if (received >= tx_len)
+				rx[received - tx_len] = c;
+			received++;
+		}
+	}
+	while (REG(SPI_SR) & SR_BUSY)
+		;
+	REG(SPI_SSIENR) = 0;
+}
+
+static void flash_cmd(uint8_t cmd)
+{
+	spi_xfer(&cmd, 1, 0, 0);
+}
+
+static void flash_wait(void)
+{
+	uint8_t cmd = FLASH_READ_STATUS, status;
+
+	do
+		spi_xfer(&cmd, 1, &status, 1);
+	while (status & FLASH_STATUS_WIP);
+}
+
+static void flash_addr_cmd(uint8_t cmd, uint32_t offset)
+{
+	page[0] = cmd;
+	page[1] = offset >> 16;
+	page[2] = offset >> 8;
+	page[3] = offset;
+}
+
+static void flash_unlock(void)
+{
+	uint8_t cmd[2] = {FLASH_WRITE_STATUS, 0};
+
+	flash_cmd(FLASH_WRITE_ENABLE);
+	spi_xfer(cmd, sizeof(cmd), 0, 0);
+	flash_wait();
+}
+
+static void flash_erase(uint32_t offset)
+{
+	flash_cmd(FLASH_WRITE_ENABLE);
+	flash_addr_cmd(FLASH_BLOCK_ERASE, offset);
+	spi_xfer(page, 4, 0, 0);
+	flash_wait();
+}
+
+static void flash_program(uint32_t offset, const uint8_t *data, uint32_t len)
+{
+	while (len) {
+		uint32_t chunk = FLASH_PAGE_SIZE - offset % FLASH_PAGE_SIZE;
+
+		if (chunk > len)
+			chunk = len;
+		flash_cmd(FLASH_WRITE_ENABLE);
+		flash_addr_cmd(FLASH_PAGE_PROGRAM, offset);
+		for (uint32_t i = 0; i < chunk; i++)
+			page[4 + i] = data[i];
+		spi_xfer(page, 4 + chunk, 0, 0);
+		flash_wait();
+		offset += chunk;
+		data += chunk;
+		len -= chunk;
+	}
+}
+
+static uint32_t flash_crc(uint32_t offset, uint32_t len)
+{
+	uint32_t crc = 0xFFFFFFFF;
+
+	while (len) {
+		uint32_t chunk = len < FLASH_PAGE_SIZE ? len : FLASH_PAGE_SIZE;
+
+		flash_addr_cmd(FLASH_READ, offset);
+		spi_xfer(page, 4, page + 4, chunk);
+		crc = crc_update(crc, page + 4, chunk);
+		offset += chunk;
+		len -= chunk;
+	}
+	return ~crc;
+}
+
+static void send_frame(uint8_t status, uint32_t offset, const uint8_t *payload, uint32_t len)
+{
+	uint8_t header[HEADER_SIZE], crc[4];
+
+	header[0] = MAGIC_STUB;
+	header[1] = status;
+	put_le(header + 2, len, 2);
+	put_le(header + 4, offset, 4);
+	put_le(crc, ~crc_update(crc_update(0xFFFFFFFF, header, HEADER_SIZE), payload, len), 4);
+	for (int i = 0; i < HEADER_SIZE; i++)
+		uart_putc(header[i]);
+	for (uint32_t i = 0; i < len; i++)
+		uart_putc(payload[i]);
+	for (int i = 0; i < 4; i++)
+		uart_putc(crc[i]);
+}
+
+// Receive frame to `frame` buffer. Return status for answer.
+static uint8_t receive_frame(void)
+{
+	uint32_t len;
+
+	while ((frame[0] = uart_getc()) != MAGIC_HOST)
+		;
+	for (int i = 1; i < HEADER_SIZE; i++)
+		frame[i] = uart_getc();
+	len = get_le(frame + 2, 2);
+	if (len > MAX_PAYLOAD)
+		return STATUS_BAD_LENGTH;
+	for (uint32_t i = HEADER_SIZE; i < HEADER_SIZE + len + 4; i++)
+		frame[i] = uart_getc();
+	if (~crc_update(0xFFFFFFFF, frame, HEADER_SIZE + len) != get_le(frame + HEADER_SIZE + len, 4))
+		return STATUS_BAD_CRC;
+	return STATUS_OK;
+}
+
+void main(void)
+{
+	uint8_t answer[6];
+
+	crc_init();
+	spi_init();
+
+	// Hello frame: protocol version, maximum payload size and JEDEC ID of SPI flash
+	answer[0] = FLASH_READ_ID;
+	spi_xfer(answer, 1, answer + 3, 3);
+	answer[0] = PROTOCOL_VERSION;
+	put_le(answer + 1, MAX_PAYLOAD, 2);
+	send_frame(STATUS_OK, 0, answer, 6);
+
+	for (;;) {
+		uint8_t status = receive_frame();
+		uint32_t len = get_le(frame + 2, 2);
+		uint32_t offset = get_le(frame + 4, 4);
+		uint8_t *payload = frame + HEADER_SIZE;
+
+		if (status != STATUS_OK) {
+			send_frame(status, offset, 0, 0);
+			continue;
+		}
+
+		switch (frame[1]) {
+		case CMD_HELLO:
+			send_frame(STATUS_OK, offset, answer, 6);
+			break;
+		case CMD_UNLOCK:
+			flash_unlock();
+			send_frame(STATUS_OK, offset, 0, 0);
+			break;
+		case CMD_ERASE:
+			flash_erase(offset);
+			send_frame(STATUS_OK, offset, 0, 0);
+			break;
+		case CMD_WRITE:
+			flash_program(offset, payload, len);
+			send_frame(STATUS_OK, offset, 0, 0);
+			break;
+		case CMD_CRC:
+			if (len != 4) {
+				send_frame(STATUS_BAD_LENGTH, offset, 0, 0);
+				break;
+			}
+			put_le(payload, flash_crc(offset, get_le(payload, 4)), 4);
+			send_frame(STATUS_OK, offset, payload, 4);
+			break;
+		default:
+			send_frame(STATUS_BAD_COMMAND, offset, 0, 0);
+		}
+	}
+}
@@ -33,3 +33,14 @@ def uip_term(request):
 @pytest.fixture(scope="session")
 def img_path(request):
     return request.config.getoption("--img")
+
+
+@pytest.fixture(autouse=True)
+def xdg_dirs(tmp_path, monkeypatch):
+    """Keep cache, profiles and journals of the tools run by tests in temporary directory.
+    The tools do not forward jobs to mcom02-flash-daemon of the user.
+    """
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "xdg-cache"))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "xdg-config"))
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path / "xdg-runtime"))
+    monkeypatch.delenv("MCOM02_FLASH_DAEMON_SOCKET", raising=False)
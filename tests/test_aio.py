@@ -0,0 +1,141 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import asyncio
+import os
+import time
+import tty
+
+import pytest
+
+from mcom02_flash_tools import CommandError
+from mcom02_flash_tools.aio import AsyncUART, SyncUART
+from mcom02_flash_tools.benchmark import benchmark, benchmark_factory
+from mcom02_flash_tools.emulator import UBootEmulator
+
+
+def open_pty():
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    return master, slave
+
+
+@pytest.mark.noboard
+def test_async_wait_for_string():
+    master, slave = open_pty()
+
+    async def main():
+        uart = AsyncUART(prompt="mcom# ", port=os.ttyname(slave))
+        os.write(master, b"Hit any key to stop autoboot:  1 mcom# second\r\nmcom# ")
+        results = [
+            await uart.wait_for_string(["mcom# ", "Hit any key to stop autoboot:"]),
+            await uart.wait_for_string("mcom# "),
+            await uart.wait_for_string("mcom# "),
+            await uart.wait_for_string("mcom# ", timeout=0.1),
+        ]
+        uart.close()
+        return results
+
+    try:
+        results = asyncio.run(main())
+    finally:
+        os.close(master)
+        os.close(slave)
+
+    assert results == [
+        (True, "Hit any key to stop autoboot:"),
+        (True, "  1 mcom# "),
+        (True, "second\nmcom# "),
+        (False, ""),
+    ]
+
+
+@pytest.mark.noboard
+def test_async_many_consoles():
+    count = 100
+    ptys = [open_pty() for _ in range(count)]
+
+    async def main():
+        uarts = [AsyncUART(prompt="mcom# ", port=os.ttyname(x)) for _, x in ptys]
+        tasks = [asyncio.ensure_future(x.run("cmd{}".format(i))) for i, x in enumerate(uarts)]
+        # consoles wait for the answers without using CPU
+        cpu_time = time.process_time()
+        await asyncio.sleep(0.5)
+        cpu_time = time.process_time() - cpu_time
+        for i, (master, _) in reversed(list(enumerate(ptys))):
+            assert os.read(master, 64) == "cmd{}\n".format(i).encode()
+            os.write(master, "cmd{0}\r\nout{0}\r\nmcom# ".format(i).encode())
+        results = await asyncio.wait_for(asyncio.gather(*tasks), 5)
+        for uart in uarts:
+            uart.close()
+        return cpu_time, results
+
+    try:
+        cpu_time, results = asyncio.run(main())
+    finally:
+        for master, slave in ptys:
+            os.close(master)
+            os.close(slave)
+
+    assert results == ["out{}\n".format(i) for i in range(count)]
+    assert cpu_time < 0.1
+
+
+@pytest.mark.noboard
+def test_async_run_with_retcode():
+    emulators = [UBootEmulator(baudrate=0) for _ in range(4)]
+
+    async def session(emulator, i):
+        uart = AsyncUART(prompt="\nmcom# ", port=emulator.port, window=3)
+        try:
+            assert await uart.wait_for_uboot(timeout=10, show_status=False)
+            await uart.run_batch_with_retcode(["setenv a {}".format(i), "setenv b 2"])
+            retcode, _ = await uart.run_with_retcode("env print nonexistent", check=False)
+            with pytest.raises(CommandError, match="No variable"):
+                await uart.run_with_retcode("env print nonexistent", errmsg="No variable")
+            unstripped = await uart.run_with_retcode("echo x", strip_echo=False)
+            assert unstripped == (0, "echo x\nx\nmcom# ")
+            return retcode, await uart.run_with_retcode("echo $a")
+        finally:
+            uart.close()
+
+    async def main():
+        return await asyncio.gather(*(session(x, i) for i, x in enumerate(emulators)))
+
+    for emulator in emulators:
+        emulator.__enter__()
+    try:
+        results = asyncio.run(main())
+    finally:
+        for emulator in emulators:
+            emulator.__exit__(None, None, None)
+
+    assert results == [(1, (0, str(i))) for i in range(len(emulators))]
+    assert all(x.env["b"] == "2" for x in emulators)
+
+
+@pytest.mark.noboard
+def test_sync_uart_negotiate_baudrate():
+    with UBootEmulator(power_on="prompt", baudrate=115200, max_baudrate=921600) as emulator:
+        uart = SyncUART(prompt="\nmcom# ", port=emulator.port)
+        assert uart.negotiate_baudrate(uart.set_uboot_baudrate, 3000000) == 921600
+        assert uart.run_with_retcode("echo ok") == (0, "ok")
+        assert uart.retcode_mode == "inline"
+        uart.restore_baudrate()
+        assert uart.tty.baudrate == 115200
+        assert uart.run_batch(["echo 1", "echo 2"]) == ["1", "2"]
+        uart.close()
+
+    assert emulator.baudrate == 115200
+
+
+@pytest.mark.noboard
+def test_sync_uart_tools(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(0xC000 + 3))
+
+    result = benchmark(str(file_name), baudrate=0, extra_args=["--async-uart"])
+    assert result["retcode"] == 0
+    assert result["flashed"]
+
+    result = benchmark_factory(["--async-uart", "print"])
+    assert result["retcode"] == 0
@@ -0,0 +1,94 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import os
+
+import pytest
+
+from mcom02_flash_tools import FlashMemoryError, PortError, VerificationError
+from mcom02_flash_tools.api import BOOTROM, UBOOT, FlashSession
+from mcom02_flash_tools.emulator import BootROMEmulator, SPIFlashModel, UBootEmulator
+
+
+@pytest.mark.noboard
+def test_session_flash_and_verify(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    image = os.urandom(0xC000 + 0x1001)
+    file_name.write_bytes(image)
+    messages = []
+
+    with BootROMEmulator(baudrate=0) as emulator:
+        with FlashSession.open(emulator.port, BOOTROM, progress=messages.append) as session:
+            # commands are not pipelined unless the window is specified
+            assert session.uart.window == 1
+            result = session.flash_spi(str(file_name), verify_each=True)
+            # the second operation uses the same connection
+            checked = session.verify_spi(str(file_name))
+            emulator.flash.data[0x100] ^= 0xFF
+            with pytest.raises(VerificationError) as e:
+                session.verify_spi(str(file_name), count=0x200)
+
+    assert result.verified
+    assert result.bytes_written == len(image)
+    assert result.bytes_checked == len(image)
+    assert [x["attempts"] for x in result.blocks] == [1, 1]
+    assert set(result.timings) == {"write"}
+    assert result.duration >= result.timings["write"]
+    assert checked.verified and checked.bytes_checked == len(image)
+    assert e.value.result.bytes_checked == 0x200
+    assert not e.value.result.verified
+    assert "Writing to flash with checking of every block..." in messages
+    assert "Checking..." in messages
+
+
+@pytest.mark.noboard
+def test_session_errors(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(512 * 1024 + 1))
+
+    with pytest.raises(PortError):
+        FlashSession.open(str(tmp_path / "nonexistent"))
+
+    with BootROMEmulator(baudrate=0, flash=SPIFlashModel(jedec_id=0x1F4401)) as emulator:
+        with FlashSession.open(emulator.port) as session:
+            with pytest.raises(FlashMemoryError, match="exceeds capacity"):
+                session.flash_spi(str(file_name))
+            with pytest.raises(ValueError):
+                session.factory_read()
+
+
+@pytest.mark.noboard
+def test_session_uboot(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    image = os.urandom(0x10000 + 3)
+    file_name.write_bytes(image)
+    settings = {"factory_serial": "112233", "factory_eth_mac": "00:11:22:33:44:55"}
+
+    with UBootEmulator(baudrate=0, flash=SPIFlashModel(protected=False)) as emulator:
+        with FlashSession.open(emulator.port, UBOOT) as session:
+            written = session.factory_flash(settings)
+            read = session.factory_read()
+            flashed = session.flash_spi(str(file_name))
+            cleared = session.factory_clear()
+            empty = session.factory_read()
+
+    assert written.settings == settings
+    assert read.settings == settings
+    assert flashed.verified
+    assert flashed.bytes_written == flashed.bytes_checked == len(image)
+    assert set(flashed.timings) == {"send", "write", "check"}
+    assert cleared.settings is None
+    assert empty.settings is None
+
+
+@pytest.mark.noboard
+def test_session_close_lost_link():
+    messages = []
+    with UBootEmulator(power_on="prompt", baudrate=115200, max_baudrate=921600) as emulator:
+        session = FlashSession.open(emulator.port, UBOOT, progress=messages.append)
+        session.set_baudrate(921600)
+        emulator.stop()
+        # the baudrate can not be restored, the port is closed anyway
+        session.close()
+
+    assert not session.uart.tty.is_open
+    assert messages[-1].startswith("Warning: ")
@@ -0,0 +1,50 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import os
+
+import pytest
+
+from mcom02_flash_tools.cache import BlockCache
+
+
+def put(cache, data):
+    key = BlockCache.key(data, "c000")
+    return key, cache.put(key, {"upload": [data[:3], data[3:]], "dump": []})
+
+
+@pytest.mark.noboard
+def test_cache_entry(tmp_path):
+    cache = BlockCache(str(tmp_path))
+    data = b"0123456789"
+    key, entry = put(cache, data)
+
+    assert key == BlockCache.key(bytearray(data), "c000")
+    assert key != BlockCache.key(data, "8000")
+    assert [bytes(x) for x in entry.chunks("upload")] == [b"012", b"3456789"]
+    assert list(cache.get(key).chunks("dump")) == []
+    assert cache.get(BlockCache.key(b"other", "c000")) is None
+
+    # truncated stream file is not valid
+    with open(os.path.join(entry.path, "upload"), "r+b") as f:
+        f.truncate(5)
+    assert cache.get(key) is None
+
+
+@pytest.mark.noboard
+def test_cache_eviction(tmp_path):
+    cache = BlockCache(str(tmp_path), max_size=0)
+    keys = []
+    for i in range(3):
+        key, _ = put(cache, bytes([i]) * 1000)
+        keys.append(key)
+        # the last written entry is kept even if it exceeds the limit
+        assert sorted(os.listdir(str(tmp_path))) == [key]
+
+    cache.max_size = 3500
+    keys = [put(cache, bytes([i]) * 1000)[0] for i in range(3)]
+    # the least recently used entry is removed
+    os.utime(os.path.join(str(tmp_path), keys[0], "index.json"), (0, 0))
+    assert cache.get(keys[1]) is not None
+    put(cache, b"\xff" * 1000)
+    assert keys[0] not in os.listdir(str(tmp_path))
+    assert keys[1] in os.listdir(str(tmp_path))
@@ -0,0 +1,147 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+import pytest
+
+from mcom02_flash_tools.daemon import SOCKET_ENV, Daemon, forward_job
+from mcom02_flash_tools.emulator import BootROMEmulator, SPIFlashModel, UBootEmulator
+
+
+@pytest.fixture
+def daemon(monkeypatch):
+    # Path of Unix socket is limited to 108 bytes
+    directory = tempfile.mkdtemp(prefix="mcom02-")
+    path = os.path.join(directory, "daemon.sock")
+    monkeypatch.setenv(SOCKET_ENV, path)
+    daemon = Daemon(path)
+    daemon.bind()
+    thread = threading.Thread(target=daemon.serve_forever)
+    thread.start()
+    yield daemon
+    daemon.shutdown()
+    thread.join()
+    daemon.close()
+    shutil.rmtree(directory)
+
+
+def run_tool(module, args):
+    cmd = [sys.executable, "-m", "mcom02_flash_tools.{}".format(module)] + args
+    return subprocess.run(cmd, capture_output=True, universal_newlines=True, timeout=60)
+
+
+@pytest.mark.noboard
+def test_daemon_flash_and_verify(tmp_path, monkeypatch, daemon):
+    image = os.urandom(0xC000 + 0x1000)
+    (tmp_path / "test_file.img").write_bytes(image)
+    flash = SPIFlashModel(jedec_id=0x20BA18)
+
+    with BootROMEmulator(baudrate=0, flash=flash) as emulator:
+        args = ["-p", emulator.port, "test_file.img"]
+        # relative path is resolved by the client
+        monkeypatch.chdir(tmp_path)
+        flashed = run_tool("mcom02_flash_spi", args)
+        verified = run_tool("mcom02_flash_spi", ["--verify"] + args)
+        flash.data[0x100] ^= 0xFF
+        corrupted = run_tool("mcom02_flash_spi", ["--verify"] + args)
+        local = run_tool("mcom02_flash_spi", ["--verify", "--no-daemon"] + args)
+
+    assert flashed.returncode == 0
+    assert "Writing to flash" in flashed.stdout
+    assert "Checking succeeded" in flashed.stdout
+    assert verified.returncode == 0
+    assert "Writing to flash" not in verified.stdout
+    assert "Checking succeeded" in verified.stdout
+    assert corrupted.returncode == 1
+    assert "Checking failed" in corrupted.stderr
+    assert local.returncode == 1
+    assert daemon.jobs == 3
+    # the port is kept open between jobs
+    assert list(daemon.pool._ports) == [emulator.port]
+
+
+@pytest.mark.noboard
+def test_daemon_busy_port(tmp_path, daemon):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(0x8000))
+
+    with BootROMEmulator(baudrate=0) as emulator:
+        cmd = [sys.executable, "-m", "mcom02_flash_tools.mcom02_flash_spi"]
+        cmd += ["-p", emulator.port, str(file_name)]
+        processes = [
+            subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True) for _ in range(2)
+        ]
+        outputs = [x.communicate(timeout=60)[0] for x in processes]
+
+    assert [x.returncode for x in processes] == [0, 0]
+    assert all("Checking succeeded" in x for x in outputs)
+    assert sum("is busy, waiting" in x for x in outputs) == 1
+
+
+@pytest.mark.noboard
+def test_daemon_factory(daemon):
+    with UBootEmulator(baudrate=0) as emulator:
+        args = ["-p", emulator.port, "-t", "10"]
+        flashed = run_tool("mcom02_flash_factory", args + ["flash", "factory_serial=112233"])
+        printed = run_tool("mcom02_flash_factory", args + ["print"])
+
+    assert flashed.returncode == 0
+    assert printed.returncode == 0
+    assert "factory_serial=112233" in printed.stdout
+    assert daemon.jobs == 2
+
+
+@pytest.mark.noboard
+def test_daemon_releases_consoles(tmp_path, daemon):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(0x1000))
+    transcript = tmp_path / "spi.jsonl"
+
+    with BootROMEmulator(baudrate=0) as emulator:
+        args = ["-p", emulator.port, str(file_name)]
+        # the first job opens the port kept by the daemon
+        assert run_tool("mcom02_flash_spi", args).returncode == 0
+        fds = len(os.listdir("/proc/self/fd"))
+        assert run_tool("mcom02_flash_spi", ["--async-uart"] + args).returncode == 0
+        assert run_tool("mcom02_flash_spi", ["--record", str(transcript)] + args).returncode == 0
+        # event loop of SyncUART and transcript file are closed, the port stays open
+        assert len(os.listdir("/proc/self/fd")) == fds
+        assert run_tool("mcom02_flash_spi", args).returncode == 0
+
+    assert daemon.jobs == 4
+    assert list(daemon.pool._ports) == [emulator.port]
+    assert transcript.read_text().rstrip().endswith("}")
+
+
+@pytest.mark.noboard
+def test_forward_job_not_running(tmp_path, monkeypatch):
+    monkeypatch.setenv(SOCKET_ENV, str(tmp_path / "daemon.sock"))
+    assert forward_job("mcom02_flash_spi", object()) is None
+
+
+@pytest.mark.noboard
+def test_forward_job_replay_port(daemon):
+    args = argparse.Namespace(port="replay:session.jsonl")
+    assert forward_job("mcom02_flash_spi", args) is None
+    assert daemon.jobs == 0
+
+
+@pytest.mark.noboard
+def test_tools_without_unix_sockets():
+    # Windows: socket.AF_UNIX and socketserver.UnixStreamServer are not defined
+    code = (
+        "import argparse, socket, socketserver\n"
+        "del socket.AF_UNIX, socketserver.UnixStreamServer\n"
+        "import mcom02_flash_tools.mcom02_flash_factory\n"
+        "import mcom02_flash_tools.mcom02_flash_spi\n"
+        "from mcom02_flash_tools.daemon import forward_job\n"
+        "assert forward_job('mcom02_flash_spi', argparse.Namespace(port='COM1')) is None\n"
+    )
+    proc = subprocess.run([sys.executable, "-c", code], capture_output=True, timeout=60)
+    assert proc.returncode == 0, proc.stderr.decode()
@@ -0,0 +1,53 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import os
+
+import pytest
+
+from mcom02_flash_tools.emulator import BootROMEmulator
+from mcom02_flash_tools.mcom02_flash_spi import DumpDecoder
+
+
+def dump_output(data, offset, prefix=""):
+    words = [int.from_bytes(data[i : i + 4], "little") for i in range(0, len(data), 4)]
+    cmd = "dumpspiflash {:x} {:x}\r\n".format(offset, len(words))
+    return (cmd + prefix + BootROMEmulator.format_dump(offset, words) + "\r#").encode()
+
+
+@pytest.mark.noboard
+@pytest.mark.parametrize("prefix", ["", "Config spi0... Ok\r\n"], ids=["rev1", "rev0"])
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_dump_decoder(prefix, chunk_size):
+    data = os.urandom(0x400)
+    output = dump_output(data, 0x2000, prefix)
+    decoder = DumpDecoder(0x800)
+    decoder.start(0x2000, 0x100)
+    for pos in range(0, len(output), chunk_size):
+        decoder.feed(output[pos : pos + chunk_size])
+    assert decoder.data(0x3FF) == data[:0x3FF]
+
+
+@pytest.mark.noboard
+def test_dump_decoder_incomplete():
+    data = os.urandom(0x100)
+    output = dump_output(data, 0, "")
+    decoder = DumpDecoder(0x100)
+    decoder.start(0, 0x40)
+    # line of the second word is corrupted
+    decoder.feed(output.replace(b"0x00000004 : 0x", b"0x00000004 ; 0x"))
+    assert decoder.data(0x100) is None
+
+
+@pytest.mark.noboard
+def test_dump_decoder_corrupted_address():
+    data = os.urandom(0x100)
+    output = dump_output(data, 0, "")
+    decoder = DumpDecoder(0x100)
+    decoder.start(0, 0x40)
+    decoder.feed(output)
+    assert decoder.data(0x100) == data
+    # the same block again: the address of the second word is corrupted to the address of
+    # the third word, the count of lines is right but the second word is missing
+    decoder.start(0, 0x40)
+    decoder.feed(output.replace(b"0x00000004 : 0x", b"0x00000008 : 0x"))
+    assert decoder.data(0x100) is None
@@ -0,0 +1,404 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import zlib
+
+import pytest
+import serial
+
+from mcom02_flash_tools import UART
+from mcom02_flash_tools.benchmark import (
+    benchmark,
+    benchmark_factory,
+    benchmark_ums,
+    make_stub_placeholder,
+    run_tool,
+)
+from mcom02_flash_tools.emulator import BootROMEmulator, SPIFlashModel, UBootEmulator
+from mcom02_flash_tools.mcom02_flash_spi import SPI0Controller
+
+
+def round_trips(result):
+    return sum(x["commands"] for x in result["phases"].values())
+
+
+def read_factory_settings(emulator):
+    offset = int(emulator.env["factoryoffset"], 16)
+    size = int(emulator.env["factorysize"], 16)
+    raw = bytes(emulator.flash.data[offset : offset + size])
+    assert zlib.crc32(raw[4:]) == int.from_bytes(raw[:4], "little")
+    items = raw[4:].split(b"\0\0")[0].decode().split("\0")
+    return dict(x.split("=", 1) for x in items)
+
+
+@pytest.mark.noboard
+@pytest.mark.parametrize(
+    "size",
+    [
+        pytest.param(20 * 1024 + 1, id="odd image (20 KB + 1 B)"),
+        pytest.param(0xC000 + 8, id="two blocks (48 KB + 8 B)"),
+    ],
+)
+@pytest.mark.parametrize("jedec_id", [0x20BA18, 0x1F4701], ids=["micron", "atmel"])
+def test_flash_emulated(tmp_path, size, jedec_id):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(bytes(range(256)) * (size // 256) + b"\x5a" * (size % 256))
+
+    result = benchmark(str(file_name), baudrate=0, jedec_id=jedec_id)
+
+    assert result["retcode"] == 0
+    assert result["flashed"]
+    assert result["phases"]["write"]["rx_bytes"] > 2 * size
+    assert result["phases"]["check"]["tx_bytes"] > 2 * size
+
+
+@pytest.mark.noboard
+@pytest.mark.parametrize("jedec_id", [0x20BA18, 0x1F4701], ids=["micron", "atmel"])
+def test_flash_stub_emulated(tmp_path, jedec_id):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(0x10000 + 4097))
+    stub_file = tmp_path / "stub.hex"
+    make_stub_placeholder(str(stub_file))
+
+    result = benchmark(str(file_name), baudrate=0, jedec_id=jedec_id, stub_file=str(stub_file))
+
+    assert result["retcode"] == 0
+    assert result["flashed"]
+    # data is sent in binary frames
+    assert result["phases"]["write"]["rx_bytes"] < 0x10000 + 4097 + 1024
+
+
+@pytest.mark.noboard
+def test_flash_cached_emulated(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(0xC000 + 0x2000 + 6))
+    cache_dir = tmp_path / "cache"
+    cache_args = ["--cache-dir", str(cache_dir)]
+
+    retcode, _ = run_tool("mcom02_flash_spi", cache_args + ["--prewarm", str(file_name)], True)
+    assert retcode == 0
+    (entry,) = os.listdir(cache_dir)
+    mtime = os.path.getmtime(cache_dir / entry / "upload")
+
+    result = benchmark(str(file_name), baudrate=0, extra_args=cache_args)
+    assert result["retcode"] == 0
+    assert result["flashed"]
+    # partial check (-c) of a size which is not word-aligned reuses the cached upload data
+    result = benchmark(str(file_name), baudrate=0, extra_args=cache_args + ["-c", "8195"])
+    assert result["retcode"] == 0
+    assert result["flashed"]
+    assert os.listdir(cache_dir) == [entry]
+    assert os.path.getmtime(cache_dir / entry / "upload") == mtime
+
+
+@pytest.mark.noboard
+@pytest.mark.parametrize("stub", [False, True], ids=["bootrom", "stub"])
+def test_flash_sparse_emulated(tmp_path, stub):
+    data = os.urandom(0x8000) + b"\xff" * 0x28000 + os.urandom(0x5001)
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(data)
+    stub_file = None
+    if stub:
+        stub_file = tmp_path / "stub.hex"
+        make_stub_placeholder(str(stub_file))
+    flash = SPIFlashModel()
+    flash.data[:] = bytes(len(flash.data))
+
+    result = benchmark(
+        str(file_name),
+        baudrate=0,
+        flash=flash,
+        extra_args=["--sparse"],
+        stub_file=stub_file and str(stub_file),
+    )
+
+    assert result["retcode"] == 0
+    assert result["flashed"]
+    # sectors 0x10000-0x2FFFF are erased and not written
+    assert result["phases"]["write"]["rx_bytes"] < 3 * (len(data) - 0x20000)
+    if not stub:
+        assert result["phases"]["check"]["tx_bytes"] < 7 * (len(data) - 0x20000)
+    # sectors after the image end are not erased
+    assert flash.data[0x40000] == 0
+
+
+@pytest.mark.noboard
+def test_flash_autotune_emulated(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    # every upload block size is measured on its own 64 KiB sector
+    file_name.write_bytes(os.urandom(0x40001))
+    profile = tmp_path / "profile.json"
+    profile_args = ["--profile", str(profile), "--board", "test"]
+
+    result = benchmark(str(file_name), baudrate=0, extra_args=profile_args + ["--autotune"])
+    assert result["retcode"] == 0
+    assert result["flashed"]
+    entry = json.loads(profile.read_text())["test@115200"]
+    assert set(entry["upload"]["rates"]) == {"8192", "16384", "32768", "49152"}
+    assert entry["upload"]["block_size"] in (0x2000, 0x4000, 0x8000, 0xC000)
+    assert entry["check"]["block_size"] in (0x800, 0x1000, 0x2000, 0x4000)
+
+    # the selected block sizes are used by the next run
+    entry["upload"]["block_size"] = 0x2000
+    entry["check"]["block_size"] = 0x4000
+    profile.write_text(json.dumps({"test@115200": entry}))
+    result = benchmark(str(file_name), baudrate=0, extra_args=profile_args)
+    assert result["retcode"] == 0
+    assert result["flashed"]
+    assert result["phases"]["write"]["commands"] > 0x40001 // 0x2000
+    assert result["phases"]["check"]["commands"] < 0x40001 // 0x2000
+
+
+@pytest.mark.noboard
+def test_flash_oversized_emulated(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(512 * 1024 + 1))
+
+    result = benchmark(str(file_name), baudrate=0, flash=SPIFlashModel(jedec_id=0x1F4401))
+
+    assert result["retcode"] == 1
+    # the file is rejected before writing
+    assert "write" not in result["phases"]
+
+
+class FlakyFlash(SPIFlashModel):
+    """Flash which programs zeros instead of data at `offset` `failures` times."""
+
+    def __init__(self, offset, failures):
+        super().__init__()
+        self.offset = offset
+        self.failures = failures
+
+    def program(self, offset, data):
+        if offset == self.offset and self.failures:
+            self.failures -= 1
+            data = bytes(len(data))
+        return super().program(offset, data)
+
+
+@pytest.mark.noboard
+def test_flash_verify_each_retry(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(3 * 0xC000 + 1))
+    flash = FlakyFlash(0xC000, failures=2)
+
+    result = benchmark(str(file_name), baudrate=0, flash=flash, extra_args=["--verify-each"])
+
+    assert result["retcode"] == 0
+    assert result["flashed"]
+    assert flash.failures == 0
+
+
+@pytest.mark.noboard
+def test_flash_verify_each_fail_fast(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(3 * 0xC000 + 1))
+    flash = FlakyFlash(0xC000, failures=100)
+
+    result = benchmark(
+        str(file_name), baudrate=0, flash=flash, extra_args=["--verify-each", "--retries", "1"]
+    )
+
+    assert result["retcode"] == 1
+    assert flash.failures == 98
+    # blocks after the corrupted one are not written
+    assert flash.data[2 * 0xC000 :] == b"\xff" * (len(flash.data) - 2 * 0xC000)
+
+
+@pytest.mark.noboard
+def test_flash_manifest_emulated(tmp_path):
+    boot = os.urandom(0x10000 + 1)
+    env = os.urandom(0x100)
+    (tmp_path / "boot.img").write_bytes(boot)
+    (tmp_path / "env.img").write_bytes(env)
+    manifest_file = tmp_path / "board.yaml"
+    manifest_file.write_text(
+        "regions:\n"
+        "  - {file: boot.img, offset: 0x0}\n"
+        "  - {fill: 0xff, offset: 0x30000, size: 0x20000}\n"
+        "  - {file: env.img, offset: 0x60000, size: 0x10000}\n"
+    )
+    flash = SPIFlashModel()
+    flash.data[:0x70000] = b"\x5a" * 0x70000
+
+    result = benchmark(str(manifest_file), baudrate=0, flash=flash, extra_args=["--manifest"])
+
+    assert result["retcode"] == 0
+    assert bytes(flash.data[: len(boot)]) == boot
+    assert flash.data[0x30000:0x50000] == b"\xff" * 0x20000
+    assert bytes(flash.data[0x60000 : 0x60000 + len(env)]) == env
+    # gaps between the regions are not written
+    assert flash.data[len(boot) + 1 : 0x30000] == b"\x5a" * (0x30000 - len(boot) - 1)
+    assert flash.data[0x50000:0x60000] == b"\x5a" * 0x10000
+    assert result["phases"]["write"]["rx_bytes"] < 3 * (len(boot) + len(env))
+
+
+class StallingFlash(SPIFlashModel):
+    """Flash which records programmed offsets and stalls on programming at `offset` until
+    `release` is set.
+    """
+
+    def __init__(self, offset):
+        super().__init__()
+        self.offset = offset
+        self.programmed = []
+        self.stalled = threading.Event()
+        self.release = threading.Event()
+
+    def program(self, offset, data):
+        self.programmed.append(offset)
+        if offset == self.offset and not self.release.is_set():
+            self.stalled.set()
+            self.release.wait()
+        return super().program(offset, data)
+
+
+@pytest.mark.noboard
+@pytest.mark.parametrize("extra_args", [[], ["--verify-each"]], ids=["check", "verify-each"])
+def test_flash_resume_emulated(tmp_path, extra_args):
+    file_name = tmp_path / "test_file.img"
+    image = os.urandom(4 * 0xC000 + 1)
+    file_name.write_bytes(image)
+    # blocks: 0x0, 0xC000, 0x10000, 0x1C000, 0x20000, 0x2C000, 0x30000 (see split_ranges())
+    flash = StallingFlash(0x10000)
+
+    with BootROMEmulator(baudrate=0, flash=flash) as emulator:
+        args = ["-p", emulator.port] + extra_args + [str(file_name)]
+        cmd = [sys.executable, "-m", "mcom02_flash_tools.mcom02_flash_spi"] + args
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        assert flash.stalled.wait(timeout=60)
+        # the link is lost while the third block is committed
+        proc.kill()
+        proc.wait()
+        flash.release.set()
+        # drop the answer of the interrupted command
+        with serial.Serial(emulator.port, timeout=0.5) as port:
+            port.read(4096)
+        written = len(flash.programmed)
+
+        retcode, _ = run_tool("mcom02_flash_spi", ["--resume"] + args)
+
+    assert retcode == 0
+    assert bytes(flash.data[: len(image)]) == image
+    assert flash.programmed[written:] == [0x10000, 0x1C000, 0x20000, 0x2C000, 0x30000]
+    assert not os.listdir(tmp_path / "xdg-cache" / "mcom02-flash-tools" / "journal")
+
+
+@pytest.mark.noboard
+def test_flash_resume_other_board(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    image = os.urandom(4 * 0xC000 + 1)
+    file_name.write_bytes(image)
+    flash = StallingFlash(0x10000)
+
+    with BootROMEmulator(baudrate=0, flash=flash) as emulator:
+        args = ["-p", emulator.port, "--verify-each", str(file_name)]
+        cmd = [sys.executable, "-m", "mcom02_flash_tools.mcom02_flash_spi"] + args
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+        assert flash.stalled.wait(timeout=60)
+        proc.kill()
+        proc.wait()
+        flash.release.set()
+        with serial.Serial(emulator.port, timeout=0.5) as port:
+            port.read(4096)
+        # other board of the same model has other data in the first block
+        flash.data[:0x100] = b"\xff" * 0x100
+        written = len(flash.programmed)
+
+        retcode, _ = run_tool("mcom02_flash_spi", ["--resume"] + args)
+
+    assert retcode == 0
+    assert bytes(flash.data[: len(image)]) == image
+    assert flash.programmed[written:] == [0x0, 0xC000, 0x10000, 0x1C000, 0x20000, 0x2C000, 0x30000]
+
+
+@pytest.mark.noboard
+def test_flash_stub_fallback(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(1024))
+    stub_file = tmp_path / "stub.hex"
+    stub_file.write_text(":00000001FF\n")  # no start address
+
+    result = benchmark(str(file_name), baudrate=0, stub_file=str(stub_file))
+
+    assert result["retcode"] == 0
+    assert result["flashed"]
+    assert "stub" not in result["phases"]
+
+
+@pytest.mark.noboard
+def test_flash_uboot_emulated(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    # more than 256 YMODEM packets to check sequence number wrapping
+    file_name.write_bytes(os.urandom(300 * 1024 + 1))
+    flash = SPIFlashModel(protected=False)
+
+    result = benchmark(str(file_name), baudrate=0, uboot=True, flash=flash)
+    assert result["retcode"] == 0
+    assert result["flashed"]
+
+    # only the changed sector is written by "sf update"
+    flash.data[0x10005] ^= 0xFF
+    result = benchmark(str(file_name), baudrate=0, uboot=True, flash=flash)
+    assert result["retcode"] == 0
+    assert result["flashed"]
+
+
+@pytest.mark.noboard
+def test_factory_emulated():
+    settings = {"factory_serial": "112233", "factory_eth_mac": "00:11:22:33:44:55"}
+    emulator = UBootEmulator()
+    result = benchmark_factory(
+        ["flash"] + ["{}={}".format(*x) for x in settings.items()], emulator=emulator
+    )
+    assert result["retcode"] == 0
+    assert round_trips(result) <= 8
+    assert read_factory_settings(emulator) == settings
+
+    result = benchmark_factory(["print"], emulator=UBootEmulator(flash=emulator.flash))
+    assert result["retcode"] == 0
+    assert round_trips(result) <= 9
+
+    emulator = UBootEmulator(flash=emulator.flash)
+    result = benchmark_factory(["clear"], emulator=emulator)
+    assert result["retcode"] == 0
+    assert round_trips(result) <= 5
+    assert emulator.flash.data.count(0xFF) == len(emulator.flash.data)
+
+
+@pytest.mark.noboard
+@pytest.mark.skipif(
+    os.geteuid() != 0 or shutil.which("losetup") is None, reason="losetup is not available"
+)
+def test_ums_emulated(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(1024 * 1024 + 512))
+
+    result = benchmark_ums(str(file_name))
+
+    assert result["retcode"] == 0
+    assert result["flashed"]
+
+
+@pytest.mark.noboard
+def test_spi0_controller_shadow():
+    with BootROMEmulator(baudrate=0, flash=SPIFlashModel(jedec_id=0x1F4701)) as emulator:
+        tty = UART(prompt="\r#", port=emulator.port, window=8)
+        sessions = []
+        for _ in range(2):
+            start = len(emulator.records)
+            with SPI0Controller(tty) as spi:
+                assert spi.transfer([0x9F], 3) == [0x1F, 0x47, 0x01]
+                # write-only transfer is queued and sent with the next read
+                spi.transfer([0x06], 0)
+                assert spi.transfer([0x05], 1) == [0x0E]
+            sessions.append(len(emulator.records) - start)
+        tty.tty.close()
+
+    # clock gating and pin function registers are not read and written again
+    assert sessions[1] == sessions[0] - 4
@@ -0,0 +1,49 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import pytest
+
+from mcom02_flash_tools import FlashMemoryError
+from mcom02_flash_tools.flash_chips import UNLOCK_GLOBAL, UNLOCK_NONE, find_chip
+from mcom02_flash_tools.mcom02_flash_spi import (
+    erase_sectors,
+    image_layout,
+    probe_flash,
+    split_ranges,
+)
+
+
+@pytest.mark.noboard
+def test_find_chip():
+    chip = find_chip(0x20BA18)
+    assert (chip.name, chip.size, chip.unlock) == ("N25Q128A", 16 * 1024 * 1024, UNLOCK_NONE)
+    assert str(chip) == "Micron N25Q128A (JEDEC ID 0x20ba18)"
+
+    # unknown memories are unlocked by manufacturer
+    assert find_chip(0x1F9901).size is None
+    assert find_chip(0x1F9901).unlock == UNLOCK_GLOBAL
+    assert find_chip(0x123456).unlock == UNLOCK_NONE
+
+
+@pytest.mark.noboard
+def test_layout_aligned_to_sectors():
+    chip = find_chip(0x1F4701)
+    image = b"\x00" * 0x8000 + b"\xff" * 0x18000 + b"\x00"
+    ranges, skipped = image_layout(image, sparse=True, chip=chip)
+    assert ranges == [(0, 0x10000), (0x20000, 1)]
+    assert skipped == [0x10000]
+    blocks = list(split_ranges(ranges, 0xC000, chip.sector_size))
+    assert blocks == [(0, 0xC000), (0xC000, 0x4000), (0x20000, 1)]
+
+
+@pytest.mark.noboard
+def test_erase_beyond_3byte_addressing():
+    # the offsets are checked before the console is used
+    with pytest.raises(FlashMemoryError, match="beyond 3-byte addressing"):
+        erase_sectors(None, [0x10000, 0x1000000])
+
+
+@pytest.mark.noboard
+def test_probe_unknown_chip():
+    assert probe_flash(0x123456, 16 * 1024 * 1024).size is None
+    with pytest.raises(FlashMemoryError, match="exceeds 3-byte addressing"):
+        probe_flash(0x123456, 16 * 1024 * 1024 + 1)
@@ -0,0 +1,72 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import json
+import os
+import tty
+
+import pytest
+
+from mcom02_flash_tools.benchmark import run_tool
+from mcom02_flash_tools.emulator import BootROMEmulator
+from mcom02_flash_tools.fleet import Board, expand_ports, format_progress
+
+
+@pytest.mark.noboard
+def test_board_progress():
+    board = Board("/dev/ttyUSB0", "image.img")
+    for line in ["SPI Flash: Micron N25Q128A", "Writing to flash...", "Block: 3/10, size: 49152"]:
+        board.update(line)
+    assert (board.phase, board.done, board.total) == ("write", 3, 10)
+    board.update("Checking...")
+    assert (board.phase, board.done, board.total) == ("check", 0, 0)
+    board.update("Error: Checking failed")
+    assert board.error == "Checking failed"
+
+    other = Board("/dev/ttyUSB1", "image.img")
+    other.update("Writing to flash...")
+    other.update("Block: 2/10, size: 49152")
+    assert (
+        format_progress([board, other], 1.0) == "[    1.0 s] write: 1, check: 1 | write 2/10 blocks"
+    )
+
+
+@pytest.mark.noboard
+def test_expand_ports(tmp_path):
+    for i in [0, 1, 2, 10, 11]:
+        (tmp_path / "ttyUSB{}".format(i)).touch()
+    pattern = str(tmp_path / "ttyUSB*")
+    names = [os.path.basename(x) for x in expand_ports([pattern])]
+    assert names == ["ttyUSB0", "ttyUSB1", "ttyUSB2", "ttyUSB10", "ttyUSB11"]
+    # ports are listed in order of the options, duplicates are listed once
+    ports = expand_ports([str(tmp_path / "ttyUSB10"), "/dev/ttyS0", pattern])
+    names = [os.path.basename(x) for x in ports]
+    assert names == ["ttyUSB10", "ttyS0", "ttyUSB0", "ttyUSB1", "ttyUSB2", "ttyUSB11"]
+
+
+@pytest.mark.noboard
+def test_fleet_emulated(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(0x10000 + 1))
+    report = tmp_path / "report.json"
+    # the board does not respond: the port is open but nobody answers
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    stuck = os.ttyname(slave)
+
+    with BootROMEmulator(baudrate=0) as first, BootROMEmulator(baudrate=0) as second:
+        args = ["-p", first.port, "-p", second.port, "-p", stuck, "-t", "3", "-i", "0.5"]
+        args += ["--report", str(report), "--log-dir", str(tmp_path / "logs"), str(file_name)]
+        retcode, wall_time = run_tool("fleet", args)
+        flashed = [x.flash.data[:0x10001] == file_name.read_bytes() for x in (first, second)]
+    os.close(master)
+    os.close(slave)
+
+    assert retcode == 1
+    assert flashed == [True, True]
+    results = {x["port"]: x for x in json.loads(report.read_text())["boards"]}
+    assert results[first.port]["result"] == "OK"
+    assert results[second.port]["result"] == "OK"
+    assert results[stuck]["result"] == "TIMEOUT"
+    # the stuck board does not stall the others
+    assert results[first.port]["duration"] < 3
+    assert len(os.listdir(tmp_path / "logs")) == 3
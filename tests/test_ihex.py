@@ -0,0 +1,44 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import io
+import os
+
+import pytest
+from intelhex import IntelHex
+
+from mcom02_flash_tools.ihex import IHexEncoder, align_block, map_file
+
+
+@pytest.mark.noboard
+@pytest.mark.parametrize(
+    "size, base_addr",
+    [(0, 0x20000000), (1, 0x10), (40, 0x20000000), (0xC000, 0x20000000), (0x20010, 0x2000FFF0)],
+)
+def test_encoder_matches_intelhex(size, base_addr):
+    data = os.urandom(size)
+    ihex = IntelHex()
+    ihex.frombytes(data, base_addr)
+    sio = io.StringIO()
+    ihex.write_hex_file(sio)
+
+    encoder = IHexEncoder(0xC000)
+    assert bytes(encoder.encode(data, base_addr)).decode() == sio.getvalue()
+    # buffer is reused
+    assert bytes(encoder.encode(data, base_addr)).decode() == sio.getvalue()
+
+
+@pytest.mark.noboard
+def test_map_file(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    data = os.urandom(0xC000 + 3)
+    file_name.write_bytes(data)
+
+    with map_file(str(file_name)) as image:
+        assert bytes(image) == data
+        # the block of odd size is aligned to 2 bytes (rf#2088)
+        assert bytes(align_block(image[0xC000:])) == data[0xC000:] + b"\xff"
+        assert len(align_block(image[:0xC000])) == 0xC000
+
+    (tmp_path / "empty.img").write_bytes(b"")
+    with map_file(str(tmp_path / "empty.img")) as image:
+        assert len(image) == 0
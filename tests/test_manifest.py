@@ -0,0 +1,71 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import json
+
+import pytest
+
+from mcom02_flash_tools.manifest import Manifest
+from mcom02_flash_tools.mcom02_flash_spi import SECTOR_SIZE, image_layout
+
+
+@pytest.mark.noboard
+def test_manifest_yaml(tmp_path):
+    (tmp_path / "boot.img").write_bytes(b"\x01" * (SECTOR_SIZE + 3))
+    (tmp_path / "board.dtb").write_bytes(b"\x02" * 5)
+    manifest_file = tmp_path / "board.yaml"
+    manifest_file.write_text(
+        "regions:\n"
+        "  - file: board.dtb\n"
+        "    offset: 0x30000\n"
+        "    size: 0x10000\n"
+        "  - file: boot.img\n"
+        "    offset: 0\n"
+        "  - fill: 0xff\n"
+        "    offset: 0x40000\n"
+        "    size: 0x20000\n"
+        "  - fill: 0\n"
+        "    offset: 0x60000\n"
+        "    size: 16\n"
+    )
+    manifest = Manifest.load(str(manifest_file))
+    manifest.validate(SECTOR_SIZE)
+    image, regions, fills = manifest.build_image()
+
+    assert len(image) == 0x60010
+    assert image[SECTOR_SIZE : SECTOR_SIZE + 4] == b"\x01\x01\x01\xff"
+    assert image[0x30000:0x30006] == b"\x02" * 5 + b"\xff"
+    assert image[0x60000:] == bytes(16)
+    assert regions == [(0, SECTOR_SIZE + 3), (0x30000, 5), (0x60000, 16)]
+    assert fills == [(0x40000, 0x20000)]
+    assert image_layout(image, regions, fills) == (regions, [0x40000, 0x50000])
+
+
+@pytest.mark.noboard
+@pytest.mark.parametrize(
+    "regions, error",
+    [
+        pytest.param([{"fill": 0, "offset": 0}], "size is required", id="fill without size"),
+        pytest.param([{"file": "a.img", "offset": 0x100}], "not aligned", id="unaligned"),
+        pytest.param(
+            [{"file": "a.img", "offset": 0}, {"fill": 0xFF, "offset": 0, "size": 1}],
+            "overlap",
+            id="overlap",
+        ),
+        pytest.param(
+            [{"file": "a.img", "offset": 0}, {"file": "a.img", "offset": "0x10000"}],
+            "overlap",
+            id="shared sector",
+        ),
+        pytest.param([{"file": "a.img", "offset": 0, "size": 8}], "larger", id="too large"),
+        pytest.param([{"file": "b.img", "offset": 0}], "not found", id="missing file"),
+        pytest.param([{"fill": 0x100, "offset": 0, "size": 1}], "byte", id="bad fill"),
+        pytest.param([{"file": "a.img", "offset": "zero"}], "integer", id="bad offset"),
+        pytest.param([], "list of regions", id="empty"),
+    ],
+)
+def test_manifest_errors(tmp_path, regions, error):
+    (tmp_path / "a.img").write_bytes(b"\x00" * (SECTOR_SIZE + 1))
+    manifest_file = tmp_path / "board.json"
+    manifest_file.write_text(json.dumps({"regions": regions}))
+    with pytest.raises(ValueError, match=error):
+        Manifest.load(str(manifest_file)).validate(SECTOR_SIZE)
@@ -0,0 +1,36 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import pytest
+
+from mcom02_flash_tools import microbench
+
+
+@pytest.mark.noboard
+def test_microbench(tmp_path):
+    results = microbench.run_suite(sizes=[64 * 1024], repeat=1, min_time=0)
+    assert list(results) == ["{}/65536".format(x) for x in microbench.CASES]
+    for result in results.values():
+        assert result["throughput"] > 0
+        assert result["peak"] > 0
+    assert results["wait_for_string/65536"]["bytes"] > 2 * 64 * 1024
+
+    baseline_file = tmp_path / "baseline.json"
+    microbench.save_baseline(str(baseline_file), results)
+    baseline = microbench.load_baseline(str(baseline_file))
+    assert microbench.compare(results, baseline) == []
+
+    key = "check_blocks/65536"
+    baseline[key] = dict(baseline[key], throughput=results[key]["throughput"] * 2)
+    baseline["dump_decode/65536"]["peak"] = results["dump_decode/65536"]["peak"] // 2
+    regressions = microbench.compare(results, baseline)
+    assert len(regressions) == 2
+    assert regressions[0].startswith("dump_decode/65536: peak memory")
+    assert regressions[1].startswith("check_blocks/65536: throughput")
+    assert microbench.compare(results, baseline, max_slowdown=0.6, max_memory_growth=1.5) == []
+
+
+@pytest.mark.noboard
+def test_parse_size():
+    assert microbench.parse_size("64K") == 64 * 1024
+    assert microbench.parse_size("32m") == 32 * 1024 * 1024
+    assert microbench.parse_size("1000") == 1000
@@ -19,6 +19,8 @@ def test_help_version():
     sh.mcom02_flash_factory("--version")
     sh.mcom02_flash_ums_mmc("--help")
     sh.mcom02_flash_ums_mmc("--version")
+    sh.mcom02_flash_bench("--help")
+    sh.mcom02_flash_bench("--version")
 
 
 # As per rf#2088 there is a bug that BootROM can't write images with odd number of bytes.
@@ -0,0 +1,44 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import pytest
+
+from mcom02_flash_tools.profile import Autotuner, Profile
+
+
+@pytest.mark.noboard
+def test_autotuner():
+    tuner = Autotuner((0x2000, 0x4000))
+    sizes = tuner.block_sizes()
+    assert [next(sizes) for _ in range(3)] == [0x2000, 0x4000, 0x2000]
+    tuner.add(0x2000, 2.0)
+    tuner.add(0x2000, 2.0)
+    tuner.add(0x4000, 2.0)
+    # incomplete block is not accounted
+    tuner.add(0x1001, 0.001)
+    assert tuner.rates() == {0x2000: 0x1000, 0x4000: 0x2000}
+
+
+@pytest.mark.noboard
+def test_autotuner_boundary():
+    tuner = Autotuner((0x4000, 0xC000), boundary=0x10000)
+    sizes = tuner.block_sizes()
+    # the last block of 0xC000 is shortened to the boundary by split_ranges()
+    assert [next(sizes) for _ in range(7)] == [0x4000] * 4 + [0xC000] * 2 + [0x4000]
+
+
+@pytest.mark.noboard
+def test_profile(tmp_path):
+    path = tmp_path / "config" / "profile.json"
+    profile = Profile(str(path))
+    assert profile.block_size("board", 115200, "upload", 0xC000) == 0xC000
+    assert profile.update("board", 115200, "upload", {}) is None
+
+    assert profile.update("board", 115200, "upload", {0x2000: 10.0, 0x4000: 20.0}) == 0x4000
+    # measured rates are merged with stored ones
+    assert profile.update("board", 115200, "upload", {0x4000: 5.0}) == 0x2000
+    profile.save()
+
+    profile = Profile(str(path))
+    assert profile.block_size("board", 115200, "upload", 0xC000) == 0x2000
+    assert profile.block_size("board", 921600, "upload", 0xC000) == 0xC000
+    assert profile.block_size("other", 115200, "check", 0x2000) == 0x2000
@@ -0,0 +1,76 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import json
+import os
+
+import pytest
+
+from mcom02_flash_tools.benchmark import benchmark, benchmark_factory
+from mcom02_flash_tools.trace import Tracer, span, trace_run, tracing
+
+
+@pytest.mark.noboard
+def test_tracer():
+    with span("untraced") as s:
+        s.set(rx=1)
+
+    tracer = Tracer()
+    with tracing(tracer):
+        with span("phase", "phase"):
+            for _ in range(3):
+                with span("run", tx=10, baudrate=100) as s:
+                    s.set(rx=20)
+            with pytest.raises(ValueError):
+                with span("failed"):
+                    raise ValueError()
+    tracer.finish(True)
+
+    stats = tracer.stats()
+    assert list(stats) == ["run", "failed", "phase"]
+    assert (len(stats["run"].durations), stats["run"].tx, stats["run"].rx) == (3, 30, 60)
+    assert stats["run"].tx_time == pytest.approx(30 * 10 / 100)
+    assert stats["run"].rx_time == pytest.approx(60 * 10 / 100)
+    assert tracer.link_stats()[:2] == (30, 60)
+    assert tracer.events[3][4] == {"error": "ValueError"}
+
+    events = tracer.chrome_trace()["traceEvents"]
+    assert [x["name"] for x in events if x["ph"] == "X"] == ["run"] * 3 + ["failed", "phase"]
+
+    metrics = tracer.prometheus({"port": "/dev/ttyUSB0"})
+    assert 'mcom02_flash_success{port="/dev/ttyUSB0"} 1' in metrics
+    assert 'mcom02_flash_span_seconds_count{port="/dev/ttyUSB0",span="run"} 3' in metrics
+    assert 'mcom02_flash_span_seconds_bucket{port="/dev/ttyUSB0",span="run",le="+Inf"} 3' in metrics
+    assert "Latency of commands:" in tracer.summary()
+
+
+@pytest.mark.noboard
+def test_trace_run_failure(tmp_path, capsys):
+    prometheus_file = tmp_path / "metrics.prom"
+    with pytest.raises(SystemExit):
+        with trace_run(prometheus_file=str(prometheus_file), labels={"tool": "test"}):
+            raise SystemExit(1)
+
+    assert 'mcom02_flash_success{tool="test"} 0' in prometheus_file.read_text()
+    assert "Trace summary" in capsys.readouterr().err
+
+
+@pytest.mark.noboard
+def test_trace_tools(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(0xC000 + 3))
+    trace_file = tmp_path / "trace.json"
+    prometheus_file = tmp_path / "metrics.prom"
+    trace_args = ["--trace", str(trace_file), "--prometheus", str(prometheus_file)]
+
+    result = benchmark(str(file_name), baudrate=0, extra_args=trace_args)
+    assert result["retcode"] == 0
+    names = {x["name"] for x in json.loads(trace_file.read_text())["traceEvents"]}
+    assert {"run_batch", "send_ihex", "dumpspiflash", "spi_transfer", "write", "check"} <= names
+    metrics = prometheus_file.read_text()
+    assert "mcom02_flash_success{" in metrics
+    assert 'phase="write"' in metrics
+
+    result = benchmark_factory(trace_args + ["print"])
+    assert result["retcode"] == 0
+    names = {x["name"] for x in json.loads(trace_file.read_text())["traceEvents"]}
+    assert {"run", "wait_for_string", "read"} <= names
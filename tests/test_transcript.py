@@ -0,0 +1,94 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import json
+import os
+import time
+
+import pytest
+
+from mcom02_flash_tools import UART, ReplayError
+from mcom02_flash_tools.benchmark import benchmark, benchmark_factory, run_tool
+from mcom02_flash_tools.transcript import ReplaySerial, load_transcript
+
+
+def write_transcript(path, events):
+    with open(path, "w") as f:
+        f.write(json.dumps({"version": 1, "port": "/dev/ttyUSB0", "baudrate": 115200}) + "\n")
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+
+
+@pytest.mark.noboard
+def test_replay_timing(tmp_path):
+    transcript = tmp_path / "transcript.jsonl"
+    write_transcript(
+        transcript,
+        [
+            {"t": 0.0, "tx": "ls\n"},
+            {"t": 0.01, "rx": "ls\n"},
+            {"t": 0.3, "rx": "file\r\n\r#"},
+        ],
+    )
+
+    durations = {}
+    for speed in [1, 2, None]:
+        tty = ReplaySerial(str(transcript), speed)
+        uart = UART(prompt="\r#", port=tty)
+        start = time.monotonic()
+        assert uart.run("ls") == "file"
+        durations[speed] = time.monotonic() - start
+        assert tty.remaining == 0
+
+    assert durations[1] >= 0.3
+    assert 0.15 <= durations[2] < 0.3
+    assert durations[None] < 0.1
+
+    uart = UART(prompt="\r#", port=ReplaySerial(str(transcript), None))
+    with pytest.raises(ReplayError, match=r"host sent b'x\\n' at byte 1, recorded b's\\n'"):
+        uart.run("lx")
+
+    tty = ReplaySerial(str(transcript), None, strict=False)
+    UART(prompt="\r#", port=tty).run("cd")
+    assert len(tty.divergences) == 1
+
+
+@pytest.mark.noboard
+def test_record_replay(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    image = os.urandom(0xC000 + 3)
+    file_name.write_bytes(image)
+    transcript = tmp_path / "spi.jsonl"
+
+    result = benchmark(str(file_name), baudrate=0, extra_args=["--record", str(transcript)])
+    assert result["retcode"] == 0
+    header, events = load_transcript(str(transcript))
+    assert header["baudrate"] == 115200
+    assert b"".join(x[2] for x in events if x[1] == "rx").endswith(b"\r#")
+
+    replay_port = "replay:{}@max".format(transcript)
+    assert run_tool("mcom02_flash_spi", ["-p", replay_port, str(file_name)])[0] == 0
+
+    # the host sends other Intel-HEX records for other image
+    file_name.write_bytes(bytes(len(image)))
+    assert run_tool("mcom02_flash_spi", ["-p", replay_port, str(file_name)])[0] == 1
+
+    transcript = tmp_path / "factory.jsonl"
+    assert benchmark_factory(["--record", str(transcript), "print"])["retcode"] == 0
+    args = ["-p", "replay:{}@max".format(transcript), "-t", "10", "print"]
+    assert run_tool("mcom02_flash_factory", args)[0] == 0
+
+
+@pytest.mark.noboard
+def test_record_replay_negotiated_baudrate(tmp_path):
+    file_name = tmp_path / "test_file.img"
+    file_name.write_bytes(os.urandom(0x10000 + 3))
+    transcript = tmp_path / "uboot.jsonl"
+
+    extra_args = ["-b", "921600", "--record", str(transcript)]
+    result = benchmark(str(file_name), baudrate=0, extra_args=extra_args, uboot=True)
+    assert result["retcode"] == 0
+    _, events = load_transcript(str(transcript))
+    assert [x[2] for x in events if x[1] == "baudrate"][0] == 921600
+
+    args = ["-p", "replay:{}@max".format(transcript), "--uboot", "-t", "10", "-b", "921600"]
+    assert run_tool("mcom02_flash_spi", args + [str(file_name)])[0] == 0
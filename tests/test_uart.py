@@ -0,0 +1,200 @@
+# Copyright 2024 RnD Center "ELVEES", JSC
+
+import os
+import threading
+import time
+import tty
+import types
+
+import pytest
+
+from mcom02_flash_tools import UART, CommandError, UARTProtocol
+from mcom02_flash_tools.emulator import BootROMEmulator, UBootEmulator
+
+
+@pytest.fixture
+def pty_uart():
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    uart = UART(prompt="mcom# ", port=os.ttyname(slave), timeout=0.1)
+    yield uart, master
+    uart.tty.close()
+    os.close(master)
+    os.close(slave)
+
+
+@pytest.mark.noboard
+def test_wait_for_string_keeps_tail(pty_uart):
+    uart, master = pty_uart
+    os.write(master, b"first\r\nmcom# second\r\nmcom# ")
+    time.sleep(0.05)
+
+    assert uart.wait_for_string("mcom# ") == (True, "first\nmcom# ")
+    assert uart.wait_for_string("mcom# ") == (True, "second\nmcom# ")
+    assert uart.wait_for_string("mcom# ", timeout=0.2) == (False, "")
+
+
+@pytest.mark.noboard
+def test_wait_for_string_earliest_pattern(pty_uart):
+    uart, master = pty_uart
+    os.write(master, b"Hit any key to stop autoboot:  1 mcom# ")
+    time.sleep(0.05)
+
+    ok, resp = uart.wait_for_string(["mcom# ", "Hit any key to stop autoboot:"])
+    assert ok
+    assert resp == "Hit any key to stop autoboot:"
+    assert uart.wait_for_string("mcom# ") == (True, "  1 mcom# ")
+
+
+@pytest.mark.noboard
+def test_read_until_split_prompt(pty_uart):
+    uart, master = pty_uart
+    data = b"0x0 : 0x1\r\nmcom# rest"
+
+    def writer():
+        for i in range(len(data)):
+            os.write(master, data[i : i + 1])
+            time.sleep(0.002)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    chunks = list(uart.read_until("mcom# ", timeout=2))
+    thread.join()
+    assert b"".join(chunks) == b"0x0 : 0x1\r\nmcom# "
+    assert uart.read_bytes(4) == b"rest"
+    with pytest.raises(CommandError):
+        list(uart.read_until("mcom# ", timeout=0.2))
+
+
+@pytest.mark.noboard
+def test_wait_for_string_split_utf8(pty_uart):
+    uart, master = pty_uart
+    data = "Прошивка\r\nmcom# ".encode()
+
+    def writer():
+        for i in range(len(data)):
+            os.write(master, data[i : i + 1])
+            time.sleep(0.002)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    ok, resp = uart.wait_for_string("mcom# ", timeout=2)
+    thread.join()
+    assert ok
+    assert resp == "Прошивка\nmcom# "
+
+
+@pytest.mark.noboard
+def test_protocol_steps():
+    protocol = UARTProtocol(prompt="\nmcom# ", retcode_mode="inline")
+    protocol.tty = types.SimpleNamespace(baudrate=115200)
+    steps = protocol._run_with_retcode_steps("version")
+    assert next(steps) == ("write", b"version; echo @rc@$?\n")
+    assert steps.send(None) == ("read", pytest.approx(5, abs=1))
+    # the response is received in parts, the generator reads until the prompt
+    assert steps.send(b"version; echo @rc@$?\r\nU-Boot 2017.01\r\n")[0] == "read"
+    with pytest.raises(StopIteration) as stop:
+        steps.send(b"@rc@0\r\nmcom# ")
+    assert stop.value.value == (0, "U-Boot 2017.01")
+
+    # errors of the transport are raised in the generator
+    steps = protocol._run_steps("version")
+    next(steps)
+    next(steps)
+    with pytest.raises(OSError):
+        steps.throw(OSError("read failed"))
+
+
+@pytest.mark.noboard
+def test_run_batch_attributes_errors():
+    with BootROMEmulator(baudrate=0) as emulator:
+        uart = UART(prompt="\r#", port=emulator.port, window=4)
+        assert uart.run("") is not None
+        cmds = ["set 38032014 5dc0", "bogus 1", "dump 38032014 1", "autorun 0", "cache 1"]
+        resps = uart.run_batch(cmds, strip_echo=False)
+        uart.tty.close()
+
+    assert len(resps) == len(cmds)
+    assert all(cmd in resp for cmd, resp in zip(cmds, resps))
+    assert [i for i, x in enumerate(resps) if "Incorrect command" in x] == [1]
+    assert "0x00005dc0" in resps[2]
+
+
+@pytest.mark.noboard
+@pytest.mark.parametrize("retcode_mode", ["auto", "inline", "separate"])
+def test_run_with_retcode(retcode_mode):
+    with UBootEmulator(power_on="prompt", baudrate=0) as emulator:
+        uart = UART(prompt="\nmcom# ", port=emulator.port, retcode_mode=retcode_mode)
+        assert uart.run_with_retcode("echo line1; echo line2") == (0, "line1\nline2")
+        assert uart.run_with_retcode("setenv a 1") == (0, "")
+        assert uart.run_with_retcode("env print a") == (0, "a=1")
+        retcode, result = uart.run_with_retcode("env print nonexistent", check=False)
+        with pytest.raises(CommandError, match="No variable"):
+            uart.run_with_retcode("env print nonexistent", errmsg="No variable")
+        # unstripped response is the same in all modes: echo of command, output and prompt
+        unstripped = uart.run_with_retcode("echo line1", strip_echo=False)
+        batch = uart.run_batch_with_retcode(["setenv a 2", "echo $a"], strip_echo=False)
+        uart.tty.close()
+
+    assert unstripped == (0, "echo line1\nline1\nmcom# ")
+    assert batch == [(0, "setenv a 2\nmcom# "), (0, "echo $a\n2\nmcom# ")]
+    assert retcode == 1
+    assert "not defined" in result
+    assert uart.retcode_mode == ("separate" if retcode_mode == "separate" else "inline")
+
+
+@pytest.mark.noboard
+@pytest.mark.parametrize("retcode_mode", ["inline", "separate"])
+def test_run_batch_with_retcode(retcode_mode):
+    with UBootEmulator(power_on="prompt", baudrate=0) as emulator:
+        uart = UART(prompt="\nmcom# ", port=emulator.port, window=3, retcode_mode=retcode_mode)
+        results = uart.run_batch_with_retcode(
+            ["setenv a 1", "env print nonexistent", "echo $a"], check=False
+        )
+        with pytest.raises(CommandError, match="env print nonexistent"):
+            uart.run_batch_with_retcode(["setenv b 2", "env print nonexistent"])
+        uart.tty.close()
+
+    assert results[0] == (0, "")
+    assert results[1][0] == 1
+    assert results[2] == (0, "1")
+    assert emulator.env["b"] == "2"
+
+
+@pytest.mark.noboard
+def test_run_with_retcode_long_command():
+    value = "x" * 240
+    with UBootEmulator(power_on="prompt", baudrate=0, cbsize=256) as emulator:
+        uart = UART(prompt="\nmcom# ", port=emulator.port, window=3, retcode_mode="inline")
+        # the command fits to the command line buffer only without the echo of return code
+        single = uart.run_with_retcode("setenv a " + value)
+        a = emulator.env["a"]
+        batch = uart.run_batch_with_retcode(
+            ["setenv b 1", "setenv c " + value, "echo $b"], strip_echo=False
+        )
+        uart.tty.close()
+
+    assert single == (0, "")
+    assert a == value
+    assert emulator.env["c"] == value
+    assert batch == [
+        (0, "setenv b 1\nmcom# "),
+        (0, "setenv c {}\nmcom# ".format(value)),
+        (0, "echo $b\n1\nmcom# "),
+    ]
+    assert uart.retcode_mode == "inline"
+
+
+@pytest.mark.noboard
+def test_negotiate_baudrate():
+    with UBootEmulator(power_on="prompt", baudrate=115200, max_baudrate=921600) as emulator:
+        uart = UART(prompt="\nmcom# ", port=emulator.port)
+        assert uart.negotiate_baudrate(uart.set_uboot_baudrate, 3000000) == 921600
+        assert emulator.baudrate == 921600
+        assert uart.run_with_retcode("echo ok") == (0, "ok")
+        uart.restore_baudrate()
+        assert uart.tty.baudrate == 115200
+        assert uart.run_with_retcode("echo ok") == (0, "ok")
+        uart.tty.close()
+
+    assert emulator.baudrate == 115200